@@ -0,0 +1,265 @@
+'''
+CAPP 30122: Benchmark the transcript processing pipeline
+
+Runs every saved transcript page in BENCHMARK_DIR through the same steps as
+a crawl (parse the page, crawler_util.crawl_transcript to clean the text,
+resolve speakers and insert the rows into an in-memory copy of news.sql)
+and reports per-page latency percentiles and throughput for each network,
+compared with a stored baseline.
+'''
+
+import os
+import io
+import json
+import time
+import sqlite3
+import argparse
+import contextlib
+import crawler_cnn
+import crawler_fox
+import crawler_msnbc
+import crawler_util
+
+
+BENCHMARK_DIR = 'benchmark_pages'
+BASELINE_FILENAME = os.path.join(BENCHMARK_DIR, 'baseline.json')
+SCHEMA_FILENAME = 'news.sql'
+REPEATS = 5
+PERCENTILES = [50, 90, 99]
+
+# A network is reported as slower than the baseline when its median latency
+# or its throughput is more than TOLERANCE (as a fraction) worse.
+TOLERANCE = 0.2
+
+# Folders of BENCHMARK_DIR: crawler module and the function it uses to pull
+# the raw transcript text out of a parsed page
+NETWORKS = {'cnn': (crawler_cnn, crawler_cnn.get_cnn_transcript_text),
+            'fox': (crawler_fox, crawler_fox.get_fox_transcript_text),
+            'msnbc': (crawler_msnbc, crawler_msnbc.get_msnbc_transcript_text)}
+
+
+def load_corpus(directory=BENCHMARK_DIR):
+    '''
+    Read the saved transcript pages.
+
+    Inputs:
+        directory: (str) folder with one subfolder of .html pages per
+            network in NETWORKS
+
+    Outputs: list of (network, file name, page HTML) tuples, sorted
+    '''
+    corpus = []
+    for network in sorted(NETWORKS):
+        network_dir = os.path.join(directory, network)
+        if not os.path.isdir(network_dir):
+            continue
+        for filename in sorted(os.listdir(network_dir)):
+            if filename.endswith('.html'):
+                with open(os.path.join(network_dir, filename),
+                          encoding='utf-8') as f:
+                    corpus.append((network, filename, f.read()))
+
+    return corpus
+
+
+def process_page(network, page_text, ids, db_cursor):
+    '''
+    Load one transcript page into the database the way the crawlers do.
+
+    Inputs:
+        network: (str) key of NETWORKS
+        page_text: (str) HTML of the transcript page
+        ids: list of the next episode, speaker and phrase IDs, updated in
+            place
+        db_cursor: cursor of the benchmark database
+    '''
+    crawler, get_transcript_text = NETWORKS[network]
+    soup = crawler_util.make_soup(page_text, crawler.STRAINERS)
+    transcript_text = get_transcript_text(soup)
+
+    episode_id, speaker_id, phrase_id = ids
+    speaker_id, phrase_id = crawler_util.crawl_transcript(transcript_text,
+        crawler.BEGIN_FLAG, crawler.END_FLAG, episode_id, speaker_id,
+        phrase_id, db_cursor)
+    db_cursor.execute('INSERT INTO episode VALUES(?, ?, ?, ?)',
+                      (episode_id, network, '', network))
+    ids[:] = [episode_id + 1, speaker_id, phrase_id]
+
+
+def run_benchmark(corpus, repeats=REPEATS):
+    '''
+    Time every page of the corpus, repeats times, each time into a fresh
+    in-memory database. The pipeline's progress messages are not printed.
+
+    Outputs: dictionary mapping each network (and "all") to a list of
+        per-page latencies in seconds and the total seconds taken
+    '''
+    with open(SCHEMA_FILENAME) as f:
+        schema = f.read()
+
+    timings = {}
+    for _ in range(repeats):
+        db_connection = sqlite3.connect(':memory:')
+        db_connection.executescript(schema)
+        db_cursor = db_connection.cursor()
+        ids = [0, 0, 0]
+
+        for network, _, page_text in corpus:
+            with contextlib.redirect_stdout(io.StringIO()):
+                start = time.perf_counter()
+                process_page(network, page_text, ids, db_cursor)
+                db_connection.commit()
+                latency = time.perf_counter() - start
+
+            for key in [network, 'all']:
+                network_timings = timings.setdefault(key, {'latencies': [],
+                                                           'seconds': 0})
+                network_timings['latencies'].append(latency)
+                network_timings['seconds'] += latency
+
+        db_connection.close()
+
+    return timings
+
+
+def get_percentile(sorted_values, percentile):
+    '''
+    Return the nearest-rank percentile of a sorted list.
+    '''
+    rank = max(0, -(-percentile * len(sorted_values) // 100) - 1)
+
+    return sorted_values[rank]
+
+
+def summarize_timings(timings):
+    '''
+    Turn the output of run_benchmark into latency percentiles
+    (milliseconds) and throughput for each network.
+
+    Outputs: dictionary mapping each network (and "all") to a dictionary of
+        pages, p50_ms, p90_ms, p99_ms, max_ms and pages_per_second
+    '''
+    summary = {}
+    for network, network_timings in sorted(timings.items()):
+        latencies = sorted(network_timings['latencies'])
+        network_summary = {'pages': len(latencies)}
+        for percentile in PERCENTILES:
+            network_summary['p{}_ms'.format(percentile)] = \
+                1000 * get_percentile(latencies, percentile)
+        network_summary['max_ms'] = 1000 * latencies[-1]
+        network_summary['pages_per_second'] = \
+            len(latencies) / network_timings['seconds']
+        summary[network] = network_summary
+
+    return summary
+
+
+def compare_to_baseline(summary, baseline, tolerance=TOLERANCE):
+    '''
+    Find the networks that got slower than the baseline.
+
+    Outputs: list of messages, one per slower network and measure
+    '''
+    regressions = []
+    for network, network_summary in summary.items():
+        if network not in baseline:
+            continue
+        old, new = baseline[network]['p50_ms'], network_summary['p50_ms']
+        if new > old * (1 + tolerance):
+            regressions.append('{}: median latency {:.2f} ms -> {:.2f} ms'\
+                .format(network, old, new))
+        old = baseline[network]['pages_per_second']
+        new = network_summary['pages_per_second']
+        if new < old * (1 - tolerance):
+            regressions.append('{}: throughput {:.1f} -> {:.1f} pages/s'\
+                .format(network, old, new))
+
+    return regressions
+
+
+def print_summary(summary, baseline=None):
+    '''
+    Print the benchmark summary as a table, with the change from the
+    baseline in median latency and throughput if there is one.
+    '''
+    columns = ['pages'] + ['p{}_ms'.format(percentile)
+                           for percentile in PERCENTILES] + \
+              ['max_ms', 'pages_per_second']
+    print('{:<8}'.format('network') +
+          ''.join(['{:>18}'.format(column) for column in columns]))
+    for network, network_summary in summary.items():
+        line = '{:<8}'.format(network)
+        for column in columns:
+            value = network_summary[column]
+            if baseline and network in baseline and \
+                    column in ['p50_ms', 'pages_per_second']:
+                change = 100 * (value / baseline[network][column] - 1)
+                line += '{:>18}'.format('{:.2f} ({:+.0f}%)'.format(value,
+                                                                   change))
+            elif isinstance(value, float):
+                line += '{:>18.2f}'.format(value)
+            else:
+                line += '{:>18}'.format(value)
+        print(line)
+
+
+def go(directory=BENCHMARK_DIR, repeats=REPEATS,
+       baseline_filename=BASELINE_FILENAME, save_baseline=False,
+       tolerance=TOLERANCE):
+    '''
+    Run the benchmark and compare it with the baseline.
+
+    Inputs:
+        directory: (str) folder of saved transcript pages
+        repeats: (int) number of times to process the corpus
+        baseline_filename: (str) JSON file with the baseline summary
+        save_baseline: (bool) store this run's summary as the new baseline
+            instead of comparing with it
+        tolerance: (float) slowdown (as a fraction) reported as a regression
+
+    Outputs: list of regression messages (empty if none)
+    '''
+    corpus = load_corpus(directory)
+    summary = summarize_timings(run_benchmark(corpus, repeats))
+
+    baseline = None
+    if not save_baseline and os.path.exists(baseline_filename):
+        with open(baseline_filename) as f:
+            baseline = json.load(f)
+
+    print(len(corpus), "pages,", repeats, "repeats")
+    print_summary(summary, baseline)
+
+    if save_baseline:
+        with open(baseline_filename, 'w') as f:
+            json.dump(summary, f, indent=2, sort_keys=True)
+        print("Saved baseline to", baseline_filename)
+        return []
+
+    regressions = []
+    if baseline is not None:
+        regressions = compare_to_baseline(summary, baseline, tolerance)
+    for regression in regressions:
+        print("SLOWER THAN BASELINE", regression)
+
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(\
+        description="Benchmark the transcript processing pipeline")
+    parser.add_argument("--pages", default=BENCHMARK_DIR,
+                        help="folder of saved transcript pages")
+    parser.add_argument("--repeat", type=int, default=REPEATS,
+                        help="number of times to process the pages")
+    parser.add_argument("--baseline", default=BASELINE_FILENAME,
+                        help="JSON file with the baseline results")
+    parser.add_argument("--save-baseline", action="store_true",
+                        help="store this run as the new baseline")
+    parser.add_argument("--tolerance", type=float, default=TOLERANCE,
+                        help="slowdown reported as a regression (fraction)")
+    args = parser.parse_args()
+
+    if go(args.pages, args.repeat, args.baseline, args.save_baseline,
+          args.tolerance):
+        raise SystemExit(1)
@@ -0,0 +1,503 @@
+'''
+CAPP 30122: Crawl with any number of worker processes sharing a work queue
+
+The crawl is split into work items in a queue (see work_queue.py):
+    - "show": read a show's listing and queue an episode item for each
+      transcript in the crawl window. Fox shows are paginated through the
+      browser, in airtime order, so a Fox show item crawls the whole show.
+    - "episode": fetch and parse a transcript and resolve its speakers
+    - "write": load an episode (or a crawl frontier update) into the
+      database
+Workers (python crawl_workers.py work) claim show and episode items, on as
+many machines as can open the queue file; the one writer (python
+crawl_workers.py write) is the only process that opens the database, and
+hands out IDs as in run_crawlers.py. A worker that dies or hangs loses its
+leases, and its items are crawled again by the others.
+'''
+
+import os
+import time
+import sqlite3
+import argparse
+import datetime
+import crawler_cnn
+import crawler_fox
+import crawler_msnbc
+import crawler_util
+import run_crawlers
+import work_queue
+import reparse_transcripts
+
+
+# Items a worker claims at a time; the episodes among them are fetched
+# concurrently through the scheduler and parsed in the parse pool
+WORK_BATCH = 16
+
+# Write items loaded into the database per transaction
+WRITE_BATCH = 200
+
+# Seconds to wait before asking again when nothing is queued but other
+# processes still hold items
+POLL_SECONDS = 2
+
+NETWORK_NAMES = {'fox': 'Fox', 'cnn': 'CNN', 'msnbc': 'MSNBC'}
+
+
+def get_write_items():
+    '''
+    Turn the writer items captured by the crawlers into write work items.
+    '''
+    return [('write', None, item)
+            for item in crawler_util.take_captured_writes()]
+
+
+def get_episode_item(show, url, headline=None):
+    '''
+    Return the episode work item for a transcript found in a show's listing.
+    Each transcript is queued once, under the first show listing it.
+    '''
+    entry = {'network': show['network'], 'show': show['show'],
+             'listing': show['listing'], 'url': url, 'headline': headline,
+             'start': show['start'], 'end': show['end']}
+
+    return ('episode', 'episode ' + url, entry)
+
+
+def list_show(show, progress=None):
+    '''
+    Read a show's listing and return the work items it produces: its
+    episodes, and the crawl frontier entries for the writer. A Fox show is
+    crawled completely here instead.
+
+    Inputs:
+        show: payload of a show item (see seed)
+        progress: function called with no arguments after each page of a
+            Fox show (see crawler_fox.paginate_show)
+
+    Outputs: list of (kind, key, payload) tuples
+    '''
+    title, listing = show['show'], show['listing']
+    start, end = show['start'], show['end']
+    crawler_util.set_crawl_context(show['network'], title)
+
+    if show['network'] == 'Fox':
+        for show_name, mark in show['marks'].items():
+            crawler_util.update_crawl_mark(show_name, *mark)
+        crawler_fox.crawl_show(show['starting_url'], listing, title, None,
+                               show['incremental'], start, end, progress)
+        return get_write_items()
+
+    episodes = []
+    if show['network'] == 'CNN':
+        transcripts_request = crawler_util.get_listing(listing, stream=True)
+        if transcripts_request is None:
+            raise ValueError("listing could not be fetched")
+        title, day_blocks = crawler_cnn.read_listing(show['starting_url'],
+            transcripts_request, start, end, show['incremental'],
+            show['marks'])
+        show = dict(show, show=title)
+        for headlines, links in day_blocks:
+            crawler_util.add_to_frontier('CNN', title, links, listing,
+                                         headlines)
+            episodes.extend([get_episode_item(show, link, headline)
+                             for headline, link in zip(headlines, links)])
+    else:
+        transcripts_request = crawler_util.get_listing(listing)
+        if transcripts_request is None:
+            raise ValueError("listing could not be fetched")
+        mark_url = None
+        if show['incremental']:
+            _, mark_url = crawler_util.get_crawl_mark(title, show['marks'])
+        links = crawler_msnbc.read_listing(show['starting_url'],
+            transcripts_request.text, start, end, mark_url)
+        crawler_util.add_to_frontier('MSNBC', title, links, listing)
+        episodes = [get_episode_item(show, link) for link in links]
+
+    return episodes + get_write_items()
+
+
+def crawl_episodes(entries):
+    '''
+    Fetch, parse and load a batch of episodes of one network and crawl
+    window, as crawl_show does for the episodes of a listing.
+
+    Inputs:
+        entries: list of episode item payloads (see get_episode_item)
+
+    Outputs: list of write work items
+    '''
+    network_name = entries[0]['network']
+    start, end = entries[0]['start'], entries[0]['end']
+    crawler_util.set_crawl_context(network_name)
+
+    transcript_requests = crawler_util.get_requests(\
+        [entry['url'] for entry in entries])
+    parsed_transcripts = crawler_util.parse_responses(\
+        reparse_transcripts.parse_and_resolve, transcript_requests,
+        reparse_transcripts.PARSE_FUNCTIONS[network_name], start, end)
+    for entry, (link, parsed_transcript) in zip(entries, parsed_transcripts):
+        if parsed_transcript is None:
+            continue
+        crawler_util.set_crawl_context(network_name, entry['show'])
+        loaded = reparse_transcripts.load_episode(entry, parsed_transcript,
+                                                  start, end)
+        if not loaded:
+            crawler_util.mark_url(link, 'done')
+
+    return get_write_items()
+
+
+def run_items(conn, worker_id, items,
+              lease_seconds=work_queue.LEASE_SECONDS):
+    '''
+    Do the work of a batch of claimed show and episode items. Each show, and
+    each group of episodes of the same network and window, is completed (or
+    given back if it failed) on its own, and then the leases of the rest of
+    the batch are renewed. A Fox show also renews them after each page.
+    '''
+    def renew():
+        work_queue.heartbeat(conn, worker_id, lease_seconds)
+
+    groups = []
+    episode_groups = {}
+    for item_id, kind, payload in items:
+        if kind == 'show':
+            groups.append(('show', [item_id], payload))
+        else:
+            group_key = (payload['network'], payload['start'],
+                         payload['end'])
+            if group_key not in episode_groups:
+                episode_groups[group_key] = ('episode', [], [])
+                groups.append(episode_groups[group_key])
+            episode_groups[group_key][1].append(item_id)
+            episode_groups[group_key][2].append(payload)
+
+    for kind, item_ids, payload in groups:
+        try:
+            if kind == 'show':
+                new_items = list_show(payload, renew)
+            else:
+                new_items = crawl_episodes(payload)
+        except Exception as error:
+            print("FAILED", kind, "ITEMS", item_ids, repr(error))
+            crawler_util.take_captured_writes()
+            for item_id in item_ids:
+                work_queue.fail_item(conn, worker_id, item_id, repr(error))
+            continue
+
+        if not work_queue.complete_items(conn, worker_id, item_ids,
+                                         new_items):
+            print("LOST THE LEASE OF", kind, "ITEMS", item_ids)
+        renew()
+
+
+def work(queue_name=work_queue.QUEUE_FILENAME, batch=WORK_BATCH,
+         lease_seconds=work_queue.LEASE_SECONDS,
+         parse_workers=crawler_util.PARSE_WORKERS, report=None,
+         max_lease_seconds=work_queue.MAX_LEASE_SECONDS):
+    '''
+    Claim and crawl show and episode items until none are left queued or
+    leased to other workers.
+
+    Inputs:
+        queue_name: (str) queue database file
+        batch: (int) items to claim at a time
+        lease_seconds: (float) length of the leases, renewed after each
+            group of episodes and each page of a show's listing, so at
+            least as long as the longest of them takes
+        parse_workers: (int) number of parse processes (0 parses in this
+            process)
+        report: (str) JSON file to write this worker's run report to, or
+            None
+        max_lease_seconds: (float) how long an item can be held, however
+            often its lease is renewed
+
+    Outputs: (int) number of items claimed
+    '''
+    worker_id = work_queue.get_worker_id()
+    conn = work_queue.connect_queue(queue_name)
+    crawler_util.reset_metrics()
+    crawler_util.capture_writes()
+    crawler_util.close_parse_pool()
+    crawler_util.PARSE_WORKERS = parse_workers
+
+    claimed = 0
+    try:
+        while True:
+            items = work_queue.claim_items(conn, worker_id,
+                                           ['show', 'episode'], batch,
+                                           lease_seconds, max_lease_seconds)
+            if not items:
+                if not work_queue.count_pending(conn, ['show', 'episode']):
+                    break
+                time.sleep(POLL_SECONDS)
+                continue
+
+            claimed += len(items)
+            run_items(conn, worker_id, items, lease_seconds)
+    finally:
+        work_queue.release_items(conn, worker_id)
+        conn.close()
+        crawler_util.close_parse_pool()
+        crawler_fox.close_browsers()
+        if report is not None:
+            crawler_util.write_run_report(report)
+
+    print(worker_id, "crawled", claimed, "items")
+
+    return claimed
+
+
+def write(queue_name=work_queue.QUEUE_FILENAME,
+          db_name=run_crawlers.DATABASE_FILENAME, synchronous='FULL',
+          batch=WRITE_BATCH, lease_seconds=work_queue.LEASE_SECONDS,
+          max_lease_seconds=work_queue.MAX_LEASE_SECONDS):
+    '''
+    Load write items into the database until no work is left queued or
+    leased. Only one writer runs at a time: it holds the queue's writer
+    item, and returns straight away if another process holds it.
+
+    The writer item is held for as long as the writer keeps renewing it;
+    write items are held for at most max_lease_seconds.
+
+    Items are completed after the transaction that loads them commits. If
+    the writer dies in between, the items are written again by the next
+    writer, which leaves out the episodes that are already loaded (by URL,
+    and by text; see crawler_util.add_episode_rows).
+
+    Outputs: (int) number of write items loaded
+    '''
+    worker_id = work_queue.get_worker_id()
+    conn = work_queue.connect_queue(queue_name)
+    if not work_queue.claim_items(conn, worker_id, ['writer'], 1,
+                                  lease_seconds, None):
+        conn.close()
+        print("ANOTHER WRITER IS RUNNING (OR THE QUEUE WAS NOT SEEDED)")
+        return 0
+
+    written = 0
+    db_connection = sqlite3.connect(db_name)
+    try:
+        db_connection.execute('PRAGMA synchronous = {}'.format(synchronous))
+        db_cursor = db_connection.cursor()
+        crawler_util.create_crawl_tables(db_cursor)
+        crawler_util.set_next_ids(*crawler_util.get_checkpoint_ids(db_cursor))
+        crawler_util.load_crawl_marks(db_cursor)
+        crawler_util.load_frontier(db_cursor)
+        db_connection.commit()
+        speakers, content_hashes = crawler_util.load_writer_state(\
+            db_connection)
+
+        while True:
+            # Renews the writer item too, for as long as the writer loops
+            work_queue.heartbeat(conn, worker_id, lease_seconds)
+            items = work_queue.claim_items(conn, worker_id, ['write'], batch,
+                                           lease_seconds, max_lease_seconds)
+            if not items:
+                if not work_queue.count_pending(conn,
+                        ['show', 'episode', 'write']):
+                    break
+                time.sleep(POLL_SECONDS)
+                continue
+
+            write_batch = crawler_util.new_write_batch()
+            for _, _, item in items:
+                # Loaded before a writer died without completing the item
+                if item[0] == 'episode' and \
+                        crawler_util.is_url_done(item[1][4]):
+                    continue
+                crawler_util.add_write_rows(write_batch, speakers,
+                                            content_hashes, item)
+            crawler_util.flush_write_batch(db_connection, write_batch)
+            work_queue.complete_items(conn, worker_id,
+                                      [item_id for item_id, _, _ in items])
+            written += len(items)
+    finally:
+        db_connection.close()
+        work_queue.release_items(conn, worker_id)
+        conn.close()
+
+    print(written, "write items loaded into", db_name)
+
+    return written
+
+
+def seed(queue_name=work_queue.QUEUE_FILENAME,
+         db_name=run_crawlers.DATABASE_FILENAME, incremental=False,
+         start=None, end=None, starting_urls=None, networks=None, shows=None,
+         refresh_shows=False):
+    '''
+    Queue a show item for every show of the networks, and the writer item.
+    Shows already in the queue are listed again; episodes already in the
+    queue, or done in the database's crawl frontier, are not queued again,
+    so seeding again picks up the transcripts added since.
+
+    Inputs:
+        queue_name: (str) queue database file, created if needed
+        db_name: (str) database the writer fills, created with the news.sql
+            schema if it does not exist
+        incremental, start, end, starting_urls, networks, shows,
+            refresh_shows: as for run_crawlers.go
+
+    Shows are taken from the show catalog of db_name while it has not
+    expired; shows found on the indexes instead are written to it by the
+    writer.
+
+    Outputs: (int) number of show items queued
+    '''
+    if starting_urls is None:
+        starting_urls = {}
+    if networks is None:
+        networks = [name for name, _ in run_crawlers.CRAWLERS]
+    crawler_util.configure_shows(shows)
+    crawler_util.configure_catalog(refresh=refresh_shows)
+
+    if not os.path.exists(db_name):
+        crawler_util.create_database(db_name)
+    db_connection = sqlite3.connect(db_name)
+    db_cursor = db_connection.cursor()
+    crawler_util.create_crawl_tables(db_cursor)
+    crawler_util.load_crawl_marks(db_cursor)
+    crawler_util.load_catalog(db_cursor)
+    done_urls = [url for url, in db_cursor.execute(\
+        "SELECT url FROM crawl_frontier WHERE state = 'done'").fetchall()]
+    db_connection.commit()
+    db_connection.close()
+
+    crawler_util.capture_writes()
+    show_items = []
+    for name, crawler in run_crawlers.CRAWLERS:
+        if name not in networks:
+            continue
+        network_name = NETWORK_NAMES[name]
+        starting_url = starting_urls.get(name, crawler.STARTING_URL)
+        crawler_util.set_crawl_context(network_name)
+        window = crawler_util.get_date_window(start, end, crawler.LIMIT_YEAR)
+        # The high-water marks of the network's shows (CNN listings can name
+        # a show differently from the index)
+        marks = {}
+        if incremental:
+            marks = crawler_util.get_crawl_marks(network_name)
+        for title, listing in crawler_util.get_catalog_shows(network_name,
+                starting_url, crawler.get_shows):
+            if not crawler_util.is_show_selected(title):
+                continue
+            show = {'network': network_name, 'show': title,
+                    'listing': listing, 'starting_url': starting_url,
+                    'start': window[0], 'end': window[1],
+                    'incremental': incremental, 'marks': marks}
+            show_items.append(('show', 'show ' + listing, show))
+
+    conn = work_queue.connect_queue(queue_name)
+    try:
+        conn.execute('BEGIN IMMEDIATE')
+        db_cursor = conn.cursor()
+        work_queue.put_items(db_cursor, [('episode', 'episode ' + url, None)
+                                         for url in done_urls], 'done')
+        queued = work_queue.put_items(db_cursor, show_items, requeue=True)
+        work_queue.put_items(db_cursor, get_write_items())
+        work_queue.put_items(db_cursor, [('writer', 'writer', None)])
+        conn.execute('COMMIT')
+    finally:
+        conn.close()
+
+    print(queued, "show items queued in", queue_name)
+
+    return queued
+
+
+def print_status(queue_name=work_queue.QUEUE_FILENAME):
+    '''
+    Print how many items of each kind are in each state, and the items that
+    failed.
+    '''
+    conn = work_queue.connect_queue(queue_name)
+    try:
+        summary = work_queue.get_queue_summary(conn)
+        failed_items = work_queue.get_failed_items(conn)
+    finally:
+        conn.close()
+
+    print("{:10}".format("") + "".join("{:>10}".format(state)
+                                       for state in work_queue.ITEM_STATES))
+    for kind in sorted(summary, key=work_queue.WORK_PRIORITIES.get):
+        print("{:10}".format(kind) + "".join("{:>10}".format(\
+            summary[kind][state]) for state in work_queue.ITEM_STATES))
+    for kind, key, error in failed_items:
+        print("FAILED", kind, key, error)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(\
+        description="Crawl with worker processes sharing a work queue")
+    parser.add_argument("--queue", default=work_queue.QUEUE_FILENAME,
+                        help="queue database file")
+    parser.add_argument("--lease", type=float,
+                        default=work_queue.LEASE_SECONDS,
+                        help="seconds a claimed item is leased for")
+    parser.add_argument("--max-lease", type=float,
+                        default=work_queue.MAX_LEASE_SECONDS,
+                        help="seconds a claimed item can be held for, "
+                             "however often its lease is renewed")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    seed_parser = commands.add_parser("seed", help="queue the shows")
+    seed_parser.add_argument("--db", default=run_crawlers.DATABASE_FILENAME,
+                             help="database file to fill")
+    seed_parser.add_argument("--incremental", action="store_true",
+                             help="only add episodes newer than the last "
+                                  "crawl")
+    seed_parser.add_argument("--start", type=datetime.date.fromisoformat,
+                             help="first air date to crawl (YYYY-MM-DD)")
+    seed_parser.add_argument("--end", type=datetime.date.fromisoformat,
+                             help="last air date to crawl (YYYY-MM-DD)")
+    seed_parser.add_argument("--network", action="append",
+                             choices=[name for name, _ in
+                                      run_crawlers.CRAWLERS],
+                             help="only crawl this network (can be repeated)")
+    seed_parser.add_argument("--show", action="append",
+                             help="only crawl this show (can be repeated)")
+    seed_parser.add_argument("--refresh-shows", action="store_true",
+                             help="read the show indexes again instead of "
+                                  "using the show catalog")
+    for name, crawler in run_crawlers.CRAWLERS:
+        seed_parser.add_argument("--{}-url".format(name),
+                                 default=crawler.STARTING_URL,
+                                 help="page the {} crawler starts "
+                                      "from".format(name))
+
+    work_parser = commands.add_parser("work",
+                                      help="crawl show and episode items")
+    work_parser.add_argument("--batch", type=int, default=WORK_BATCH,
+                             help="items to claim at a time")
+    work_parser.add_argument("--workers", type=int,
+                             default=crawler_util.PARSE_WORKERS,
+                             help="number of parse processes")
+    work_parser.add_argument("--report",
+                             help="JSON file to write the run report to")
+
+    write_parser = commands.add_parser("write",
+                                       help="load write items into the "
+                                            "database")
+    write_parser.add_argument("--db", default=run_crawlers.DATABASE_FILENAME,
+                              help="database file to fill")
+    write_parser.add_argument("--synchronous", default='FULL',
+                              choices=crawler_util.SYNCHRONOUS_MODES,
+                              help="SQLite synchronous mode")
+
+    commands.add_parser("status", help="count the items in each state")
+    args = parser.parse_args()
+
+    if args.command == "seed":
+        seed(args.queue, args.db, args.incremental, args.start, args.end,
+             {'cnn': args.cnn_url, 'msnbc': args.msnbc_url,
+              'fox': args.fox_url}, args.network, args.show,
+             args.refresh_shows)
+    elif args.command == "work":
+        work(args.queue, args.batch, args.lease, args.workers, args.report,
+             args.max_lease)
+    elif args.command == "write":
+        write(args.queue, args.db, args.synchronous, lease_seconds=args.lease,
+              max_lease_seconds=args.max_lease)
+    else:
+        print_status(args.queue)
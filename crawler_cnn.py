@@ -9,10 +9,23 @@ import bs4
 import crawler_util
 import re
 import calendar
+import datetime
+import html.parser
 
 LIMIT_YEAR = 2020
+STARTING_URL = "http://transcripts.cnn.com/TRANSCRIPTS/"
 MONTH_DICT = dict((v,k) for k,v in enumerate(calendar.month_name))
 
+# Transcript links carry their air date (/TRANSCRIPTS/YYMM/DD/...), so
+# listings can be matched against a date window without fetching transcripts
+LINK_DATE = re.compile('/TRANSCRIPTS/([0-9]{2})([0-9]{2})/([0-9]{2})/')
+
+# Parts of a transcript page read by parse_cnn_transcript
+STRAINERS = [bs4.SoupStrainer('p',
+    class_=re.compile(r'\b(cnnBodyText|cnnTransSubHead)\b'))]
+BEGIN_FLAG = '(\n[A-Z][^a-z^\n]+?:|\(BEGIN .*?\)).*'
+END_FLAG = ""
+
 def get_cnn_transcript_date(article_soup):
     '''
     Given the soup from a transcript, return the date.
@@ -38,129 +51,415 @@ def get_cnn_transcript_date(article_soup):
     return int(year), airtime
 
 
-def crawl_transcript(link, db_cursor, db_connection, title, headline,
-                episode_id_start, speaker_id_start, phrase_id_start):
+def get_link_date(link):
+    '''
+    Return the air date in a transcript link, or None if it has none.
+    '''
+    date_obj = LINK_DATE.search(link)
+    if not date_obj:
+        return None
+
+    year, month, day = [int(group) for group in date_obj.groups()]
+    try:
+        return datetime.date(2000 + year, month, day)
+    except ValueError:
+        return None
+
+
+class ListingParser(html.parser.HTMLParser):
+    '''
+    Incremental parser for a show listing. Fed the page a chunk at a time as
+    it downloads, it keeps the show title (p.cnnTransHead) and each day
+    block (div.cnnSectBulletItems) once the block has been read in full, as
+    a list of (headline, href) tuples for the links in it.
+    '''
+
+    def __init__(self):
+        super().__init__()
+        self.title = None
+        self.day_blocks = []
+        self._title_text = None
+        self._block = None
+        self._block_depth = 0
+        self._link = None
+
+    def handle_starttag(self, tag, attrs):
+        attrs = dict(attrs)
+        classes = (attrs.get('class') or '').split()
+        if tag == 'p' and 'cnnTransHead' in classes and self.title is None:
+            self._title_text = []
+        elif tag == 'div':
+            self.end_title()
+            if self._block is not None:
+                self._block_depth += 1
+            elif 'cnnSectBulletItems' in classes:
+                self._block = []
+                self._block_depth = 1
+        elif tag == 'a' and self._block is not None and 'href' in attrs:
+            self._link = (attrs['href'] or '', [])
+
+    def handle_endtag(self, tag):
+        if tag == 'p':
+            self.end_title()
+        elif tag == 'a' and self._link is not None:
+            href, text = self._link
+            self._block.append((''.join(text), href))
+            self._link = None
+        elif tag == 'div' and self._block is not None:
+            self._block_depth -= 1
+            if self._block_depth == 0:
+                self.day_blocks.append(self._block)
+                self._block = None
+
+    def handle_data(self, data):
+        if self._title_text is not None:
+            self._title_text.append(data)
+        if self._link is not None:
+            self._link[1].append(data)
+
+    def end_title(self):
+        '''
+        Keep the show title once its paragraph has ended.
+        '''
+        if self._title_text is not None:
+            self.title = ''.join(self._title_text)
+            self._title_text = None
+
+    def read_blocks(self, chunks):
+        '''
+        Feed the listing to the parser and yield each day block as soon as
+        it has been read. The title is known by the first block.
+
+        Inputs:
+            chunks: generator of page text from crawler_util.iter_page_text.
+                It is closed (and with it the connection) when this
+                generator is.
+
+        Outputs: generator of lists of (headline, href) tuples
+        '''
+        try:
+            for chunk in chunks:
+                self.feed(chunk)
+                while self.day_blocks:
+                    yield self.day_blocks.pop(0)
+            self.close()
+            self.end_title()
+            while self.day_blocks:
+                yield self.day_blocks.pop(0)
+        finally:
+            chunks.close()
+
+
+def get_cnn_transcript_text(article_soup):
+    '''
+    Given the soup from a transcript, return the raw transcript text.
+    '''
+    for br in article_soup.find_all("br"):
+        br.replace_with("\n")
+
+    return article_soup.find_all('p','cnnBodyText')[2].getText()
+
+
+def parse_cnn_transcript(transcript_text, start=None, end=None):
+    '''
+    Parse a CNN transcript page into plain data. Runs in the parse pool.
+
+    Inputs:
+        transcript_text: (str) HTML of the transcript page
+        start, end: (datetime.dates) only split transcripts that aired in
+            this window (default: LIMIT_YEAR)
+
+    Outputs: dictionary with the year and airtime of the transcript, whether
+        it did not air, and the speakers and turns from
+        crawler_util.split_transcript (empty if it was not split)
+    '''
+    start, end = crawler_util.get_date_window(start, end, LIMIT_YEAR)
+    article_soup = crawler_util.make_soup(transcript_text, STRAINERS)
+    subheading = article_soup.find('p', class_="cnnTransSubHead")
+    year, airtime = get_cnn_transcript_date(article_soup)
+
+    parsed_transcript = {'year': year,
+                         'airtime': airtime,
+                         'did_not_air': "Did Not Air" in subheading.get_text(),
+                         'all_speakers': [],
+                         'turns': []}
+    if (not crawler_util.in_date_window(airtime, start, end) or
+            parsed_transcript['did_not_air']):
+        return parsed_transcript
+
+    transcript_text = get_cnn_transcript_text(article_soup)
+    parsed_transcript.update(crawler_util.split_transcript(transcript_text,
+        BEGIN_FLAG, END_FLAG))
+
+    return parsed_transcript
+
+
+def crawl_transcript(link, title, headline, parsed_transcript=None,
+                     start=None, end=None):
     '''
     Crawl CNN transcript.
 
     Inputs:
         link: URL to transcript page
-        db_cursor: DB cursor to perform SQL operations
-        db_connection: connection to database
         title: title of show
         headline: name of article
-        episode_id_start: (int) current episode ID
-        speaker_id_start: (int) current speaker ID
-        phrase_id_start: (int) current text clip ID
+        parsed_transcript: result of parse_cnn_transcript for link, if the
+            page has already been fetched and parsed
+        start, end: (datetime.dates) first and last air date to load
+            (default: LIMIT_YEAR)
+
+    Outputs: (bool) True if the episode was queued for the database
     '''
+    start, end = crawler_util.get_date_window(start, end, LIMIT_YEAR)
+
+    if parsed_transcript is None:
+        transcript_request = crawler_util.get_request(link)
+        if transcript_request is None:
+            crawler_util.mark_url(link, 'failed', "page could not be fetched")
+            return False
+        parsed_transcript = parse_cnn_transcript(transcript_request.text,
+                                                 start, end)
 
-    transcript_request = crawler_util.get_request(link)
-    transcript_text = transcript_request.text
-    article_soup = bs4.BeautifulSoup(transcript_text, "html5lib")
-    subheading = article_soup.find('p', class_="cnnTransSubHead")
-    
     print("show is", title)
     print("headline is", headline)
-    year, airtime = get_cnn_transcript_date(article_soup)
+    airtime = parsed_transcript['airtime']
 
     if (headline == "White House Coronavirus Update; Federal Reserve Cuts Rate To Zero; Coronavirus Testing Available To All 50 States. Aired 5-6p ET" and
         airtime == "2020-03-15 17:00"):
-        return year, episode_id_start, speaker_id_start, phrase_id_start
+        return False
 
-    if year != LIMIT_YEAR or "Did Not Air" in subheading.get_text():
-        return year, episode_id_start, speaker_id_start, phrase_id_start
+    if (not crawler_util.in_date_window(airtime, start, end) or
+            parsed_transcript['did_not_air']):
+        return False
 
-    for br in article_soup.find_all("br"):
-        br.replace_with("\n")
-    transcript_text = article_soup.find_all('p','cnnBodyText')[2].getText()
-
-    begin_flag = '(\n[A-Z][^a-z^\n]+?:|\(BEGIN .*?\)).*'
-    end_flag = ""
-
-    phrase_id_init = phrase_id_start
-    speaker_id_start, phrase_id_start = crawler_util.\
-        crawl_transcript(transcript_text, begin_flag, end_flag,
-            episode_id_start, speaker_id_start, phrase_id_start, db_cursor)
-
-    if phrase_id_init != phrase_id_start:
-        db_cursor.execute('INSERT INTO episode VALUES(?, ?, ?, ?)',
-            (episode_id_start, headline, airtime, title))
-        episode_id_start += 1
-    else:
+    if not parsed_transcript['turns']:
         print("DIDN'T INCREMENT, THIS TRANSCRIPT WAS EMPTY")
+        return False
 
-    db_connection.commit()
+    crawler_util.store_episode('CNN', title, headline, airtime, link,
+                               parsed_transcript)
 
-    return int(year), episode_id_start, speaker_id_start, phrase_id_start
+    return True
 
 
-def crawl_show(starting_url, transcript_link, db_cursor,
-                           db_connection, title, episode_id_start,
-                           speaker_id_start, phrase_id_start):
+def read_listing(starting_url, transcripts_request, start, end,
+                 incremental=False, marks=None):
     '''
-    Crawl all transcripts for a given show, for the requested time frame.
+    Read the day blocks of a show listing that fall in the requested time
+    frame. The listing runs from newest to oldest, so it is parsed as it
+    downloads and the connection is closed at the first block from before
+    start (or holding the show's high-water mark): the years of older
+    blocks are never read.
 
     Inputs:
         starting_url: (str) link to show page (to help give complete url for a
             transcript)
-        transcript_link: (str) link to transcript page
-        db_cursor, db_connection: database cursor and connection
-        title: (str) name of show)
-        episode_id_start, speaker_id_start, phrase_id_start: (ints) numbers at
-            which to start speakers, episodes, and phrases
+        transcripts_request: request object for the listing, streamed or not
+        start, end: (datetime.dates) first and last air date to crawl
+        incremental: (bool) stop at the show's high-water mark
+        marks: dictionary of high-water marks to read it from (see
+            crawler_util.get_crawl_marks), by default the current ones
 
     Outputs:
-        episode_id_start, speaker_id_start, phrase_id_start: (ints) updated
-            starting points for the next transcript to be crawled
-    '''
-    episode_id_init = episode_id_start
-    
-    # Create soup object from starting page
-    transcripts_request = crawler_util.get_request(transcript_link)
-    transcripts_text = transcripts_request.text
-    articles_soup = bs4.BeautifulSoup(transcripts_text, "html5lib")
-    transcripts_by_day = articles_soup.find('div', class_='cnnSectBulletItems')
-    transcripts_raw_links = transcripts_by_day.find_all('a', href=True)
-
-    title = articles_soup.find('p', class_='cnnTransHead').get_text()
-
-    most_recent_year = LIMIT_YEAR
-    while most_recent_year >= LIMIT_YEAR:
-        for article in transcripts_raw_links:
-            headline = article.get_text()
-            if "Did Not Air" in headline:
-                continue
-            link = crawler_util.convert_if_relative_url(starting_url,
-                article.get('href'))
-            link = re.sub("\n", "", link)
-            transcript_request = crawler_util.get_request(link)
-            if transcript_request is None:
-                continue
-            most_recent_year, episode_id_start, speaker_id_start, phrase_id_start = crawl_transcript(link, db_cursor, db_connection, title, headline,
-                episode_id_start, speaker_id_start, phrase_id_start)
+        title: (str) name of show, from the listing
+        day_blocks: list of (headlines, links) tuples of lists, newest
+            first, without transcripts that are already done
+    '''
+    listing = ListingParser()
+    blocks = listing.read_blocks(crawler_util.iter_page_text(\
+        transcripts_request))
+    day_blocks = []
+    try:
+        block = next(blocks, None)
+        if listing.title is None:
+            raise ValueError("listing has no show title")
+        title = listing.title
+
+        mark_url = None
+        if incremental:
+            _, mark_url = crawler_util.get_crawl_mark(title, marks)
+        reached_end = False
+
+        while block is not None and not reached_end:
+            headlines = []
+            links = []
+            block_date = None
+            for headline, href in block:
+                if "Did Not Air" in headline:
+                    continue
+                link = crawler_util.convert_if_relative_url(\
+                    starting_url, href)
+                link = re.sub("\n", "", link)
+                if link == mark_url:
+                    reached_end = True
+                    break
+                block_date = block_date or get_link_date(link)
+                if crawler_util.is_url_done(link):
+                    continue
+                headlines.append(headline)
+                links.append(link)
+
+            if block_date is not None and block_date < start:
+                break
+            if block_date is None or block_date <= end:
+                day_blocks.append((headlines, links))
+            if not reached_end:
+                block = next(blocks, None)
+    finally:
+        blocks.close()
+
+    return title, day_blocks
+
+
+def get_block_date(links):
+    '''
+    Return the air date of a day block of a listing, from its first dated
+    link, or None if none of its links is dated.
+    '''
+    for link in links:
+        link_date = get_link_date(link)
+        if link_date is not None:
+            return link_date
 
-        transcripts_by_day = transcripts_by_day.find_next_sibling('div', class_='cnnSectBulletItems')
-        transcripts_raw_links = transcripts_by_day.find_all('a', href=True)
+    return None
 
-    if episode_id_start > episode_id_init:
-        db_cursor.execute('INSERT INTO show VALUES(?, ?)',
-            (title, 'CNN')).fetchall()
 
-    return episode_id_start, speaker_id_start, phrase_id_start
+def list_show(starting_url, transcript_link, title, incremental=False,
+              start=None, end=None, marks=None):
+    '''
+    Read a show's listing for the requested time frame, as it downloads
+    (see read_listing). A partitioned crawl reads each listing once with
+    this, for the whole window, and hands it to the crawl_show of each
+    partition (see crawler_util.crawl_shows).
 
+    Inputs:
+        as for crawl_show (title is taken from the listing instead)
 
-def go(db_cursor, db_connection, speaker_id_start=0, episode_id_start=0,
-       phrase_id_start=0):
+    Outputs: the request object the listing was read from, the (title,
+        day_blocks) tuple from read_listing and the list of transcript links
+        in the day blocks, or None if the listing has not changed since the
+        last incremental crawl
     '''
-    Crawls transcripts of CNN shows and returns some TBD data structure.
-    start_date: first date of transcripts to include (inclusive)
-    end_date: last date of transcripts to include (inclusive)
+    start, end = crawler_util.get_date_window(start, end, LIMIT_YEAR)
+
+    transcripts_request = crawler_util.get_listing(transcript_link,
+        stream=True, revalidate=incremental)
+    if transcripts_request is None:
+        raise ValueError("listing could not be fetched")
+    if transcripts_request.not_modified:
+        return None
+
+    title, day_blocks = read_listing(starting_url, transcripts_request, start,
+                                     end, incremental, marks)
+
+    return transcripts_request, (title, day_blocks), \
+        [link for _, links in day_blocks for link in links]
+
+
+def crawl_show(starting_url, transcript_link, title, incremental=False,
+               start=None, end=None, marks=None, listing=None):
     '''
+    Crawl all transcripts for a given show, for the requested time frame.
 
-    starting_url = ("http://transcripts.cnn.com/TRANSCRIPTS/")
+    The listing is grouped in day blocks. It is read up to the first block
+    from before start (see list_show), then the transcripts of all the
+    blocks are fetched as one batch and loaded in listing order, stopping
+    at the first transcript from before start. Blocks newer than end are
+    skipped without fetching their transcripts.
 
-    # Create soup object from starting page
-    starting_request = crawler_util.get_request(starting_url)
+    Inputs:
+        starting_url: (str) link to show page (to help give complete url for a
+            transcript)
+        transcript_link: (str) link to transcript page
+        title: (str) name of show)
+        incremental: (bool) only crawl episodes newer than the show's
+            high-water mark
+        start, end: (datetime.dates) first and last air date to crawl
+            (default: LIMIT_YEAR)
+        marks: dictionary of high-water marks to crawl down to (see
+            crawler_util.get_crawl_marks), by default the current ones
+        listing: (title, day_blocks) tuple already read by list_show for a
+            wider window, of which only the day blocks in this window are
+            crawled; the listing's validators are then left to the caller
+
+    Outputs: (int) number of episodes queued for the database
+    '''
+    start, end = crawler_util.get_date_window(start, end, LIMIT_YEAR)
+    episodes_loaded = 0
+
+    transcripts_request = None
+    if listing is None:
+        listed = list_show(starting_url, transcript_link, title,
+                           incremental, start, end, marks)
+        if listed is None:
+            return episodes_loaded
+        transcripts_request, (title, day_blocks), _ = listed
+    else:
+        title, day_blocks = listing
+        day_blocks = [(headlines, links) for headlines, links in day_blocks
+                      if links and (get_block_date(links) is None or
+                          start <= get_block_date(links) <= end)]
+    crawler_util.set_crawl_context('CNN', title)
+
+    mark_airtime = None
+    if incremental:
+        mark_airtime, _ = crawler_util.get_crawl_mark(title, marks)
+
+    # Leave transcripts another show's listing has claimed to that show
+    claimed = [(headline, link) for headlines, links in day_blocks
+               for headline, link in zip(headlines, links)
+               if crawler_util.claim_url(link)]
+    headlines = [headline for headline, _ in claimed]
+    links = [link for _, link in claimed]
+
+    # Fetch and parse the transcripts of every day block concurrently, then
+    # load them in listing order. Only the transcripts in the window (and
+    # those that failed) go in the crawl frontier: the others are left for a
+    # crawl with another window to find.
+    transcript_requests = crawler_util.get_requests(links)
+    parsed_transcripts = crawler_util.parse_responses(parse_cnn_transcript,
+        transcript_requests, start, end)
+    frontier = []
+    for headline, (link, parsed_transcript) in zip(headlines,
+                                                   parsed_transcripts):
+        if parsed_transcript is None:
+            frontier.append((headline, link))
+            continue
+        if (crawler_util.is_before_mark(parsed_transcript['airtime'],
+                                        mark_airtime) or
+                crawler_util.is_before_window(parsed_transcript['airtime'],
+                                              start)):
+            break
+        if not crawler_util.in_date_window(parsed_transcript['airtime'],
+                                           start, end):
+            continue
+        frontier.append((headline, link))
+        loaded = crawl_transcript(link, title, headline, parsed_transcript,
+                                  start, end)
+        episodes_loaded += loaded
+        if not loaded:
+            crawler_util.mark_url(link, 'done')
+    crawler_util.add_to_frontier('CNN', title,
+        [link for _, link in frontier], transcript_link,
+        [headline for headline, _ in frontier])
+
+    if transcripts_request is not None:
+        crawler_util.save_validators(transcript_link, transcripts_request,
+                                     links)
+
+    return episodes_loaded
+
+
+def get_shows(starting_url=STARTING_URL):
+    '''
+    Find the shows on the transcripts index.
+
+    Inputs:
+        starting_url: (str) transcripts index
+
+    Outputs: list of (title, link to the show's transcript listing) tuples
+    '''
+    starting_request = crawler_util.get_listing(starting_url)
     starting_text = starting_request.text
     starting_soup = bs4.BeautifulSoup(starting_text, "html5lib")
     show_subsection = starting_soup.find_all('span',
@@ -177,9 +476,37 @@ def go(db_cursor, db_connection, speaker_id_start=0, episode_id_start=0,
                     starting_url, show.get('href'))
             show_dict[title] = transcript_link
 
-            episode_id_start, speaker_id_start, phrase_id_start = crawl_show(\
-                starting_url, transcript_link, db_cursor, db_connection,
-                title, episode_id_start, speaker_id_start, phrase_id_start)
-    db_connection.commit()
+    return list(show_dict.items())
+
+
+def go(incremental=False, start=None, end=None, starting_url=STARTING_URL):
+    '''
+    Crawls transcripts of CNN shows and returns some TBD data structure.
+    start: first date of transcripts to include (inclusive)
+    end: last date of transcripts to include (inclusive)
+    incremental: only crawl episodes newer than each show's high-water mark
+    starting_url: transcripts index to start from (to crawl a stand-in site,
+        see stand_in_sites.py)
+
+    start and end are datetime.dates and default to the first and last day
+    of LIMIT_YEAR. The window can span any number of years, and be split
+    into years or months crawled in parallel (see
+    crawler_util.configure_partitions).
+
+    Shows are crawled crawler_util.SHOW_WORKERS at a time, and episodes are
+    queued for crawler_util's writer thread (see crawler_util.start_writer),
+    so this can run at the same time as the other networks' crawlers.
+
+    The shows are taken from the show catalog while it has not expired
+    (see crawler_util.get_catalog_shows).
+
+    Outputs: (int) number of episodes queued for the database
+    '''
+
+    crawler_util.set_crawl_context('CNN')
+    start, end = crawler_util.get_date_window(start, end, LIMIT_YEAR)
 
-    return speaker_id_start, episode_id_start, phrase_id_start
+    return crawler_util.crawl_shows('CNN', crawl_show, starting_url,
+        crawler_util.get_catalog_shows('CNN', starting_url, get_shows),
+        incremental, start, end, crawler_util.PARTITION_CONFIG['partition'],
+        list_show)
@@ -6,17 +6,56 @@ Charlie Sheils
 
 import re
 import bs4
-import time
 import json
 import calendar
+import threading
+import concurrent.futures
 from selenium import webdriver
-from selenium.webdriver.common.keys import Keys
+from selenium.webdriver.support.ui import WebDriverWait
+from selenium.common.exceptions import TimeoutException, WebDriverException
 
 import crawler_util
 
 LIMIT_YEAR = 2020
+STARTING_URL = "https://www.foxnews.com/shows"
 MONTH_DICT = dict((v,k) for k,v in enumerate(calendar.month_name))
 
+# Headless Firefox browsers shared by the show listing walkers. Up to
+# BROWSERS shows are paginated at the same time. After a "load more" click we
+# wait up to LOAD_MORE_TIMEOUT seconds for new articles to appear.
+BROWSERS = 3
+LOAD_MORE_TIMEOUT = 30
+SECTION_XPATH = '//*[@id="wrapper"]/div[2]/div[3]/div/main/section/div'
+ARTICLES_XPATH = (SECTION_XPATH + "//article[contains(concat(' ', "
+                  "normalize-space(@class), ' '), ' article ')]")
+LOAD_MORE_XPATH = "//div[@class='button load-more js-load-more']/a"
+
+# Returns the HTML of the listed articles matching the XPath in arguments[0],
+# starting from index arguments[1], so each "load more" only hands back the
+# newly added articles
+NEW_ARTICLES_SCRIPT = '''
+var articles = document.evaluate(arguments[0], document, null,
+    XPathResult.ORDERED_NODE_SNAPSHOT_TYPE, null);
+var html = [];
+for (var i = arguments[1]; i < articles.snapshotLength; i++) {
+    html.push(articles.snapshotItem(i).outerHTML);
+}
+return html;
+'''
+
+# Browsers waiting for a show, and every browser running. Both are only
+# changed with _browsers_lock held, and a show waiting for a browser waits on
+# it, so no more than BROWSERS are ever running.
+_browsers_idle = []
+_browsers_started = []
+_browsers_lock = threading.Condition()
+
+# Parts of a transcript page read by parse_fox_transcript: the speakable and
+# untagged paragraphs and the ld+json metadata
+STRAINERS = [bs4.SoupStrainer(['p', 'script'])]
+BEGIN_FLAG = '(\n[A-Z][^a-z^\n]+?:|\(BEGIN .*?\)).*'
+END_FLAG = "Content and Programming Copyright.*"
+
 
 def get_show_transcripts_page(show, starting_url):
     '''
@@ -33,7 +72,7 @@ def get_show_transcripts_page(show, starting_url):
         show.find('a').get('href'))
 
     # Go to first show link to find transcripts page
-    show_page_request = crawler_util.get_request(first_show_link)
+    show_page_request = crawler_util.get_listing(first_show_link)
     show_page_text = show_page_request.text
     show_page_soup = bs4.BeautifulSoup(show_page_text, "html5lib")
     subnav = show_page_soup.find('nav', class_='show-subnav')
@@ -74,78 +113,319 @@ def get_fox_transcript_date(transcript_page_soup):
     return int(year), airtime
 
 
-def crawl_transcripts(starting_url, all_show_transcripts, db_cursor,
-    db_connection, title, episode_id_start, speaker_id_start, phrase_id_start,
-    index_start):
+def get_fox_transcript_text(transcript_page_soup):
+    '''
+    Given the soup from a transcript, return the raw transcript text.
+    '''
+    # https://stackoverflow.com/questions/54162988/how-to-find-a-tag-
+    # without-specific-attribute-using-beautifulsoup
+    transcript_raw_text = transcript_page_soup.find_all('p',
+        class_='speakable') + transcript_page_soup.find_all('p',
+            class_=None)
+
+    return crawler_util.join_text_chunks(transcript_raw_text)
+
+
+def parse_fox_transcript(transcript_page_text, start=None, end=None):
+    '''
+    Parse a Fox transcript page into plain data. Runs in the parse pool.
+
+    Inputs:
+        transcript_page_text: (str) HTML of the transcript page
+        start, end: (datetime.dates) only split transcripts that aired in
+            this window (default: LIMIT_YEAR)
+
+    Outputs: dictionary with the year, airtime and headline of the
+        transcript and the speakers and turns from
+        crawler_util.split_transcript (empty if it was not split)
+    '''
+    start, end = crawler_util.get_date_window(start, end, LIMIT_YEAR)
+    transcript_page_soup = crawler_util.make_soup(transcript_page_text,
+        STRAINERS)
+
+    year, airtime = get_fox_transcript_date(transcript_page_soup)
+    parsed_transcript = {'year': year,
+                         'airtime': airtime,
+                         'headline': None,
+                         'all_speakers': [],
+                         'turns': []}
+    if not crawler_util.in_date_window(airtime, start, end):
+        return parsed_transcript
+
+    meta_data = transcript_page_soup.find("script",
+        {"type":"application/ld+json"})
+    meta_data_dict = json.loads("".join(meta_data.contents))
+    parsed_transcript['headline'] = meta_data_dict['headline']
+
+    transcript_text = get_fox_transcript_text(transcript_page_soup)
+    parsed_transcript.update(crawler_util.split_transcript(transcript_text,
+        BEGIN_FLAG, END_FLAG))
+
+    return parsed_transcript
+
+
+def start_browser():
+    '''
+    Start a headless browser for the pool. Called with _browsers_lock held.
+    '''
+    options = webdriver.FirefoxOptions()
+    options.add_argument('-headless')
+    driver = webdriver.Firefox(options=options)
+    _browsers_started.append(driver)
+
+    return driver
+
+
+def get_browser():
     '''
-    Crawl all transcripts for a given show.
+    Take a headless browser from the pool, starting a new one if fewer than
+    BROWSERS are running, otherwise waiting for one to be released or
+    discarded.
+    '''
+    with _browsers_lock:
+        while not _browsers_idle and len(_browsers_started) >= BROWSERS:
+            _browsers_lock.wait()
+        if _browsers_idle:
+            return _browsers_idle.pop()
+
+        return start_browser()
+
+
+def release_browser(driver):
+    '''
+    Return a browser to the pool for the next show.
+    '''
+    with _browsers_lock:
+        _browsers_idle.append(driver)
+        _browsers_lock.notify()
+
+
+def discard_browser(driver):
+    '''
+    Quit a browser that failed instead of returning it to the pool, so the
+    next show gets a new one in its place. It stops counting against
+    BROWSERS once it has quit.
+    '''
+    try:
+        driver.quit()
+    except WebDriverException:
+        pass
+    with _browsers_lock:
+        if driver in _browsers_started:
+            _browsers_started.remove(driver)
+        _browsers_lock.notify()
+
+
+def close_browsers():
+    '''
+    Quit every browser started by the pool.
+    '''
+    with _browsers_lock:
+        for driver in _browsers_started:
+            driver.quit()
+        del _browsers_started[:]
+        del _browsers_idle[:]
+
+
+def load_more(driver, article_count):
+    '''
+    Click the "load more" button and wait until more articles have been
+    added to the listing or the button is gone.
+
+    Inputs:
+        driver: browser showing a show's transcript listing
+        article_count: (int) number of articles currently listed
+
+    Outputs: (bool) True if more articles were loaded
+    '''
+    buttons = driver.find_elements_by_xpath(LOAD_MORE_XPATH)
+    if not buttons:
+        return False
+    buttons[0].click()
+
+    try:
+        WebDriverWait(driver, LOAD_MORE_TIMEOUT).until(\
+            lambda d: (len(d.find_elements_by_xpath(ARTICLES_XPATH)) >
+                       article_count or
+                       not d.find_elements_by_xpath(LOAD_MORE_XPATH)))
+    except TimeoutException:
+        return False
+
+    return len(driver.find_elements_by_xpath(ARTICLES_XPATH)) > article_count
+
+
+def get_new_articles(driver, index_start):
+    '''
+    Get the articles added to a show's listing since index_start.
+
+    Inputs:
+        driver: browser showing a show's transcript listing
+        index_start: (int) number of articles already processed
+
+    Outputs: list of article soup objects
+    '''
+    articles_html = driver.execute_script(NEW_ARTICLES_SCRIPT, ARTICLES_XPATH,
+                                          index_start)
+    articles_soup = bs4.BeautifulSoup("".join(articles_html), "html5lib")
+
+    return articles_soup.find_all('article', class_='article')
+
+
+def crawl_transcripts(starting_url, show_transcripts, mark=(None, None),
+                      start=None, end=None):
+    '''
+    Fetch and parse the transcripts in part of a show's listing, stopping at
+    the show's high-water mark or the first transcript from before start.
+    The listing has no dates, so transcripts newer than end are fetched but
+    left out.
 
     Inputs:
         starting_url: URL to network page
-        all_show_transcripts: list of transcripts
-        db_cursor: DB cursor to perform SQL operations
-        db_connection: connection to database
-        title: title of show
-        episode_id_start: (int) current episode ID
-        speaker_id_start: (int) current speaker ID
-        phrase_id_start: (int) current text clip ID
-        index_start: index of transcript in list (to reference
-            after clicking "Show More" button)
+        show_transcripts: list of article soup objects
+        mark: (airtime, url) of the newest episode of the show already in
+            the database, or (None, None)
+        start, end: (datetime.dates) first and last air date to crawl
+            (default: LIMIT_YEAR)
+
+    Outputs:
+        more: (bool) False if the rest of the listing does not need to be
+            walked: the high-water mark or start was reached, or there were
+            no transcripts
+        parsed_transcripts: list of (link, parse_fox_transcript result)
+            tuples, in listing order
     '''
+    start, end = crawler_util.get_date_window(start, end, LIMIT_YEAR)
+    mark_airtime, mark_url = mark
+    reached_end = False
 
-    year = None
-    for transcript in all_show_transcripts[index_start:]:
+    links = []
+    skipped_done = False
+    for transcript in show_transcripts:
         link = crawler_util.convert_if_relative_url(starting_url,
             transcript.find('a').get('href'))
 
         # Skip over non-transcripts:
         if "transcript" not in link:
             continue
+        if link == mark_url:
+            reached_end = True
+            break
+        if not crawler_util.claim_url(link):
+            skipped_done = True
+            continue
+        links.append(link)
+
+    # Fetch and parse transcripts concurrently
+    transcript_page_requests = crawler_util.get_requests(links)
+    parsed_transcripts = []
+    found = skipped_done
+    for link, parsed_transcript in crawler_util.parse_responses(\
+            parse_fox_transcript, transcript_page_requests, start, end):
+        if parsed_transcript is None:
+            continue
+        found = True
+        if (crawler_util.is_before_mark(parsed_transcript['airtime'],
+                                        mark_airtime) or
+                crawler_util.is_before_window(parsed_transcript['airtime'],
+                                              start)):
+            reached_end = True
+            break
+        if crawler_util.in_date_window(parsed_transcript['airtime'], start,
+                                       end):
+            parsed_transcripts.append((link, parsed_transcript))
 
-        transcript_page_request = crawler_util.get_request(\
-            link)
-        transcript_page_text = transcript_page_request.text
-        transcript_page_soup = bs4.BeautifulSoup(\
-            transcript_page_text, "html5lib")
+    return found and not reached_end, parsed_transcripts
 
-        year, airtime = get_fox_transcript_date(transcript_page_soup)
-        if year != LIMIT_YEAR:
-            continue
 
-        meta_data = transcript_page_soup.find("script",
-            {"type":"application/ld+json"})
-        meta_data_dict = json.loads("".join(meta_data.contents))
-        headline = meta_data_dict['headline']
+def paginate_show(starting_url, transcript_link, mark=(None, None),
+                  start=None, end=None, progress=None):
+    '''
+    Walk a show's transcript listing in a pooled browser, clicking "load
+    more" until it reaches transcripts from before start or the show's
+    high-water mark, and fetch and parse every transcript on the way. Does
+    not touch the database, so several shows can be paginated at the same
+    time.
 
-        db_cursor.execute('INSERT INTO episode VALUES(?, ?, ?, ?)',
-            (episode_id_start, headline, airtime, title))
+    Only the articles added by each click are read from the browser and
+    parsed, so walking far back stays linear in time.
 
-        # https://stackoverflow.com/questions/54162988/how-to-find-a-tag-
-        # without-specific-attribute-using-beautifulsoup
-        transcript_raw_text = transcript_page_soup.find_all('p',
-            class_='speakable') + transcript_page_soup.find_all('p',
-                class_=None)
+    Inputs:
+        starting_url: (str) link to show page (to help give complete url for a
+            transcript)
+        transcript_link: (str) link to transcript page
+        mark: (airtime, url) of the newest episode of the show already in
+            the database, or (None, None) to crawl the whole time frame
+        start, end: (datetime.dates) first and last air date to crawl
+            (default: LIMIT_YEAR)
+        progress: function called with no arguments after each page of
+            articles, such as a crawl worker renewing its lease
+
+    Outputs: list of (link, parse_fox_transcript result) tuples for the
+        transcripts between start and end, in listing order
+    '''
+    show_transcripts = []
 
-        transcript_text = crawler_util.join_text_chunks(transcript_raw_text)
+    # https://pythonspot.com/selenium-click-button/
+    driver = get_browser()
+    try:
+        driver.get(transcript_link)
+
+        index_start = 0
+        more = True
+        while more:
+            new_articles = get_new_articles(driver, index_start)
+            index_start += len(new_articles)
+            # For shows that have no actual transcripts in first 10, skip show
+            more, parsed_transcripts = crawl_transcripts(starting_url,
+                new_articles, mark, start, end)
+            show_transcripts.extend(parsed_transcripts)
+            if progress is not None:
+                progress()
+
+            if more and not load_more(driver, index_start):
+                break
+    except WebDriverException:
+        # A browser that crashed or lost its session is not handed to the
+        # next show
+        discard_browser(driver)
+        driver = None
+        raise
+    finally:
+        if driver is not None:
+            release_browser(driver)
+
+    return show_transcripts
+
+
+def load_transcripts(parsed_transcripts, title, transcript_link=None):
+    '''
+    Queue a show's parsed transcripts for the database.
 
-        begin_flag = '(\n[A-Z][^a-z^\n]+?:|\(BEGIN .*?\)).*'
-        end_flag = "Content and Programming Copyright.*"
+    Inputs:
+        parsed_transcripts: list of (link, parse_fox_transcript result)
+            tuples from paginate_show
+        title: title of show
+        transcript_link: link to the show's transcript listing
 
-        speaker_id_start, phrase_id_start = crawler_util.\
-            crawl_transcript(transcript_text, begin_flag, end_flag,
-                episode_id_start, speaker_id_start, phrase_id_start,
-                db_cursor)
+    Outputs: (int) number of episodes queued for the database
+    '''
+    crawler_util.add_to_frontier('Fox', title,
+        [link for link, _ in parsed_transcripts], transcript_link,
+        [parsed_transcript['headline']
+         for _, parsed_transcript in parsed_transcripts])
 
-        db_connection.commit()
-        episode_id_start += 1
+    episodes_loaded = 0
+    for link, parsed_transcript in parsed_transcripts:
+        crawler_util.store_episode('Fox', title,
+            parsed_transcript['headline'], parsed_transcript['airtime'],
+            link, parsed_transcript)
+        episodes_loaded += 1
 
-    return year, len(all_show_transcripts), episode_id_start, \
-        speaker_id_start, phrase_id_start
+    return episodes_loaded
 
 
-def crawl_show(starting_url, transcript_link, db_cursor,
-                           db_connection, title, episode_id_start,
-                           speaker_id_start, phrase_id_start):
+def crawl_show(starting_url, transcript_link, title, parsed_transcripts=None,
+               incremental=False, start=None, end=None, progress=None):
     '''
     Crawl all transcripts for a given show, for the requested time frame.
 
@@ -153,104 +433,125 @@ def crawl_show(starting_url, transcript_link, db_cursor,
         starting_url: (str) link to show page (to help give complete url for a
             transcript)
         transcript_link: (str) link to transcript page
-        db_cursor, db_connection: database cursor and connection
         title: (str) name of show)
-        episode_id_start, speaker_id_start, phrase_id_start: (ints) numbers at
-            which to start speakers, episodes, and phrases
-
-    Outputs:
-        episode_id_start, speaker_id_start, phrase_id_start: (ints) updated
-            starting points for the next transcript to be crawled
+        parsed_transcripts: result of paginate_show for the show, if it has
+            already been paginated
+        incremental: (bool) only crawl episodes newer than the show's
+            high-water mark
+        start, end: (datetime.dates) first and last air date to crawl
+            (default: LIMIT_YEAR)
+        progress: passed on to paginate_show
+
+    Outputs: (int) number of episodes queued for the database
     '''
 
-    episode_id_init = episode_id_start
-    
-    # https://pythonspot.com/selenium-click-button/
-    driver = webdriver.Firefox()
-    driver.get(transcript_link)
-    xpath_elems = driver.find_element_by_xpath(\
-        '//*[@id="wrapper"]/div[2]/div[3]/div/main/section/div')
-    articles_soup = bs4.BeautifulSoup(xpath_elems.get_attribute('innerHTML'),
-        "html5lib")
-    all_show_transcripts = articles_soup.find_all('article', class_='article')
-
-    # # Close CDC warning if any
-    # elem_popup = driver.find_element_by_xpath(\
-    #     '//*[@id="wrapper"]/div[2]/div[4]/div/div/a')
-    # if elem_popup:
-    #     elem_popup.click()
-    #     time.sleep(1)
-
-    index_start = 0
-    most_recent_year = LIMIT_YEAR
-    while most_recent_year >= LIMIT_YEAR:
-        most_recent_year, index_start, episode_id_start, speaker_id_start, \
-            phrase_id_start = crawl_transcripts(starting_url,
-            all_show_transcripts, db_cursor, db_connection,
-            title, episode_id_start, speaker_id_start, phrase_id_start, index_start)
-
-        # For shows that have no actual transcripts in first 10, skip show
-        if most_recent_year is None:
-            break
-
-        elem = driver.find_element_by_xpath(\
-            "//div[@class='button load-more js-load-more']/a")
-        elem.click()
-        time.sleep(2.5)
-        xpath_elems = driver.find_element_by_xpath(\
-            '//*[@id="wrapper"]/div[2]/div[3]/div/main/section/div')
-        articles_soup = bs4.BeautifulSoup(xpath_elems.get_attribute(\
-            'innerHTML'), "html5lib")
-        all_show_transcripts = articles_soup.find_all('article',
-            class_='article')
-
-    driver.close()
+    if parsed_transcripts is None:
+        mark = (None, None)
+        if incremental:
+            mark = crawler_util.get_crawl_mark(title)
+        parsed_transcripts = paginate_show(starting_url, transcript_link,
+                                           mark, start, end, progress)
 
-    if episode_id_start > episode_id_init:
-        db_cursor.execute('INSERT INTO show VALUES(?, ?)',
-            (title, 'Fox')).fetchall()
+    return load_transcripts(parsed_transcripts, title, transcript_link)
 
-    return episode_id_start, speaker_id_start, phrase_id_start
 
-
-def go(db_cursor, db_connection, speaker_id_start=0, episode_id_start=0,
-       phrase_id_start=0):
+def get_shows(starting_url=STARTING_URL):
     '''
-    Crawls the Fox transcripts site and updates database of transcripts,
-    speakers, titles, shows, and episodes.
-    This function modifies the input database.
+    Find the shows on the shows page that have transcripts. Shows left out
+    by crawler_util.configure_shows are skipped without loading their show
+    page.
 
     Inputs:
-        db_cursor, db_connection: cursor and connection to database
-        speaker_id_start, episode_id_start, phrase_id_start: (ints) numbers at
-            which to start speakers, episodes, and phrases
+        starting_url: (str) shows page
 
-    No outputs
+    Outputs: list of (title, link to the show's transcript listing) tuples
     '''
-
-    starting_url = "https://www.foxnews.com/shows"
-
     # Create soup object from starting page
-    starting_request = crawler_util.get_request(starting_url)
+    starting_request = crawler_util.get_listing(starting_url)
     starting_text = starting_request.text
     starting_soup = bs4.BeautifulSoup(starting_text, "html5lib")
 
     # Get list of shows to loop through
     show_info_list = starting_soup.find_all('li', class_='showpage')
+    show_list = []
     # for show in show_info_list[3:4]:
     for show in show_info_list:
         title = show.find('h2', class_='title').get_text().strip()
+        if not crawler_util.is_show_selected(title):
+            continue
         print(title)
 
         transcript_link = get_show_transcripts_page(show, starting_url)
-            
+
         # If show has transcripts available, scrape episodes
         if transcript_link:
+            show_list.append((title, transcript_link))
+
+    return show_list
+
 
-            episode_id_start, speaker_id_start, phrase_id_start = crawl_show(\
-                starting_url, transcript_link, db_cursor, db_connection,
-                title, episode_id_start, speaker_id_start, phrase_id_start)
-            db_connection.commit()
+def go(incremental=False, start=None, end=None, starting_url=STARTING_URL):
+    '''
+    Crawls the Fox transcripts site and updates database of transcripts,
+    speakers, titles, shows, and episodes.
+    This function modifies the database crawler_util's writer thread writes
+    to.
 
-    return speaker_id_start, episode_id_start, phrase_id_start
+    Shows are paginated BROWSERS at a time in pooled headless browsers and
+    queued for crawler_util's writer thread in the order they are listed, so
+    this can run at the same time as the other networks' crawlers. The
+    shows and their transcript pages are taken from the show catalog while
+    it has not expired (see crawler_util.get_catalog_shows), without
+    loading each show's page.
+
+    Inputs:
+        incremental: (bool) only crawl episodes newer than each show's
+            high-water mark
+        start, end: (datetime.dates) first and last air date to crawl
+            (default: first and last day of LIMIT_YEAR). Fox listings have
+            no dates, so each show is walked from its newest transcript
+            down to start, in one go even when CNN windows are
+            partitioned (see crawler_util.configure_partitions).
+        starting_url: (str) shows page to start from (to crawl a stand-in
+            site, see stand_in_sites.py)
+
+    Outputs: (int) number of episodes queued for the database
+    '''
 
+    crawler_util.set_crawl_context('Fox')
+    show_list = crawler_util.get_catalog_shows('Fox', starting_url,
+                                               get_shows)
+
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=BROWSERS)
+    paginated_shows = []
+    episodes_loaded = 0
+    try:
+        for index, (title, transcript_link) in enumerate(show_list):
+            # Keep up to BROWSERS shows paginating ahead of the one being
+            # loaded
+            while len(paginated_shows) < min(len(show_list), index + BROWSERS):
+                next_title, next_link = show_list[len(paginated_shows)]
+                mark = (None, None)
+                if incremental:
+                    mark = crawler_util.get_crawl_mark(next_title)
+                paginated_shows.append(executor.submit(\
+                    crawler_util.run_in_context, 'Fox', next_title,
+                    paginate_show, starting_url, next_link, mark, start, end))
+
+            # A show that fails is put on the retry list and the crawl goes
+            # on with the next one
+            try:
+                episodes_loaded += crawl_show(starting_url, transcript_link,
+                    title, paginated_shows[index].result())
+            except Exception as error:
+                print("FAILED TO CRAWL", title, repr(error))
+                crawler_util.mark_url(transcript_link, 'failed', repr(error))
+            paginated_shows[index] = None
+    finally:
+        for paginated_show in paginated_shows:
+            if paginated_show is not None:
+                paginated_show.cancel()
+        executor.shutdown()
+        close_browsers()
+
+    return episodes_loaded
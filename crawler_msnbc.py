@@ -8,10 +8,21 @@ import bs4
 import crawler_util
 import re
 import calendar
-import time
+import datetime
 
 LIMIT_YEAR = 2020
+STARTING_URL = "http://www.msnbc.com/transcripts"
 MONTH_DICT = dict((v,k) for k,v in enumerate(calendar.month_name))
+MONTH_ABBR_DICT = dict((v,k) for k,v in enumerate(calendar.month_abbr))
+
+# Each listing item ends with the date the episode aired
+ITEM_DATE = re.compile(r'([A-Z][a-z]+)\.? ([0-9]{1,2}), ([0-9]{4})$')
+
+# Parts of a transcript page read by parse_msnbc_transcript
+STRAINERS = [bs4.SoupStrainer('meta', property=re.compile('^nv:(date|title)$')),
+             bs4.SoupStrainer('div', itemprop="articleBody")]
+BEGIN_FLAG = ".*"
+END_FLAG = "(THIS IS A RUSH TRANSCRIPT|Copyright 2020).*"
 
 
 def get_msnbc_transcript_date(article_soup):
@@ -20,9 +31,6 @@ def get_msnbc_transcript_date(article_soup):
     airtime_obj = re.search('([0-9]{2})/([0-9]{2})/([0-9]{4}) ([0-9]{2}:[0-9]{2}:[0-9]{2})', airtime_raw)
     year = airtime_obj.group(3)
 
-    if int(year) != LIMIT_YEAR:
-        return episode_id_start, speaker_id_start, phrase_id_start
-
     month = airtime_obj.group(1)
     day = airtime_obj.group(2)
     time_of_day = airtime_obj.group(4)
@@ -33,105 +41,219 @@ def get_msnbc_transcript_date(article_soup):
     return int(year), airtime
 
 
-def crawl_msnbc_transcript(link, db_cursor, db_connection, title,
-                episode_id_start, speaker_id_start, phrase_id_start):
+def get_item_date(item_text):
+    '''
+    Return the air date at the end of a listing item's text, or None if it
+    cannot be read.
+    '''
+    date_obj = ITEM_DATE.search(item_text.strip())
+    if not date_obj:
+        return None
+
+    month = MONTH_DICT.get(date_obj.group(1),
+                           MONTH_ABBR_DICT.get(date_obj.group(1)))
+    if not month:
+        return None
+    try:
+        return datetime.date(int(date_obj.group(3)), month,
+                             int(date_obj.group(2)))
+    except ValueError:
+        return None
+
+
+def get_msnbc_transcript_text(article_soup):
+    '''
+    Given the soup from a transcript, return the raw transcript text.
+    '''
+    transcript_raw_text = article_soup.find('div', itemprop="articleBody").find_all('p')
+
+    return crawler_util.join_text_chunks(transcript_raw_text)
+
+
+def parse_msnbc_transcript(transcript_text, start=None, end=None):
     '''
-    Crawl MSNBC transcript.
+    Parse an MSNBC transcript page into plain data. Runs in the parse pool.
+
+    Inputs:
+        transcript_text: (str) HTML of the transcript page
+        start, end: (datetime.dates) only split transcripts that aired in
+            this window (default: LIMIT_YEAR)
+
+    Outputs: dictionary with the year, airtime and headline of the
+        transcript and the speakers and turns from
+        crawler_util.split_transcript (empty if it was not split)
     '''
+    start, end = crawler_util.get_date_window(start, end, LIMIT_YEAR)
+    article_soup = crawler_util.make_soup(transcript_text, STRAINERS)
 
-    transcript_request = crawler_util.get_request(link)
-    transcript_text = transcript_request.text
-    article_soup = bs4.BeautifulSoup(transcript_text, "html5lib")
-    
     year, airtime = get_msnbc_transcript_date(article_soup)
-    if year != LIMIT_YEAR:
-        return episode_id_start, speaker_id_start, phrase_id_start
+    parsed_transcript = {'year': year,
+                         'airtime': airtime,
+                         'headline': None,
+                         'all_speakers': [],
+                         'turns': []}
+    if not crawler_util.in_date_window(airtime, start, end):
+        return parsed_transcript
 
     headline_raw = article_soup.find('meta', property="nv:title").get('content')
-    headline = re.search("(.*?) TRANSCRIPT", headline_raw).group(1)
-    db_cursor.execute('INSERT INTO episode VALUES(?, ?, ?, ?)',
-        (episode_id_start, headline, airtime, title))
+    parsed_transcript['headline'] = re.search("(.*?) TRANSCRIPT",
+        headline_raw).group(1)
 
-    transcript_raw_text = article_soup.find('div', itemprop="articleBody").find_all('p')
-    transcript_text = crawler_util.join_text_chunks(transcript_raw_text)
+    transcript_text = get_msnbc_transcript_text(article_soup)
+    parsed_transcript.update(crawler_util.split_transcript(transcript_text,
+        BEGIN_FLAG, END_FLAG))
 
-    begin_flag = ".*"
-    end_flag = "(THIS IS A RUSH TRANSCRIPT|Copyright 2020).*"
-    speaker_id_start, phrase_id_start = crawler_util.\
-        crawl_transcript(transcript_text, begin_flag, end_flag,
-            episode_id_start, speaker_id_start, phrase_id_start, db_cursor)
+    return parsed_transcript
 
-    db_connection.commit()
-    episode_id_start += 1
 
-    return episode_id_start, speaker_id_start, phrase_id_start
+def crawl_msnbc_transcript(link, title, parsed_transcript=None, start=None,
+                           end=None):
+    '''
+    Crawl MSNBC transcript. parsed_transcript is the result of
+    parse_msnbc_transcript for link if the page has already been fetched and
+    parsed. Only transcripts that aired between start and end (default:
+    LIMIT_YEAR) are loaded. Returns True if the episode was queued for the
+    database.
+    '''
+    start, end = crawler_util.get_date_window(start, end, LIMIT_YEAR)
+
+    if parsed_transcript is None:
+        transcript_request = crawler_util.get_request(link)
+        parsed_transcript = parse_msnbc_transcript(transcript_request.text,
+                                                   start, end)
+
+    if not crawler_util.in_date_window(parsed_transcript['airtime'], start,
+                                       end):
+        return False
+
+    crawler_util.store_episode('MSNBC', title,
+        parsed_transcript['headline'], parsed_transcript['airtime'], link,
+        parsed_transcript)
 
+    return True
 
-def crawl_show(starting_url, transcripts_link, db_cursor,
-                           db_connection, title, episode_id_start,
-                           speaker_id_start, phrase_id_start):
+
+def read_listing(starting_url, transcripts_text, start, end, mark_url=None):
     '''
-    Crawl all transcripts for a given show, for the requested time frame.
+    Collect links to every transcript of a show listing in the time frame,
+    stopping at the newest one already in the database.
 
     Inputs:
         starting_url: (str) link to show page (to help give complete url for a
             transcript)
-        transcript_link: (str) link to transcript page
-        db_cursor, db_connection: database cursor and connection
-        title: (str) name of show)
-        episode_id_start, speaker_id_start, phrase_id_start: (ints) numbers at
-            which to start speakers, episodes, and phrases
+        transcripts_text: (str) HTML of the show listing
+        start, end: (datetime.dates) first and last air date to crawl
+        mark_url: (str) URL of the show's high-water mark, or None
 
-    Outputs:
-        episode_id_start, speaker_id_start, phrase_id_start: (ints) updated
-            starting points for the next transcript to be crawled
+    Outputs: list of transcript URLs, newest first
     '''
-
-    episode_id_init = episode_id_start
-
-    # Create soup object from starting page
-    transcripts_request = crawler_util.get_request(transcripts_link)
-    transcripts_text = transcripts_request.text
     articles_soup = bs4.BeautifulSoup(transcripts_text, "html5lib")
     show_day = articles_soup.find('div', class_='transcript-item')
 
-    year = int(show_day.find('a').get_text()[-4:])
-    while year >= LIMIT_YEAR:
-        # Crawl transcript
+    links = []
+    while show_day is not None:
+        item_text = show_day.find('a').get_text().strip()
+        item_date = get_item_date(item_text)
+        year = int(item_text[-4:])
+        if year < start.year or (item_date is not None and item_date < start):
+            break
+
         link = crawler_util.convert_if_relative_url(\
                 starting_url, show_day.find('a').get('href'))
-        episode_id_start, speaker_id_start, phrase_id_start = crawl_msnbc_transcript(\
-            link, db_cursor, db_connection, title, episode_id_start,
-            speaker_id_start, phrase_id_start)
+        if link == mark_url:
+            break
+        if year <= end.year and (item_date is None or item_date <= end):
+            links.append(link)
 
         show_day = show_day.find_next('div', class_='transcript-item')
-        if show_day is None:
-            break
-        year = int(show_day.find('a').get_text()[-4:])
 
-    if episode_id_start > episode_id_init:
-        db_cursor.execute('INSERT INTO show VALUES(?, ?)',
-            (title, 'MSNBC')).fetchall()
+    return links
 
-    return episode_id_start, speaker_id_start, phrase_id_start
 
+def crawl_show(starting_url, transcripts_link, title, incremental=False,
+               start=None, end=None, marks=None):
+    '''
+    Crawl all transcripts for a given show, for the requested time frame.
 
-def go(db_cursor, db_connection, speaker_id_start=0, episode_id_start=0,
-       phrase_id_start=0):
+    Listing items newer than end are skipped without fetching their
+    transcripts, and the walk stops at the first item from before start.
+
+    Inputs:
+        starting_url: (str) link to show page (to help give complete url for a
+            transcript)
+        transcript_link: (str) link to transcript page
+        title: (str) name of show)
+        incremental: (bool) only crawl episodes newer than the show's
+            high-water mark
+        start, end: (datetime.dates) first and last air date to crawl
+            (default: LIMIT_YEAR)
+        marks: dictionary of high-water marks to crawl down to (see
+            crawler_util.get_crawl_marks), by default the current ones
+
+    Outputs: (int) number of episodes queued for the database
     '''
-    Crawls transcripts of CNN shows and returns some TBD data structure.
-    start_date: first date of transcripts to include (inclusive)
-    end_date: last date of transcripts to include (inclusive)
+    start, end = crawler_util.get_date_window(start, end, LIMIT_YEAR)
+    episodes_loaded = 0
+
+    # Create soup object from starting page
+    transcripts_request = crawler_util.get_listing(transcripts_link,
+                                                   revalidate=incremental)
+    if transcripts_request is None:
+        raise ValueError("listing could not be fetched")
+    if transcripts_request.not_modified:
+        return episodes_loaded
+
+    mark_url = None
+    if incremental:
+        _, mark_url = crawler_util.get_crawl_mark(title, marks)
+
+    links = [link for link in read_listing(starting_url,
+                 transcripts_request.text, start, end, mark_url)
+             if crawler_util.claim_url(link)]
+
+    # Fetch and parse transcripts concurrently, then crawl them in listing
+    # order
+    crawler_util.add_to_frontier('MSNBC', title, links, transcripts_link)
+    transcript_requests = crawler_util.get_requests(links)
+    parsed_transcripts = crawler_util.parse_responses(parse_msnbc_transcript,
+        transcript_requests, start, end)
+    for link, parsed_transcript in parsed_transcripts:
+        if parsed_transcript is None:
+            continue
+        # read_listing has already stopped at the listing's dates and at the
+        # show's high-water mark; a page dated outside the window is only
+        # skipped
+        if not crawler_util.in_date_window(parsed_transcript['airtime'],
+                                           start, end):
+            crawler_util.mark_url(link, 'done')
+            continue
+        loaded = crawl_msnbc_transcript(link, title, parsed_transcript,
+                                        start, end)
+        episodes_loaded += loaded
+        if not loaded:
+            crawler_util.mark_url(link, 'done')
+
+    crawler_util.save_validators(transcripts_link, transcripts_request,
+                                 links)
+
+    return episodes_loaded
+
+
+def get_shows(starting_url=STARTING_URL):
     '''
+    Find the shows on the transcripts index.
 
-    starting_url = ("http://www.msnbc.com/transcripts")
+    Inputs:
+        starting_url: (str) transcripts index
 
-    # Create soup object from starting page
-    starting_request = crawler_util.get_request(starting_url)
+    Outputs: list of (title, link to the show's transcript listing) tuples
+    '''
+    starting_request = crawler_util.get_listing(starting_url)
     starting_text = starting_request.text
     starting_soup = bs4.BeautifulSoup(starting_text, "html5lib")
     show_list = starting_soup.find('div', class_='item-list').find_all('a')
 
+    shows = []
     for show in show_list:
         link = show.get('href')
         if "/nav-" in link:
@@ -139,9 +261,37 @@ def go(db_cursor, db_connection, speaker_id_start=0, episode_id_start=0,
         title = show.get_text()
         transcripts_link = crawler_util.convert_if_relative_url(\
                 starting_url, show.get('href'))
+        shows.append((title, transcripts_link))
+
+    return shows
+
+
+def go(incremental=False, start=None, end=None, starting_url=STARTING_URL):
+    '''
+    Crawls transcripts of CNN shows and returns some TBD data structure.
+    start: first date of transcripts to include (inclusive)
+    end: last date of transcripts to include (inclusive)
+    incremental: only crawl episodes newer than each show's high-water mark
+    starting_url: transcripts index to start from (to crawl a stand-in site,
+        see stand_in_sites.py)
+
+    start and end are datetime.dates and default to the first and last day
+    of LIMIT_YEAR. The window can span any number of years; each show's
+    transcripts in it are fetched concurrently.
+
+    Shows are crawled crawler_util.SHOW_WORKERS at a time, and episodes are
+    queued for crawler_util's writer thread (see crawler_util.start_writer),
+    so this can run at the same time as the other networks' crawlers.
+
+    The shows are taken from the show catalog while it has not expired
+    (see crawler_util.get_catalog_shows).
+
+    Outputs: (int) number of episodes queued for the database
+    '''
 
-        episode_id_start, speaker_id_start, phrase_id_start = crawl_show(\
-            starting_url, transcripts_link, db_cursor, db_connection,
-            title, episode_id_start, speaker_id_start, phrase_id_start)
+    crawler_util.set_crawl_context('MSNBC')
+    start, end = crawler_util.get_date_window(start, end, LIMIT_YEAR)
 
-    return speaker_id_start, episode_id_start, phrase_id_start
+    return crawler_util.crawl_shows('MSNBC', crawl_show, starting_url,
+        crawler_util.get_catalog_shows('MSNBC', starting_url, get_shows),
+        incremental, start, end)
@@ -5,8 +5,31 @@ CAPP 30122: Final Project Utility Functions
 import bs4
 import urllib
 import requests
+import requests.adapters
+import requests.structures
 import os
 import re
+import gzip
+import json
+import time
+import hashlib
+import heapq
+import random
+import datetime
+import sqlite3
+import threading
+import statistics
+import queue
+import multiprocessing
+import concurrent.futures
+import http.server
+import codecs
+import importlib.util
+
+if importlib.util.find_spec('lxml') is not None:
+    FAST_PARSER = 'lxml'
+else:
+    FAST_PARSER = 'html.parser'
 
 VIDEO_START = "[[(](BEGIN|START) (VIDEO|VOICE|AUDIO).*?[])]"
 VIDEO_END = "[[(]END (VIDEO|VOICE|AUDIO).*?[])]"
@@ -106,6 +129,233 @@ STARTS_ENDS_TITLES = ["PRESIDENTIAL CANDIDATE", "MAYOR", "CHIEF JUSTICE",
                       "DR", "SENATOR", "PRESIDENT",
                       "PRESIDENT OF THE UNITED STATES"]
 
+# Tables used to keep track of crawls, on top of the tables in news.sql
+CRAWL_TABLES = ['''CREATE TABLE IF NOT EXISTS crawl_mark(
+                       show_name varchar(25) NOT NULL PRIMARY KEY,
+                       network_name varchar(7),
+                       airtime datetime,
+                       url varchar(200))''',
+                '''CREATE TABLE IF NOT EXISTS crawl_frontier(
+                       url varchar(200) NOT NULL PRIMARY KEY,
+                       network_name varchar(7),
+                       show_name varchar(25),
+                       state varchar(7),
+                       error text)''',
+                '''CREATE TABLE IF NOT EXISTS crawl_checkpoint(
+                       checkpoint_id int NOT NULL PRIMARY KEY,
+                       speaker_id int,
+                       episode_id int,
+                       phrase_id int,
+                       saved_at datetime)''',
+                '''CREATE TABLE IF NOT EXISTS crawl_content(
+                       content_hash char(40) NOT NULL PRIMARY KEY,
+                       episode_id varchar(7))''',
+                '''CREATE TABLE IF NOT EXISTS crawl_catalog(
+                       starting_url varchar(200) NOT NULL,
+                       show_name varchar(25) NOT NULL,
+                       network_name varchar(7),
+                       listing_url varchar(200),
+                       last_seen real,
+                       PRIMARY KEY (starting_url, show_name))''',
+                '''CREATE TABLE IF NOT EXISTS crawl_discovery(
+                       starting_url varchar(200) NOT NULL PRIMARY KEY,
+                       network_name varchar(7),
+                       discovered real)''',
+                '''CREATE TABLE IF NOT EXISTS crawl_validator(
+                       url varchar(200) NOT NULL PRIMARY KEY,
+                       etag varchar(200),
+                       last_modified varchar(40),
+                       saved real)''']
+
+# Every transcript of a crawl (and every show listing that fails) is kept in
+# the crawl_frontier table: pending when it is found, then done or failed. It
+# is written in the same transactions as the crawl output, together with the
+# ID counters in crawl_checkpoint, so a crawl that stops can be resumed from
+# its last commit. Failed pages keep their error and are tried again when the
+# crawl is resumed.
+FRONTIER_STATES = ['pending', 'done', 'failed']
+SCHEMA_FILENAME = 'news.sql'
+DONE_URLS = set()
+_frontier_lock = threading.Lock()
+
+# Shows to crawl, by the title the network's show index gives them, or None
+# to crawl every show. A crawl of one network or show into its own database
+# (a shard, see merge_shards.py) needs no coordination with the others.
+SHOW_CONFIG = {'shows': None}
+
+# Show catalog: the shows found on each network's index (by the URL the
+# crawler starts from) and the listing URL of each, kept in crawl_catalog so
+# crawls do not load and parse the index (and for Fox, every show's page)
+# again. crawl_discovery records when each index was last read in full; the
+# catalog is used for CATALOG_TTL seconds after that, and a crawl of only
+# some shows uses it while those shows were seen within CATALOG_TTL.
+CATALOG_TTL = 7 * 24 * 3600
+CATALOG_CONFIG = {'ttl': CATALOG_TTL, 'refresh': False}
+# starting_url: {'discovered': time or None, 'shows': {show_name:
+# (network_name, listing_url, last_seen)}}
+CATALOG = {}
+_catalog_lock = threading.Lock()
+
+# A backfill of several years can split each CNN show's crawl window into
+# years or months, crawled in parallel like separate shows: a CNN show is
+# otherwise walked one listing day at a time. The listings are dated, so a
+# show's listing is read once and each partition only fetches the transcripts
+# of its own day blocks. An MSNBC show already fetches
+# its whole window at once, and Fox shows are paginated from their newest
+# transcript, so neither is partitioned.
+PARTITIONS = ['year', 'month']
+PARTITION_CONFIG = {'partition': None}
+
+# A transcript can be listed under more than one show. The first listing to
+# claim it during a crawl fetches it; the others skip it. The same transcript
+# can also be posted under several URLs, so the writer keeps a hash of each
+# loaded transcript's normalized text (speakers and words) in crawl_content
+# and skips episodes whose text is already in the database.
+CLAIMED_URLS = set()
+
+# Crawler output is written to the database by a single writer thread. The
+# crawlers put parsed episodes on its queue and never touch SQLite; the writer
+# hands out speaker, episode and phrase IDs from ID_COUNTERS and inserts the
+# rows with executemany, committing once WRITE_BATCH_ROWS rows are pending or
+# WRITE_BATCH_SECONDS have passed since the last commit. The synchronous
+# setting (SQLite's PRAGMA synchronous) trades durability of the latest
+# batches for fewer fsyncs.
+WRITE_BATCH_ROWS = 5000
+WRITE_BATCH_SECONDS = 5
+SYNCHRONOUS_MODES = ['OFF', 'NORMAL', 'FULL']
+WRITER_CONFIG = {'batch_rows': WRITE_BATCH_ROWS,
+                 'batch_seconds': WRITE_BATCH_SECONDS,
+                 'synchronous': 'FULL'}
+ID_COUNTERS = {'speaker': 0, 'episode': 0, 'phrase': 0}
+# show_name: (network_name, airtime, url) of the newest episode loaded
+CRAWL_MARKS = {}
+_marks_lock = threading.Lock()
+_writer = {'thread': None, 'queue': None, 'error': None}
+
+# Shared HTTP client settings. POOL_CONNECTIONS is the number of hosts to keep
+# a pool for, POOL_MAXSIZE the number of keep-alive connections per host.
+POOL_CONNECTIONS = 10
+POOL_MAXSIZE = 10
+CONNECT_TIMEOUT = 10
+READ_TIMEOUT = 30
+REQUEST_HEADERS = {'Accept-Encoding': 'gzip, deflate',
+                   'Connection': 'keep-alive'}
+
+SESSION_CONFIG = {'pool_connections': POOL_CONNECTIONS,
+                  'pool_maxsize': POOL_MAXSIZE,
+                  'timeout': (CONNECT_TIMEOUT, READ_TIMEOUT)}
+_session = None
+
+# Pages fetched with stream=True (long show listings, when the page cache is
+# off) are handed over as soon as their headers arrive and read
+# STREAM_CHUNK_SIZE bytes at a time by iter_page_text, so a crawler can parse
+# them as they download and close the connection once it has read enough.
+STREAM_CHUNK_SIZE = 64 * 1024
+
+# Every page is fetched through one scheduler shared by all crawlers and
+# shows. It keeps a priority queue per host (show listings before transcripts,
+# then the oldest request first) and SCHEDULER_WORKERS fetch threads, which
+# only take a request from a host with a free slot: at most PER_HOST_REQUESTS
+# requests in flight, and no more than the host's adaptive limit below. Keep
+# PER_HOST_REQUESTS at or below POOL_MAXSIZE so every request reuses a pooled
+# connection. Each network crawls SHOW_WORKERS shows at a time, so a slow show
+# does not hold up the others.
+PER_HOST_REQUESTS = 4
+SCHEDULER_WORKERS = 16
+SHOW_WORKERS = 4
+REQUEST_PRIORITIES = {'listing': 0, 'transcript': 1}
+
+SCHEDULER_CONFIG = {'workers': SCHEDULER_WORKERS,
+                    'per_host': PER_HOST_REQUESTS}
+_scheduler = {'condition': threading.Condition(),
+              'queues': {},
+              'scheduled': {},
+              'sequence': 0,
+              'threads': []}
+
+# Per-host politeness. Each host gets a token bucket refilled at
+# REQUESTS_PER_SECOND (holding at most BURST tokens) and an adaptive limit on
+# requests in flight: the limit grows by about one per round of successful
+# requests up to POOL_MAXSIZE and is halved whenever the host answers 429 or
+# 5xx or times out. Those requests are retried up to MAX_RETRIES times after a
+# jittered exponential backoff (or the server's Retry-After).
+REQUESTS_PER_SECOND = 5
+BURST = 5
+INITIAL_CONCURRENCY = 2
+MAX_RETRIES = 4
+BACKOFF_BASE = 1
+BACKOFF_MAX = 60
+
+RATE_CONFIG = {'rate': REQUESTS_PER_SECOND,
+               'burst': BURST,
+               'max_retries': MAX_RETRIES}
+HOST_STATS = {}
+_host_lock = threading.Lock()
+
+# Number of processes parsing transcript pages (HTML parsing and
+# clean_and_filter_text). 0 parses in the crawler process itself.
+PARSE_WORKERS = os.cpu_count() or 1
+_parse_pool = None
+_parse_pool_lock = threading.Lock()
+
+# Parser used for transcript pages. With any parser but html5lib, each
+# network only builds the subtrees named by its strainers. In parity mode every
+# transcript is also parsed in full with html5lib and the extracted results
+# must match.
+PARSER_CONFIG = {'parser': FAST_PARSER, 'parity': False}
+
+# On-disk page cache. Pages are stored under CACHE_DIR keyed by a hash of the
+# URL: the gzip-compressed body in <hash>.gz and what is needed to rebuild the
+# response (status, encoding, headers, fetch time) in <hash>.json.
+#   record: always fetch from the network and store the page
+#   replay: only serve pages from the cache, never touch the network
+#   refresh-older-than: serve cached pages younger than max_age seconds,
+#       fetch and store the rest
+CACHE_DIR = 'page_cache'
+CACHE_MODES = ['record', 'replay', 'refresh-older-than']
+CACHE_CONFIG = {'mode': None, 'directory': CACHE_DIR, 'max_age': None}
+
+# While the cache is recording, every transcript handed to the crawl by a show
+# listing is also logged to ARCHIVE_FILENAME in the cache folder, one JSON
+# object per line with its network, show, listing URL and listing headline,
+# so the database can be rebuilt from the cached pages alone (see
+# reparse_transcripts.py).
+ARCHIVE_FILENAME = 'transcripts.jsonl'
+_archive_lock = threading.Lock()
+
+# The validators (ETag and Last-Modified) of each show listing a crawl has
+# finished are kept in the crawl_validator table, apart from the page cache,
+# so an incremental crawl can ask whether a listing changed whether or not
+# the cache is on. A listing the server answers 304 Not Modified for has no
+# new episodes, and its show is skipped.
+# url: (etag, last_modified)
+VALIDATORS = {}
+_validators_lock = threading.Lock()
+
+# Crawl instrumentation. Seconds spent in each stage are added up per network
+# and show:
+#   fetch: network requests and page cache reads (with pages and bytes)
+#   parse: HTML parsing in the parse pool, not counting clean
+#   clean: clean_and_filter_text
+#   speakers: create_speaker_dict and create_alias_dict, in the writer
+#   write: database batches, shared between the shows in each batch by the
+#       number of rows they added
+# Fetches run on several threads at once, so stage seconds are work summed
+# over threads, not wall time. Work is credited to the crawl context (network
+# and show) of the thread that asked for it; see set_crawl_context.
+METRIC_STAGES = ['fetch', 'parse', 'clean', 'speakers', 'write']
+METRIC_RESOURCES = {'network': ['fetch'],
+                    'cpu': ['parse', 'clean', 'speakers'],
+                    'sqlite': ['write']}
+# Transcripts the writer leaves out, printed and counted per network and show
+# in the crawl metrics (see record_event)
+METRIC_EVENTS = {'duplicate': "DUPLICATE TRANSCRIPT",
+                 'load_failed': "FAILED TO LOAD"}
+METRICS = {}
+_metrics = {'lock': threading.Lock(), 'started': time.time(), 'server': None}
+_crawl_context = threading.local()
+_stage_times = threading.local()
+
 
 def clean_and_filter_text(transcript_text, begin_flag, end_flag,
                           video_start=VIDEO_START, video_end=VIDEO_END,
@@ -507,25 +757,327 @@ def clean_name(name):
     return ' '.join(clean_name)
 
 
-def crawl_transcript(transcript_text, begin_flag, end_flag, episode_id_start,
-            speaker_id_start, phrase_id_start, db_cursor):
+def create_database(db_name, overwrite=False):
     '''
-    Given the text of a transcript, load its information into the database.
+    Create an empty database with the news.sql schema and the crawl tables.
+
+    Inputs:
+        db_name: (str) database file to create
+        overwrite: (bool) replace the file if it already exists
+    '''
+    if os.path.exists(db_name):
+        if not overwrite:
+            raise FileExistsError("{} already exists (use --overwrite "
+                                  "to replace it)".format(db_name))
+        os.remove(db_name)
+
+    with open(SCHEMA_FILENAME) as f:
+        schema = f.read()
+    db_connection = sqlite3.connect(db_name)
+    db_connection.executescript(schema)
+    create_crawl_tables(db_connection.cursor())
+    db_connection.commit()
+    db_connection.close()
+
+
+def create_crawl_tables(db_cursor):
+    '''
+    Create the crawl bookkeeping tables in CRAWL_TABLES if the database does
+    not have them yet.
+    '''
+    for create_table in CRAWL_TABLES:
+        db_cursor.execute(create_table)
+
+
+def get_next_ids(db_cursor):
+    '''
+    Return the first unused speaker, episode and phrase IDs in the database,
+    to add to it without clearing it first.
+
+    Outputs: speaker_id_start, episode_id_start, phrase_id_start (ints)
+    '''
+    next_ids = []
+    for table, column in [('speaker', 'speaker_id'), ('episode', 'episode_id'),
+                          ('transcript', 'phrase_id')]:
+        max_id = db_cursor.execute(\
+            'SELECT MAX(CAST({0} AS INTEGER)) FROM {1}'.format(column, table)
+            ).fetchall()[0][0]
+        next_ids.append(0 if max_id is None else max_id + 1)
+
+    return tuple(next_ids)
+
+
+def set_next_ids(speaker_id_start, episode_id_start, phrase_id_start):
+    '''
+    Set the next speaker, episode and phrase IDs handed out by the writer.
+    '''
+    ID_COUNTERS['speaker'] = speaker_id_start
+    ID_COUNTERS['episode'] = episode_id_start
+    ID_COUNTERS['phrase'] = phrase_id_start
+
+
+def get_checkpoint_ids(db_cursor):
+    '''
+    Return the speaker, episode and phrase IDs saved with the last commit of
+    a crawl, or the first unused IDs in the database if there is no
+    checkpoint.
+
+    Outputs: speaker_id_start, episode_id_start, phrase_id_start (ints)
+    '''
+    checkpoint = db_cursor.execute('''SELECT speaker_id, episode_id, phrase_id
+                                      FROM crawl_checkpoint''').fetchall()
+    if not checkpoint:
+        return get_next_ids(db_cursor)
+
+    return tuple(checkpoint[0])
+
+
+def load_frontier(db_cursor):
+    '''
+    Read the URLs a previous crawl finished from the crawl_frontier table
+    into DONE_URLS, so they are not crawled again.
+    '''
+    with _frontier_lock:
+        DONE_URLS.clear()
+        CLAIMED_URLS.clear()
+        for url, in db_cursor.execute('''SELECT url FROM crawl_frontier
+                                         WHERE state = 'done' ''').fetchall():
+            DONE_URLS.add(url)
+
+
+def is_url_done(url):
+    '''
+    Has url already been crawled (by this crawl or the one it resumes)?
+    '''
+    with _frontier_lock:
+        return url in DONE_URLS
+
+
+def claim_url(url):
+    '''
+    Claim a transcript for the calling show's crawl, so it is only fetched
+    once even if it is listed under several shows.
+
+    Outputs: (bool) False if url is already done or claimed by another
+        listing in this crawl
+    '''
+    with _frontier_lock:
+        if url in DONE_URLS or url in CLAIMED_URLS:
+            return False
+        CLAIMED_URLS.add(url)
+        return True
+
+
+def get_content_hash(split_text):
+    '''
+    Return a hash of a transcript's speakers and words, ignoring case and
+    whitespace, or None if it has no turns.
+
+    Inputs:
+        split_text: dictionary created by split_transcript
+
+    Outputs: (str) hex SHA-1 digest, or None
+    '''
+    if not split_text['turns']:
+        return None
+
+    content_hash = hashlib.sha1()
+    for speaker, text in split_text['turns']:
+        turn = ' '.join([str.upper(speaker)] + text.lower().split())
+        content_hash.update(turn.encode('utf-8') + b'\n')
+
+    return content_hash.hexdigest()
+
+
+def get_failed_urls(db_cursor):
+    '''
+    Return the retry list: pages that failed in the crawl, with the error
+    they failed on. They are crawled again when the crawl is resumed.
+
+    Outputs: list of (url, network_name, show_name, error) tuples
+    '''
+    return db_cursor.execute('''SELECT url, network_name, show_name, error
+                                FROM crawl_frontier
+                                WHERE state = 'failed' ''').fetchall()
+
+
+def load_crawl_marks(db_cursor):
+    '''
+    Read every show's high-water mark from the crawl_mark table into
+    CRAWL_MARKS.
+    '''
+    with _marks_lock:
+        CRAWL_MARKS.clear()
+        for show_name, network_name, airtime, url in db_cursor.execute(\
+                'SELECT * FROM crawl_mark').fetchall():
+            CRAWL_MARKS[show_name] = (network_name, airtime, url)
+
+
+def get_crawl_mark(show_name, marks=None):
+    '''
+    Return the airtime and URL of the newest episode of a show already in
+    the database (its high-water mark), or (None, None) if there is none.
+
+    Inputs:
+        show_name: (str) name of show
+        marks: dictionary from get_crawl_marks to read the mark from, or
+            None to read the current one
+    '''
+    if marks is not None:
+        mark = marks.get(show_name)
+    else:
+        with _marks_lock:
+            mark = CRAWL_MARKS.get(show_name)
+    if mark is None:
+        return None, None
+
+    return mark[1:]
+
+
+def get_crawl_marks(network_name=None):
+    '''
+    Return a copy of the high-water marks, for a crawl that has to keep
+    using the marks it started from while the writer moves them (see
+    crawl_shows).
+
+    Inputs:
+        network_name: (str) only return the marks of this network's shows
+
+    Outputs: dictionary mapping show names to (network_name, airtime, url)
+        tuples
+    '''
+    with _marks_lock:
+        return {show_name: mark for show_name, mark in CRAWL_MARKS.items()
+                if network_name is None or mark[0] == network_name}
+
+
+def update_crawl_mark(show_name, network_name, airtime, url):
+    '''
+    Record the newest episode of a show loaded into the database, unless the
+    show's high-water mark is already newer.
+
+    Inputs:
+        show_name: (str) name of show
+        network_name: (str) name of network
+        airtime: (str) airtime of the newest episode loaded
+        url: (str) link to the newest episode loaded
+
+    Outputs: (bool) True if the mark moved
+    '''
+    with _marks_lock:
+        mark = CRAWL_MARKS.get(show_name)
+        if mark is not None and mark[1] >= airtime:
+            return False
+        CRAWL_MARKS[show_name] = (network_name, airtime, url)
+
+    return True
+
+
+def is_before_mark(airtime, mark_airtime):
+    '''
+    Is an episode older than a show's high-water mark (and so already in the
+    database)? Always False when the show has no mark.
+    '''
+    return mark_airtime is not None and airtime < mark_airtime
+
+
+def get_date_window(start=None, end=None, limit_year=None):
+    '''
+    Return the first and last air dates to crawl. A missing bound defaults to
+    the first or last day of limit_year.
+
+    Inputs:
+        start, end: (datetime.date) first and last air date (inclusive), or
+            None
+        limit_year: (int) year to crawl when a bound is missing
+
+    Outputs: start, end (datetime.dates)
+    '''
+    if start is None:
+        start = datetime.date(limit_year, 1, 1)
+    if end is None:
+        end = datetime.date(limit_year, 12, 31)
+
+    return start, end
+
+
+def in_date_window(airtime, start, end):
+    '''
+    Did an episode ("YYYY-MM-DD ..." airtime) air between start and end
+    (datetime.dates, inclusive)?
+    '''
+    return start.isoformat() <= airtime[:10] <= end.isoformat()
+
+
+def is_before_window(airtime, start):
+    '''
+    Did an episode ("YYYY-MM-DD ..." airtime) air before start? Listings run
+    from newest to oldest, so a crawl can stop at the first such episode.
+    '''
+    return airtime[:10] < start.isoformat()
+
+
+def split_transcript(transcript_text, begin_flag, end_flag):
+    '''
+    Clean raw transcript text and split it into speaker turns. Only plain
+    lists and strings are returned, so this can run in the parse pool.
 
     Inputs:
         transcript_text: raw transcript text
         begin_flag: regular expression indicating beginning of speech
         end_flag: regular expression indicating end of speech
+
+    Outputs: dictionary with
+        'all_speakers': list of all speakers as they appear in the text
+        'turns': list of (speaker, text) tuples, not including video clips
+    '''
+    clean_start = time.perf_counter()
+    all_speakers, filtered_speakers, filtered_text_list = clean_and_filter_text(\
+        transcript_text, begin_flag, end_flag)
+    add_stage_time('clean', time.perf_counter() - clean_start)
+
+    return {'all_speakers': all_speakers,
+            'turns': list(zip(filtered_speakers, filtered_text_list))}
+
+
+def resolve_speakers(split_text):
+    '''
+    Resolve the speakers of a split transcript to the official names loaded
+    into the database. Only depends on the transcript itself, so this can run
+    in the parse pool.
+
+    Inputs:
+        split_text: dictionary created by split_transcript
+
+    Outputs: speakers_dict (from create_speaker_dict), alias_dict (from
+        create_alias_dict)
+    '''
+    filtered_speakers = [speaker for speaker, _ in split_text['turns']]
+    speakers_dict = create_speaker_dict(split_text['all_speakers'],
+                                        filtered_speakers)
+    alias_dict = create_alias_dict(speakers_dict, filtered_speakers)
+
+    return speakers_dict, alias_dict
+
+
+def load_transcript(split_text, episode_id_start, speaker_id_start,
+                    phrase_id_start, db_cursor):
+    '''
+    Resolve the speakers of a split transcript and load it into the
+    database.
+
+    Inputs:
+        split_text: dictionary created by split_transcript
         episode_id_start: (int) current episode ID
         speaker_id_start: (int) current speaker ID
         phrase_id_start: (int) current text clip ID
         db_cursor: cursor to perform SQL statements on the database
 
     Outputs: updated speaker_id and phrase_id after processing transcript
-
     '''
-    all_speakers, filtered_speakers, filtered_text_list = clean_and_filter_text(\
-        transcript_text, begin_flag, end_flag)
+    all_speakers = split_text['all_speakers']
+    filtered_speakers = [speaker for speaker, _ in split_text['turns']]
+    filtered_text_list = [text for _, text in split_text['turns']]
 
     if not all_speakers and not filtered_speakers and not filtered_text_list:
         return speaker_id_start, phrase_id_start
@@ -543,35 +1095,1986 @@ def crawl_transcript(transcript_text, begin_flag, end_flag, episode_id_start,
     return speaker_id_start, phrase_id_start
 
 
-## Code below is provided from pa1 in util.
+def configure_writer(batch_rows=WRITE_BATCH_ROWS,
+                     batch_seconds=WRITE_BATCH_SECONDS, synchronous='FULL'):
+    '''
+    Set how the writer thread batches and commits crawler output.
 
-def get_request(url):
+    Inputs:
+        batch_rows: (int) commit once this many rows are pending
+        batch_seconds: (float) commit at least this often while rows are
+            pending
+        synchronous: (str) one of SYNCHRONOUS_MODES. "FULL" fsyncs every
+            commit; "NORMAL" and "OFF" are faster, but a power failure can
+            lose (or with "OFF", corrupt) the latest batches.
     '''
-    Open a connection to the specified URL and if successful
-    read the data.
+    if synchronous not in SYNCHRONOUS_MODES:
+        raise ValueError("synchronous must be one of {}".format(\
+            SYNCHRONOUS_MODES))
+
+    WRITER_CONFIG['batch_rows'] = batch_rows
+    WRITER_CONFIG['batch_seconds'] = batch_seconds
+    WRITER_CONFIG['synchronous'] = synchronous
+
+
+def new_write_batch():
+    '''
+    Return an empty batch of rows for the writer thread, keyed by table.
+    '''
+    return {'speaker': [], 'title': [], 'transcript': [], 'episode': [],
+            'show': [], 'crawl_mark': {}, 'frontier': [], 'frontier_state': {},
+            'content': [], 'catalog': [], 'discovery': {}, 'validator': {},
+            'rows_by_show': {}}
+
+
+def add_episode_rows(batch, speakers, content_hashes, episode):
+    '''
+    Resolve the speakers of an episode and add its rows to a write batch,
+    taking its IDs from ID_COUNTERS. Only called from the writer thread. If
+    the speakers cannot be resolved, raises before anything is changed. An
+    episode whose text is already in the database is marked done without
+    being loaded again.
 
     Inputs:
-        url: must be an absolute URL
+        batch: dictionary created by new_write_batch
+        speakers: dictionary mapping speaker names already in the database
+            (or batch) to their ID and set of titles
+        content_hashes: dictionary mapping the content hashes of episodes
+            already in the database (or batch) to their episode ID
+        episode: (network_name, show_name, headline, airtime, link,
+            split_text) tuple from store_episode. If split_text already has
+            the 'speakers_dict' and 'alias_dict' of resolve_speakers, they
+            are used instead of resolving the speakers again.
+
+    Outputs: (int) number of rows added
+    '''
+    network_name, show_name, headline, airtime, link, split_text = episode
+    episode_id = ID_COUNTERS['episode']
+    rows = 0
+
+    content_hash = get_content_hash(split_text)
+    if content_hash in content_hashes:
+        record_event(network_name, show_name, 'duplicate', link,
+                     'of episode {}'.format(content_hashes[content_hash]))
+        batch['frontier_state'][link] = (link, network_name, show_name,
+            'done', 'duplicate of episode {}'.format(\
+                content_hashes[content_hash]))
+        return 1
+
+    filtered_speakers = [speaker for speaker, _ in split_text['turns']]
+    if split_text['all_speakers'] or filtered_speakers:
+        if 'alias_dict' in split_text:
+            speakers_dict = split_text['speakers_dict']
+            alias_dict = split_text['alias_dict']
+        else:
+            speakers_start = time.perf_counter()
+            speakers_dict, alias_dict = resolve_speakers(split_text)
+            record_metric(network_name, show_name, 'speakers',
+                          time.perf_counter() - speakers_start)
+        for speaker_raw in filtered_speakers:
+            official_name = alias_dict[str.upper(speaker_raw)]
+            assert official_name in speakers_dict or official_name in speakers
+
+        for speaker, info in speakers_dict.items():
+            if speaker not in speakers:
+                speakers[speaker] = (ID_COUNTERS['speaker'], set())
+                batch['speaker'].append((ID_COUNTERS['speaker'], speaker))
+                ID_COUNTERS['speaker'] += 1
+                rows += 1
+            speaker_id, titles = speakers[speaker]
+            if info['title'] and info['title'] not in titles:
+                titles.add(info['title'])
+                batch['title'].append((speaker_id, info['title']))
+                rows += 1
+
+        for speaker_raw, text in split_text['turns']:
+            speaker_id = speakers[alias_dict[str.upper(speaker_raw)]][0]
+            batch['transcript'].append((ID_COUNTERS['phrase'], episode_id,
+                                        text, speaker_id))
+            ID_COUNTERS['phrase'] += 1
+            rows += 1
+
+    batch['episode'].append((episode_id, headline, airtime, show_name))
+    batch['show'].append((show_name, network_name))
+    batch['frontier_state'][link] = (link, network_name, show_name, 'done',
+                                     None)
+    rows += 3
+    if content_hash is not None:
+        content_hashes[content_hash] = episode_id
+        batch['content'].append((content_hash, episode_id))
+        rows += 1
+    batch['rows_by_show'][(network_name, show_name)] = \
+        batch['rows_by_show'].get((network_name, show_name), 0) + rows
+    if update_crawl_mark(show_name, network_name, airtime, link):
+        batch['crawl_mark'][show_name] = (show_name, network_name, airtime,
+                                          link)
+    ID_COUNTERS['episode'] += 1
+
+    return rows
+
+
+def flush_write_batch(db_connection, batch):
+    '''
+    Insert a write batch with one executemany per table and commit it, with
+    the current ID counters as the crawl's checkpoint, as a single
+    transaction.
+    '''
+    write_start = time.perf_counter()
+    db_cursor = db_connection.cursor()
+    db_cursor.executemany('INSERT INTO speaker VALUES(?, ?)',
+                          batch['speaker'])
+    db_cursor.executemany('INSERT INTO title VALUES(?, ?)', batch['title'])
+    db_cursor.executemany('INSERT INTO transcript VALUES(?, ?, ?, ?)',
+                          batch['transcript'])
+    db_cursor.executemany('INSERT INTO episode VALUES(?, ?, ?, ?)',
+                          batch['episode'])
+    db_cursor.executemany('INSERT OR IGNORE INTO show VALUES(?, ?)',
+                          batch['show'])
+    db_cursor.executemany(\
+        'INSERT OR REPLACE INTO crawl_mark VALUES(?, ?, ?, ?)',
+        batch['crawl_mark'].values())
+    # A page can be marked (with no network or show) before it is added
+    db_cursor.executemany('''INSERT INTO crawl_frontier VALUES(?, ?, ?, ?, ?)
+                             ON CONFLICT(url) DO UPDATE
+                             SET network_name = excluded.network_name,
+                                 show_name = excluded.show_name
+                             WHERE crawl_frontier.network_name IS NULL''',
+                          batch['frontier'])
+    db_cursor.executemany('''INSERT INTO crawl_frontier VALUES(?, ?, ?, ?, ?)
+                             ON CONFLICT(url) DO UPDATE
+                             SET state = excluded.state,
+                                 error = excluded.error''',
+                          batch['frontier_state'].values())
+    db_cursor.executemany('INSERT INTO crawl_content VALUES(?, ?)',
+                          batch['content'])
+    db_cursor.executemany(\
+        'INSERT OR REPLACE INTO crawl_catalog VALUES(?, ?, ?, ?, ?)',
+        batch['catalog'])
+    # Shows no longer on an index read in full leave the catalog
+    db_cursor.executemany(\
+        'DELETE FROM crawl_catalog WHERE starting_url = ? AND last_seen < ?',
+        [(starting_url, discovered) for starting_url, _, discovered
+         in batch['discovery'].values()])
+    db_cursor.executemany(\
+        'INSERT OR REPLACE INTO crawl_discovery VALUES(?, ?, ?)',
+        batch['discovery'].values())
+    db_cursor.executemany(\
+        'INSERT OR REPLACE INTO crawl_validator VALUES(?, ?, ?, ?)',
+        batch['validator'].values())
+    db_cursor.execute(\
+        'INSERT OR REPLACE INTO crawl_checkpoint VALUES(0, ?, ?, ?, ?)',
+        (ID_COUNTERS['speaker'], ID_COUNTERS['episode'],
+         ID_COUNTERS['phrase'], time.strftime('%Y-%m-%d %H:%M:%S')))
+    db_connection.commit()
+
+    write_seconds = time.perf_counter() - write_start
+    rows_by_show = batch['rows_by_show'] or {(None, None): 1}
+    total_rows = sum(rows_by_show.values())
+    for (network_name, show_name), rows in rows_by_show.items():
+        record_metric(network_name, show_name, 'write',
+                      write_seconds * rows / total_rows)
+
+
+def add_write_rows(batch, speakers, content_hashes, item):
+    '''
+    Add an item from the writer queue to a write batch. A transcript whose
+    speakers cannot be resolved is marked failed instead of stopping the
+    writer.
+
+    Inputs:
+        batch: dictionary created by new_write_batch
+        speakers: dictionary mapping speaker names to their ID and titles
+        content_hashes: dictionary mapping content hashes to episode IDs
+        item: ("episode", episode), ("frontier", network_name, show_name,
+            urls), ("state", url, state, error), ("catalog",
+            network_name, starting_url, shows, complete, seen) or
+            ("validator", url, etag, last_modified) tuple
+
+    Outputs: (int) number of rows added
+    '''
+    if item[0] == 'validator':
+        # The listing's transcripts were queued before it, so the ones that
+        # failed to load have been taken out of DONE_URLS by now
+        _, url, etag, last_modified, urls = item
+        if all(is_url_done(transcript_url) for transcript_url in urls):
+            batch['validator'][url] = (url, etag, last_modified, time.time())
+        return 1
+
+    if item[0] == 'catalog':
+        _, network_name, starting_url, shows, complete, seen = item
+        batch['catalog'].extend([(starting_url, title, network_name,
+                                  listing_url, seen)
+                                 for title, listing_url in shows])
+        if complete:
+            batch['discovery'][starting_url] = (starting_url, network_name,
+                                                seen)
+        return len(shows) + complete
+
+    if item[0] == 'frontier':
+        _, network_name, show_name, urls = item
+        batch['frontier'].extend([(url, network_name, show_name, 'pending',
+                                   None) for url in urls])
+        return len(urls)
+
+    if item[0] == 'state':
+        _, url, state, error = item
+        batch['frontier_state'][url] = (url, None, None, state, error)
+        return 1
+
+    episode = item[1]
+    try:
+        return add_episode_rows(batch, speakers, content_hashes, episode)
+    except Exception as error:
+        record_event(episode[0], episode[1], 'load_failed', episode[4],
+                     repr(error))
+        batch['frontier_state'][episode[4]] = (episode[4], episode[0],
+            episode[1], 'failed', repr(error))
+        with _frontier_lock:
+            DONE_URLS.discard(episode[4])
+        return 1
+
+
+def load_writer_state(db_connection):
+    '''
+    Read what the writer needs to know about the database before adding to
+    it.
 
     Outputs:
-        request object or None
+        speakers: dictionary mapping speaker names already in the database
+            to their ID and set of titles
+        content_hashes: dictionary mapping the content hashes of episodes
+            already in the database to their episode ID
+    '''
+    # Speakers (and their titles) already in the database
+    speakers = {}
+    titles_by_id = {}
+    for speaker_id, speaker_name in db_connection.execute(\
+            'SELECT speaker_id, speaker_name FROM speaker').fetchall():
+        speakers[speaker_name] = (speaker_id, set())
+        titles_by_id[str(speaker_id)] = speakers[speaker_name][1]
+    for speaker_id, speaker_title in db_connection.execute(\
+            'SELECT speaker_id, speaker_title FROM title').fetchall():
+        if str(speaker_id) in titles_by_id:
+            titles_by_id[str(speaker_id)].add(speaker_title)
+
+    # Transcripts already in the database
+    content_hashes = dict(db_connection.execute(\
+        'SELECT content_hash, episode_id FROM crawl_content').fetchall())
+
+    return speakers, content_hashes
+
+
+def write_episodes(db_name, episode_queue):
+    '''
+    Body of the writer thread: take items off episode_queue and write them
+    to the database in batches until it gets None.
+    '''
+    db_connection = sqlite3.connect(db_name)
+    try:
+        db_connection.execute('PRAGMA synchronous = {}'.format(\
+            WRITER_CONFIG['synchronous']))
+        speakers, content_hashes = load_writer_state(db_connection)
+
+        batch = new_write_batch()
+        pending_rows = 0
+        last_commit = time.monotonic()
+        done = False
+        while not done:
+            timeout = max(0, last_commit + WRITER_CONFIG['batch_seconds'] -
+                          time.monotonic())
+            try:
+                item = episode_queue.get(timeout=timeout)
+            except queue.Empty:
+                item = False
+
+            if item is None:
+                done = True
+            elif item:
+                pending_rows += add_write_rows(batch, speakers,
+                                               content_hashes, item)
+
+            if done or pending_rows >= WRITER_CONFIG['batch_rows'] or \
+                    time.monotonic() - last_commit >= \
+                    WRITER_CONFIG['batch_seconds']:
+                if pending_rows:
+                    flush_write_batch(db_connection, batch)
+                    batch = new_write_batch()
+                    pending_rows = 0
+                last_commit = time.monotonic()
+    finally:
+        db_connection.close()
+
+
+def run_writer(db_name, episode_queue):
+    '''
+    Run write_episodes, keeping any error for store_episode and stop_writer
+    to raise in the crawler threads. After an error the queue is still
+    drained so crawlers are not left waiting on it.
+    '''
+    try:
+        write_episodes(db_name, episode_queue)
+    except Exception as error:
+        _writer['error'] = error
+        while episode_queue.get() is not None:
+            pass
 
-    Examples:
-        get_request("http://www.cs.uchicago.edu")
+
+def start_writer(db_name):
+    '''
+    Start the writer thread for database db_name. ID_COUNTERS, CRAWL_MARKS
+    and DONE_URLS must already be set for it (see set_next_ids,
+    load_crawl_marks and load_frontier).
+    '''
+    _writer['queue'] = queue.Queue()
+    _writer['error'] = None
+    _writer['thread'] = threading.Thread(target=run_writer,
+        args=(db_name, _writer['queue']), name='db-writer', daemon=True)
+    _writer['thread'].start()
+
+
+def stop_writer():
+    '''
+    Write out everything still queued, stop the writer thread and raise the
+    error it stopped on, if any.
+    '''
+    if _writer['thread'] is None:
+        return
+
+    _writer['queue'].put(None)
+    _writer['thread'].join()
+    _writer['thread'] = None
+    _writer['queue'] = None
+    if _writer['error'] is not None:
+        raise _writer['error']
+
+
+def capture_writes():
+    '''
+    Keep what the crawlers queue for the writer (episodes, frontier entries
+    and frontier states) in a queue without writing it, for a crawl worker
+    that hands it on to a writer in another process (see crawl_workers.py).
+
+    Outputs: the queue the writer items are put on
     '''
+    _writer['queue'] = queue.Queue()
+    _writer['error'] = None
+
+    return _writer['queue']
 
-    if is_absolute_url(url):
+
+def take_captured_writes():
+    '''
+    Return the writer items captured since the last call (see
+    capture_writes), in the order they were queued.
+    '''
+    items = []
+    while True:
         try:
-            r = requests.get(url)
-            if r.status_code == 404 or r.status_code == 403:
-                r = None
-        except Exception:
-            # fail on any kind of error
-            r = None
-    else:
-        r = None
+            items.append(_writer['queue'].get_nowait())
+        except queue.Empty:
+            return items
 
-    return r
+
+def store_episode(network_name, show_name, headline, airtime, link,
+                  split_text):
+    '''
+    Queue one episode for the writer thread, which gives it its episode,
+    speaker and phrase IDs and writes it with the next batch. Safe to call
+    from several crawler threads; never waits on the database.
+
+    Inputs:
+        network_name: (str) name of network
+        show_name: (str) name of show
+        headline: (str) headline of the episode
+        airtime: (str) airtime of the episode
+        link: (str) URL of the transcript
+        split_text: dictionary created by split_transcript
+    '''
+    if _writer['error'] is not None:
+        raise _writer['error']
+
+    with _frontier_lock:
+        DONE_URLS.add(link)
+    _writer['queue'].put(('episode', (network_name, show_name, headline,
+                                      airtime, link, split_text)))
+
+
+def add_to_frontier(network_name, show_name, urls, listing_url=None,
+                    headlines=None):
+    '''
+    Record transcripts found in a show's listing as pending in the crawl
+    frontier (unless they are already there), and in the transcript archive
+    if the page cache is recording.
+
+    Inputs:
+        network_name: (str) name of network
+        show_name: (str) name of show
+        urls: list of transcript URLs
+        listing_url: (str) URL of the show listing they were found on
+        headlines: list of their headlines in the listing, if it has them
+    '''
+    archive_transcripts(network_name, show_name, urls, listing_url,
+                        headlines)
+    if _writer['queue'] is not None and urls:
+        _writer['queue'].put(('frontier', network_name, show_name,
+                              list(urls)))
+
+
+def mark_url(url, state, error=None):
+    '''
+    Set the crawl frontier state of a page: "done" for a transcript that was
+    deliberately not loaded (wrong year, did not air, ...), "failed" for a
+    page that could not be fetched or parsed. Failed pages go on the retry
+    list instead of stopping the crawl.
+
+    Inputs:
+        url: (str) URL of the page
+        state: (str) one of FRONTIER_STATES
+        error: (str) why the page failed
+    '''
+    with _frontier_lock:
+        if state == 'done':
+            DONE_URLS.add(url)
+        else:
+            DONE_URLS.discard(url)
+    if _writer['queue'] is not None:
+        _writer['queue'].put(('state', url, state, error))
+
+
+def crawl_transcript(transcript_text, begin_flag, end_flag, episode_id_start,
+            speaker_id_start, phrase_id_start, db_cursor):
+    '''
+    Given the text of a transcript, load its information into the database.
+
+    Inputs:
+        transcript_text: raw transcript text
+        begin_flag: regular expression indicating beginning of speech
+        end_flag: regular expression indicating end of speech
+        episode_id_start: (int) current episode ID
+        speaker_id_start: (int) current speaker ID
+        phrase_id_start: (int) current text clip ID
+        db_cursor: cursor to perform SQL statements on the database
+
+    Outputs: updated speaker_id and phrase_id after processing transcript
+
+    '''
+    split_text = split_transcript(transcript_text, begin_flag, end_flag)
+
+    return load_transcript(split_text, episode_id_start, speaker_id_start,
+                           phrase_id_start, db_cursor)
+
+
+def configure_parser(parser=None, parity=None):
+    '''
+    Choose the parser for transcript pages. The parse pool is restarted so
+    its workers pick up the change.
+
+    Inputs:
+        parser: (str) "lxml", "html.parser" or "html5lib"
+        parity: (bool) also parse every transcript with html5lib and check
+            that both parsers extract the same data
+    '''
+    if parser is not None:
+        PARSER_CONFIG['parser'] = parser
+    if parity is not None:
+        PARSER_CONFIG['parity'] = parity
+    close_parse_pool()
+
+
+class StrainerUnion(bs4.SoupStrainer):
+    '''
+    SoupStrainer keeping the parts of a page that any of several strainers
+    keeps, so the page is parsed once for all of them and the parts stay in
+    document order. Only meant for parse_only (see make_soup).
+    '''
+
+    def __init__(self, strainers):
+        super().__init__()
+        self.strainers = strainers
+
+    def search_tag(self, *args, **kwargs):
+        '''
+        Match a tag being parsed against each strainer (beautifulsoup4
+        before 4.13).
+        '''
+        for strainer in self.strainers:
+            found = strainer.search_tag(*args, **kwargs)
+            if found:
+                return found
+
+        return None
+
+    def allow_tag_creation(self, nsprefix, name, attrs):
+        '''
+        Keep a tag being parsed if any strainer keeps it (beautifulsoup4
+        4.13 and later).
+        '''
+        return any(strainer.allow_tag_creation(nsprefix, name, attrs)
+                   for strainer in self.strainers)
+
+    def allow_string_creation(self, string):
+        '''
+        Keep a string outside the kept tags if any strainer keeps it
+        (beautifulsoup4 4.13 and later).
+        '''
+        return any(strainer.allow_string_creation(string)
+                   for strainer in self.strainers)
+
+
+def make_soup(page_text, strainers=None):
+    '''
+    Parse a page with the configured parser.
+
+    Inputs:
+        page_text: (str) HTML of the page
+        strainers: list of bs4.SoupStrainer objects naming the only parts of
+            the page that are needed. Ignored by html5lib, which always
+            builds the whole tree.
+
+    Outputs: BeautifulSoup object
+    '''
+    parser = PARSER_CONFIG['parser']
+    if parser == 'html5lib' or not strainers:
+        return bs4.BeautifulSoup(page_text, parser)
+
+    strainer = strainers[0]
+    if len(strainers) > 1:
+        strainer = StrainerUnion(strainers)
+
+    return bs4.BeautifulSoup(page_text, parser, parse_only=strainer)
+
+
+def check_parser_parity(page_text, parse_function, *args):
+    '''
+    Run a parse function with the configured parser and again with html5lib
+    on the whole page, and check that both extract the same data.
+
+    Inputs:
+        page_text: (str) HTML of the page
+        parse_function: parse function that builds its soup with make_soup
+        args: extra arguments passed to parse_function
+
+    Outputs: the html5lib result
+    '''
+    try:
+        fast_result = parse_function(page_text, *args)
+    except Exception as e:
+        fast_result = e
+
+    parser = PARSER_CONFIG['parser']
+    PARSER_CONFIG['parser'] = 'html5lib'
+    try:
+        reference_result = parse_function(page_text, *args)
+    finally:
+        PARSER_CONFIG['parser'] = parser
+
+    assert fast_result == reference_result, \
+        "%s and html5lib disagree: %r != %r" % (parser, fast_result,
+                                                reference_result)
+
+    return reference_result
+
+
+def get_parse_pool():
+    '''
+    Return the shared pool of parse processes, creating it if needed.
+    Returns None when PARSE_WORKERS is 0.
+    '''
+    global _parse_pool
+
+    with _parse_pool_lock:
+        if _parse_pool is None and PARSE_WORKERS > 0:
+            _parse_pool = multiprocessing.Pool(PARSE_WORKERS)
+
+    return _parse_pool
+
+
+def close_parse_pool():
+    '''
+    Shut down the shared pool of parse processes.
+    '''
+    global _parse_pool
+
+    if _parse_pool is not None:
+        _parse_pool.close()
+        _parse_pool.join()
+        _parse_pool = None
+
+
+def get_parse_error(parse_error):
+    '''
+    Describe an error raised while parsing a page, for the crawl frontier.
+    Parser mismatches in parity mode are raised again to stop the crawl.
+    '''
+    if isinstance(parse_error, AssertionError) and PARSER_CONFIG['parity']:
+        raise parse_error
+
+    return repr(parse_error)
+
+
+def parse_responses(parse_function, responses, *args):
+    '''
+    Parse fetched pages in the parse pool. Each page is handed to a worker
+    as soon as it has been fetched, so parsing overlaps with the remaining
+    downloads; results are yielded in the order of responses.
+
+    Inputs:
+        parse_function: module-level function taking the page HTML and
+            args and returning plain data (no soup objects)
+        responses: iterable of (key, request object or None) tuples, such
+            as the generator returned by get_requests
+        args: extra arguments passed to parse_function
+
+    Outputs:
+        generator of (key, parse_function result or None) tuples, with None
+        for pages that could not be fetched or parsed. Those pages are
+        marked failed in the crawl frontier (keys are their URLs); in parity
+        mode a parser mismatch still stops the crawl.
+    '''
+    pool = get_parse_pool()
+    network_name, show_name = get_crawl_context()
+    if PARSER_CONFIG['parity']:
+        args = (parse_function,) + args
+        parse_function = check_parser_parity
+    args = (parse_function,) + args
+    parse_function = timed_parse
+
+    results = []
+    for key, r in responses:
+        if r is None:
+            results.append((key, None, "page could not be fetched"))
+        elif pool is None:
+            try:
+                results.append((key, parse_function(r.text, *args), None))
+            except Exception as parse_error:
+                results.append((key, None, get_parse_error(parse_error)))
+        else:
+            results.append((key, pool.apply_async(parse_function,
+                                                  (r.text,) + args), None))
+
+    for key, result, error in results:
+        if result is not None and pool is not None:
+            try:
+                result = result.get()
+            except Exception as parse_error:
+                result, error = None, get_parse_error(parse_error)
+        if error is not None:
+            print("FAILED TO PARSE", key, error)
+            mark_url(key, 'failed', error)
+        else:
+            result, stage_times = result
+            for stage, seconds in stage_times.items():
+                record_metric(network_name, show_name, stage, seconds)
+        yield key, result
+
+
+def configure_session(pool_connections=None, pool_maxsize=None,
+                      connect_timeout=None, read_timeout=None):
+    '''
+    Change the settings of the shared HTTP client. The current client (if
+    any) is closed and a new one is created on the next request.
+
+    Inputs:
+        pool_connections: (int) number of hosts to keep connection pools for
+        pool_maxsize: (int) number of keep-alive connections per host
+        connect_timeout: (float) seconds to wait for a connection
+        read_timeout: (float) seconds to wait between bytes of the response
+    '''
+    global _session
+
+    if pool_connections is not None:
+        SESSION_CONFIG['pool_connections'] = pool_connections
+    if pool_maxsize is not None:
+        SESSION_CONFIG['pool_maxsize'] = pool_maxsize
+    connect, read = SESSION_CONFIG['timeout']
+    if connect_timeout is not None:
+        connect = connect_timeout
+    if read_timeout is not None:
+        read = read_timeout
+    SESSION_CONFIG['timeout'] = (connect, read)
+
+    if _session is not None:
+        _session.close()
+        _session = None
+
+
+def get_session():
+    '''
+    Return the shared HTTP client, creating it if needed. Connections are
+    pooled per host and kept alive between requests, so repeated requests
+    to the same network skip the TCP and TLS handshakes. Gzip responses are
+    decoded transparently.
+    '''
+    global _session
+
+    if _session is None:
+        session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(\
+            pool_connections=SESSION_CONFIG['pool_connections'],
+            pool_maxsize=SESSION_CONFIG['pool_maxsize'])
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        session.headers.update(REQUEST_HEADERS)
+        _session = session
+
+    return _session
+
+
+def configure_rate_limit(rate=None, burst=None, max_retries=None):
+    '''
+    Change the per-host request rate and the number of retries.
+
+    Inputs:
+        rate: (float) requests per second allowed per host
+        burst: (int) number of requests a host may receive back to back
+        max_retries: (int) number of times to retry a throttled or failed
+            request
+    '''
+    if rate is not None:
+        RATE_CONFIG['rate'] = rate
+    if burst is not None:
+        RATE_CONFIG['burst'] = burst
+    if max_retries is not None:
+        RATE_CONFIG['max_retries'] = max_retries
+
+
+def get_host_stats(host):
+    '''
+    Return the limiter state and counters of a host, creating them on first
+    use.
+    '''
+    with _host_lock:
+        if host not in HOST_STATS:
+            HOST_STATS[host] = {'condition': threading.Condition(),
+                                'tokens': RATE_CONFIG['burst'],
+                                'refilled': time.time(),
+                                'paused_until': 0,
+                                'concurrency': INITIAL_CONCURRENCY,
+                                'in_flight': 0,
+                                'requests': 0,
+                                'retries': 0,
+                                'errors': 0,
+                                'failed_urls': [],
+                                'latencies': []}
+        return HOST_STATS[host]
+
+
+def acquire_host(host):
+    '''
+    Block until a request to host is allowed: the host is under its
+    concurrency limit, is not paused by a Retry-After, and has a token.
+    '''
+    stats = get_host_stats(host)
+    with stats['condition']:
+        while True:
+            now = time.time()
+            stats['tokens'] = min(RATE_CONFIG['burst'], stats['tokens'] +
+                (now - stats['refilled']) * RATE_CONFIG['rate'])
+            stats['refilled'] = now
+
+            if stats['in_flight'] >= max(1, int(stats['concurrency'])):
+                stats['condition'].wait()
+            elif now < stats['paused_until']:
+                stats['condition'].wait(stats['paused_until'] - now)
+            elif stats['tokens'] < 1:
+                stats['condition'].wait((1 - stats['tokens']) /
+                                        RATE_CONFIG['rate'])
+            else:
+                stats['tokens'] -= 1
+                stats['in_flight'] += 1
+                return
+
+
+def release_host(host, latency, throttled, retry_after=None):
+    '''
+    Record the outcome of a request to host and adjust its concurrency limit
+    (additive increase on success, multiplicative decrease when throttled).
+
+    Inputs:
+        host: host name
+        latency: (float) seconds the request took
+        throttled: (bool) True if the host answered 429 or 5xx, or the
+            request failed or timed out
+        retry_after: (float) seconds the host asked us to wait, if any
+    '''
+    stats = get_host_stats(host)
+    with stats['condition']:
+        stats['in_flight'] -= 1
+        stats['requests'] += 1
+        stats['latencies'].append(latency)
+        if throttled:
+            stats['errors'] += 1
+            stats['concurrency'] = max(1, stats['concurrency'] / 2)
+        else:
+            stats['concurrency'] = min(SESSION_CONFIG['pool_maxsize'],
+                stats['concurrency'] + 1 / stats['concurrency'])
+        if retry_after:
+            stats['paused_until'] = max(stats['paused_until'],
+                                        time.time() + retry_after)
+        stats['condition'].notify_all()
+
+
+def get_retry_after(r):
+    '''
+    Return the number of seconds in a response's Retry-After header, or None
+    if there is no usable header.
+    '''
+    if r is None or 'Retry-After' not in r.headers:
+        return None
+    try:
+        return float(r.headers['Retry-After'])
+    except ValueError:
+        return None
+
+
+def fetch_with_retries(url, headers, stream=False):
+    '''
+    Fetch a URL through the shared client, respecting the host's rate and
+    concurrency limits. Requests that time out, fail to connect, or get a
+    429 or 5xx answer are retried with jittered exponential backoff.
+
+    Inputs:
+        url: absolute URL
+        headers: dictionary of extra request headers
+        stream: (bool) return once the headers have arrived, leaving the
+            body to be read (see iter_page_text)
+
+    Outputs:
+        request object, or None if every attempt failed
+    '''
+    host = urllib.parse.urlparse(url).netloc
+
+    for attempt in range(RATE_CONFIG['max_retries'] + 1):
+        acquire_host(host)
+        start = time.time()
+        try:
+            r = get_session().get(url, headers=headers, stream=stream,
+                                  timeout=SESSION_CONFIG['timeout'])
+        except requests.exceptions.RequestException:
+            r = None
+        throttled = r is None or r.status_code == 429 or r.status_code >= 500
+        retry_after = get_retry_after(r)
+        release_host(host, time.time() - start, throttled, retry_after)
+
+        if not throttled:
+            return r
+        if r is not None:
+            r.close()
+
+        if attempt < RATE_CONFIG['max_retries']:
+            backoff = min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt)
+            time.sleep(retry_after or random.uniform(0, backoff))
+            stats = get_host_stats(host)
+            with stats['condition']:
+                stats['retries'] += 1
+
+    stats = get_host_stats(host)
+    with stats['condition']:
+        stats['failed_urls'].append(url)
+    print("FAILED AFTER RETRIES", url)
+
+    return None
+
+
+def get_host_summary():
+    '''
+    Summarize requests made to each host so far.
+
+    Outputs: dictionary mapping host names to dictionaries of request,
+        retry, error and failure counts, latency percentiles (seconds), and
+        the final concurrency limit
+    '''
+    summary = {}
+    for host, stats in sorted(HOST_STATS.items()):
+        latencies = sorted(stats['latencies'])
+        host_summary = {'requests': stats['requests'],
+                        'retries': stats['retries'],
+                        'errors': stats['errors'],
+                        'failed': len(stats['failed_urls']),
+                        'concurrency': round(stats['concurrency'], 2)}
+        if latencies:
+            host_summary['latency_mean'] = statistics.mean(latencies)
+            host_summary['latency_p50'] = latencies[len(latencies) // 2]
+            host_summary['latency_p95'] = \
+                latencies[int(len(latencies) * 0.95)]
+            host_summary['latency_max'] = latencies[-1]
+        summary[host] = host_summary
+
+    return summary
+
+
+def print_host_summary():
+    '''
+    Print the per-host request summary at the end of a run.
+    '''
+    for host, host_summary in get_host_summary().items():
+        print(host)
+        for key, value in host_summary.items():
+            if isinstance(value, float):
+                value = round(value, 3)
+            print("   ", key, value)
+
+
+def set_crawl_context(network_name, show_name=None):
+    '''
+    Credit the work of the calling thread (and the pages it fetches and
+    parses) to a network and show in the crawl metrics.
+    '''
+    _crawl_context.network_name = network_name
+    _crawl_context.show_name = show_name
+
+
+def get_crawl_context():
+    '''
+    Return the (network_name, show_name) the calling thread's work is
+    credited to, (None, None) if not set.
+    '''
+    return (getattr(_crawl_context, 'network_name', None),
+            getattr(_crawl_context, 'show_name', None))
+
+
+def run_in_context(network_name, show_name, function, *args):
+    '''
+    Call function(*args) with the calling thread's crawl context set to
+    network_name and show_name, then put the previous context back.
+    '''
+    previous_context = get_crawl_context()
+    set_crawl_context(network_name, show_name)
+    try:
+        return function(*args)
+    finally:
+        set_crawl_context(*previous_context)
+
+
+def reset_metrics():
+    '''
+    Clear the crawl metrics and restart the run clock.
+    '''
+    with _metrics['lock']:
+        METRICS.clear()
+        _metrics['started'] = time.time()
+
+
+def new_metrics_entry():
+    '''
+    Return empty metrics for one network and show.
+    '''
+    entry = {stage: {'seconds': 0.0, 'count': 0} for stage in METRIC_STAGES}
+    entry['pages'] = 0
+    entry['bytes'] = 0
+    entry['events'] = {event: 0 for event in METRIC_EVENTS}
+
+    return entry
+
+
+def record_metric(network_name, show_name, stage, seconds, pages=0,
+                  nbytes=0):
+    '''
+    Add time spent in a stage (and pages and bytes fetched) to the crawl
+    metrics of a network and show.
+
+    Inputs:
+        network_name, show_name: (str) what the work is credited to (None
+            if unknown)
+        stage: (str) one of METRIC_STAGES
+        seconds: (float) time spent
+        pages: (int) pages fetched
+        nbytes: (int) bytes of page bodies fetched
+    '''
+    with _metrics['lock']:
+        entry = METRICS.setdefault((network_name, show_name),
+                                   new_metrics_entry())
+        entry[stage]['seconds'] += seconds
+        entry[stage]['count'] += 1
+        entry['pages'] += pages
+        entry['bytes'] += nbytes
+
+
+def record_event(network_name, show_name, event, url, detail):
+    '''
+    Print a transcript the writer left out and count it in the crawl metrics
+    of its network and show.
+
+    Inputs:
+        network_name, show_name: (str) what the transcript is credited to
+        event: (str) one of METRIC_EVENTS
+        url: (str) URL of the transcript
+        detail: (str) why it was left out
+    '''
+    print(METRIC_EVENTS[event], url, detail)
+    with _metrics['lock']:
+        entry = METRICS.setdefault((network_name, show_name),
+                                   new_metrics_entry())
+        entry['events'][event] += 1
+
+
+def add_stage_time(stage, seconds):
+    '''
+    Add time spent in a stage to the parse timed by timed_parse in this
+    thread, if any.
+    '''
+    stage_times = getattr(_stage_times, 'times', None)
+    if stage_times is not None:
+        stage_times[stage] = stage_times.get(stage, 0) + seconds
+
+
+def timed_parse(page_text, parse_function, *args):
+    '''
+    Run a parse function and time it. Runs in the parse pool, so the times
+    are sent back with the result for parse_responses to record.
+
+    Outputs: parse_function result, dictionary mapping stages to seconds
+        (parse, and the stages timed inside it such as clean)
+    '''
+    _stage_times.times = {}
+    parse_start = time.perf_counter()
+    try:
+        result = parse_function(page_text, *args)
+        stage_times = _stage_times.times
+        stage_times['parse'] = time.perf_counter() - parse_start - \
+            sum(stage_times.values())
+    finally:
+        _stage_times.times = None
+
+    return result, stage_times
+
+
+def summarize_metrics(entries, elapsed):
+    '''
+    Add up metrics entries.
+
+    Inputs:
+        entries: list of dictionaries created by new_metrics_entry
+        elapsed: (float) seconds the crawl has been running
+
+    Outputs: dictionary with the seconds and count of each stage, pages,
+        bytes, the count of each of METRIC_EVENTS, pages per second of crawl
+        time, and the seconds spent on each resource in METRIC_RESOURCES
+    '''
+    summary = new_metrics_entry()
+    for entry in entries:
+        for stage in METRIC_STAGES:
+            summary[stage]['seconds'] += entry[stage]['seconds']
+            summary[stage]['count'] += entry[stage]['count']
+        summary['pages'] += entry['pages']
+        summary['bytes'] += entry['bytes']
+        for event in METRIC_EVENTS:
+            summary['events'][event] += entry['events'][event]
+
+    summary['pages_per_second'] = summary['pages'] / elapsed if elapsed else 0
+    summary['resources'] = {resource: sum([summary[stage]['seconds']
+                                           for stage in stages])
+                            for resource, stages in METRIC_RESOURCES.items()}
+
+    return summary
+
+
+def get_run_report():
+    '''
+    Summarize the crawl metrics so far.
+
+    Outputs: dictionary with the start time and length of the run, a total
+        summary (see summarize_metrics), one per network with one per show
+        in it, and the per-host request summary. Work that could not be
+        credited to a network or show is listed under "(none)".
+    '''
+    with _metrics['lock']:
+        metrics = {key: {stage: dict(value) if isinstance(value, dict)
+                         else value for stage, value in entry.items()}
+                   for key, entry in METRICS.items()}
+        started = _metrics['started']
+    elapsed = time.time() - started
+
+    networks = {}
+    for (network_name, show_name), entry in metrics.items():
+        networks.setdefault(network_name or '(none)', {})[\
+            show_name or '(none)'] = entry
+
+    report = {'started': datetime.datetime.fromtimestamp(started).isoformat(),
+              'elapsed_seconds': elapsed,
+              'total': summarize_metrics(list(metrics.values()), elapsed),
+              'networks': {},
+              'hosts': get_host_summary()}
+    for network_name, shows in sorted(networks.items()):
+        report['networks'][network_name] = summarize_metrics(\
+            list(shows.values()), elapsed)
+        report['networks'][network_name]['shows'] = {show_name:
+            summarize_metrics([entry], elapsed)
+            for show_name, entry in sorted(shows.items())}
+
+    return report
+
+
+def write_run_report(filename):
+    '''
+    Write the run report (see get_run_report) to a JSON file.
+    '''
+    with open(filename, 'w') as f:
+        json.dump(get_run_report(), f, indent=2)
+
+
+def get_metrics_text():
+    '''
+    Return the crawl metrics so far as plain text, one value per line:
+    name{network="...",show="..."} value.
+    '''
+    with _metrics['lock']:
+        metrics = sorted(METRICS.items(), key=lambda item: (str(item[0][0]),
+                                                            str(item[0][1])))
+        lines = ['crawl_elapsed_seconds {:.3f}'.format(\
+            time.time() - _metrics['started'])]
+        for (network_name, show_name), entry in metrics:
+            labels = 'network="{}",show="{}"'.format(\
+                *[str(name or '').replace('\\', '\\\\').replace('"', '\\"')
+                  for name in (network_name, show_name)])
+            for stage in METRIC_STAGES:
+                lines.append('crawl_stage_seconds{{{},stage="{}"}} {:.6f}'\
+                    .format(labels, stage, entry[stage]['seconds']))
+                lines.append('crawl_stage_count{{{},stage="{}"}} {}'.format(\
+                    labels, stage, entry[stage]['count']))
+            lines.append('crawl_pages{{{}}} {}'.format(labels, entry['pages']))
+            lines.append('crawl_bytes{{{}}} {}'.format(labels, entry['bytes']))
+            for event in METRIC_EVENTS:
+                lines.append('crawl_events{{{},event="{}"}} {}'.format(\
+                    labels, event, entry['events'][event]))
+
+    return '\n'.join(lines) + '\n'
+
+
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+    '''
+    Answer every GET with the crawl metrics as plain text.
+    '''
+
+    def do_GET(self):
+        body = get_metrics_text().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_metrics_server(port, host='127.0.0.1'):
+    '''
+    Serve the crawl metrics (see get_metrics_text) over HTTP on a background
+    thread until stop_metrics_server is called.
+    '''
+    server = http.server.ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='metrics',
+                     daemon=True).start()
+    _metrics['server'] = server
+
+
+def stop_metrics_server():
+    '''
+    Stop the metrics server started by start_metrics_server, if any.
+    '''
+    if _metrics['server'] is not None:
+        _metrics['server'].shutdown()
+        _metrics['server'].server_close()
+        _metrics['server'] = None
+
+
+def configure_cache(mode=None, directory=CACHE_DIR, max_age=None):
+    '''
+    Turn the on-disk page cache on or off.
+
+    Inputs:
+        mode: one of CACHE_MODES, or None to turn the cache off
+        directory: (str) folder in which to store cached pages
+        max_age: (float) age in seconds after which a cached page is
+            fetched again (only used by "refresh-older-than")
+    '''
+    assert mode is None or mode in CACHE_MODES, "unknown cache mode %r" % mode
+    assert mode != 'refresh-older-than' or max_age is not None, \
+        "refresh-older-than needs a max_age"
+
+    CACHE_CONFIG['mode'] = mode
+    CACHE_CONFIG['directory'] = directory
+    CACHE_CONFIG['max_age'] = max_age
+
+
+def get_cache_path(url):
+    '''
+    Return the path (without extension) under which a URL is cached.
+    '''
+    key = hashlib.sha1(url.encode('utf-8')).hexdigest()
+    return os.path.join(CACHE_CONFIG['directory'], key[:2], key)
+
+
+def read_cache_meta(url):
+    '''
+    Return the stored metadata for a cached URL, or None if it is not cached.
+    '''
+    path = get_cache_path(url)
+    if not (os.path.exists(path + '.json') and os.path.exists(path + '.gz')):
+        return None
+    with open(path + '.json') as f:
+        return json.load(f)
+
+
+def read_cache(url, max_age=None):
+    '''
+    Rebuild a response object from the page cache.
+
+    Inputs:
+        url: absolute URL
+        max_age: (float) if given, ignore pages fetched more than max_age
+            seconds ago
+
+    Outputs:
+        request object or None
+    '''
+    meta = read_cache_meta(url)
+    if meta is None:
+        return None
+    if max_age is not None and time.time() - meta['fetched'] > max_age:
+        return None
+
+    with gzip.open(get_cache_path(url) + '.gz', 'rb') as f:
+        content = f.read()
+
+    r = requests.models.Response()
+    r.url = meta['url']
+    r.status_code = meta['status']
+    r.encoding = meta['encoding']
+    r.headers = requests.structures.CaseInsensitiveDict(meta['headers'])
+    r._content = content
+    r.not_modified = False
+    r.streamed = False
+
+    return r
+
+
+def write_cache(url, r):
+    '''
+    Store a response in the page cache. Files are written under a temporary
+    name and then renamed, so an interrupted run never leaves a partial page.
+
+    Inputs:
+        url: URL that was requested
+        r: request object
+    '''
+    path = get_cache_path(url)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    meta = {'url': r.url,
+            'status': r.status_code,
+            'encoding': r.encoding,
+            'headers': dict(r.headers),
+            'fetched': time.time()}
+
+    with gzip.open(path + '.gz.tmp', 'wb') as f:
+        f.write(r.content)
+    with open(path + '.json.tmp', 'w') as f:
+        json.dump(meta, f)
+    os.replace(path + '.gz.tmp', path + '.gz')
+    os.replace(path + '.json.tmp', path + '.json')
+
+
+def archive_transcripts(network_name, show_name, urls, listing_url=None,
+                        headlines=None):
+    '''
+    Append transcripts found in a show's listing to the transcript archive
+    (ARCHIVE_FILENAME in the cache folder). Nothing is written unless the
+    page cache is on and can fetch pages ("record" or "refresh-older-than").
+
+    Inputs:
+        network_name: (str) name of network
+        show_name: (str) name of show
+        urls: list of transcript URLs
+        listing_url: (str) URL of the show listing they were found on
+        headlines: list of their headlines in the listing, or None
+    '''
+    if CACHE_CONFIG['mode'] not in ['record', 'refresh-older-than'] or \
+            not urls:
+        return
+
+    if headlines is None:
+        headlines = [None] * len(urls)
+    archived = time.time()
+    lines = [json.dumps({'network': network_name,
+                         'show': show_name,
+                         'listing': listing_url,
+                         'url': url,
+                         'headline': headline,
+                         'archived': archived}) + '\n'
+             for url, headline in zip(urls, headlines)]
+
+    os.makedirs(CACHE_CONFIG['directory'], exist_ok=True)
+    with _archive_lock:
+        with open(os.path.join(CACHE_CONFIG['directory'], ARCHIVE_FILENAME),
+                  'a', encoding='utf-8') as f:
+            f.writelines(lines)
+
+
+def read_archive(directory=CACHE_DIR):
+    '''
+    Read the transcript archive of a page cache folder. A transcript logged
+    more than once (by later crawls) keeps its first entry.
+
+    Outputs: list of dictionaries with the network, show, listing, url and
+        headline of each archived transcript, in the order they were logged
+    '''
+    entries = {}
+    with open(os.path.join(directory, ARCHIVE_FILENAME),
+              encoding='utf-8') as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                # Last line of a crawl that was killed while logging
+                continue
+            entries.setdefault(entry['url'], entry)
+
+    return list(entries.values())
+
+
+def get_validators(url):
+    '''
+    Return the conditional request headers (If-None-Match and
+    If-Modified-Since) for a URL, built from the ETag and Last-Modified
+    headers stored with it in the page cache or, if it is not cached, in
+    VALIDATORS. Returns an empty dictionary if neither has validators for it.
+    '''
+    meta = read_cache_meta(url) if CACHE_CONFIG['mode'] is not None else None
+    if meta is not None:
+        headers = requests.structures.CaseInsensitiveDict(meta['headers'])
+        etag, last_modified = (headers.get('ETag'),
+                               headers.get('Last-Modified'))
+    else:
+        with _validators_lock:
+            etag, last_modified = VALIDATORS.get(url, (None, None))
+
+    validators = {}
+    if etag is not None:
+        validators['If-None-Match'] = etag
+    if last_modified is not None:
+        validators['If-Modified-Since'] = last_modified
+
+    return validators
+
+
+def load_validators(db_cursor):
+    '''
+    Read the validators of every finished show listing from the
+    crawl_validator table into VALIDATORS.
+    '''
+    with _validators_lock:
+        VALIDATORS.clear()
+        for url, etag, last_modified, _ in db_cursor.execute(\
+                'SELECT * FROM crawl_validator').fetchall():
+            VALIDATORS[url] = (etag, last_modified)
+
+
+def save_validators(url, r, urls=()):
+    '''
+    Keep the validators a show listing was served with, once the crawl of
+    its show has finished, for the next incremental crawl to send (see
+    get_request and load_validators). Nothing is kept for a listing served
+    without validators, or if any of the transcripts the crawl took from it
+    did not end up done: the next crawl has to read the listing again to
+    retry them.
+
+    Inputs:
+        url: URL of the listing
+        r: request object the listing was read from
+        urls: list of the transcript URLs the crawl took from the listing
+    '''
+    etag, last_modified = r.headers.get('ETag'), r.headers.get('Last-Modified')
+    if etag is None and last_modified is None:
+        return
+
+    # VALIDATORS is left as the crawl loaded it: the listings the crawl
+    # still has to read are sent the validators it started with
+    if _writer['queue'] is not None:
+        _writer['queue'].put(('validator', url, etag, last_modified,
+                              list(urls)))
+
+
+def touch_cache(url, r):
+    '''
+    Mark a cached page as fetched now after the server answered 304 Not
+    Modified, keeping any new validators the server sent with the answer.
+
+    Inputs:
+        url: URL that was requested
+        r: the 304 request object
+    '''
+    path = get_cache_path(url)
+    meta = read_cache_meta(url)
+    for header in ['ETag', 'Last-Modified']:
+        if header in r.headers:
+            meta['headers'][header] = r.headers[header]
+    meta['fetched'] = time.time()
+
+    with open(path + '.json.tmp', 'w') as f:
+        json.dump(meta, f)
+    os.replace(path + '.json.tmp', path + '.json')
+
+
+## Code below is provided from pa1 in util.
+
+def get_request(url, revalidate=False, stream=False):
+    '''
+    Open a connection to the specified URL and if successful
+    read the data.
+
+    Inputs:
+        url: must be an absolute URL
+        revalidate: (bool) send the validators stored for the page (see
+            get_validators). When the server answers 304 Not Modified, the
+            cached body is reused. Validators from VALIDATORS (kept for show
+            listings whose show was crawled in full, see save_validators)
+            get a response with no body instead, and the caller skips the
+            show. If the cached copy the validators were read from has gone,
+            the page is fetched again without them.
+        stream: (bool) do not read the body yet; read it with
+            iter_page_text. Only used while the page cache is off, since
+            the cache needs whole pages.
+
+    Outputs:
+        request object or None. The object's not_modified attribute is True
+        when the server answered 304 to the validators, and its streamed
+        attribute is True if the body has not been read.
+
+    Examples:
+        get_request("http://www.cs.uchicago.edu")
+    '''
+
+    if not is_absolute_url(url):
+        return None
+
+    mode = CACHE_CONFIG['mode']
+    if mode == 'replay':
+        return read_cache(url)
+    if mode == 'refresh-older-than':
+        r = read_cache(url, CACHE_CONFIG['max_age'])
+        if r is not None:
+            return r
+
+    headers = {}
+    cached = False
+    if revalidate:
+        cached = mode is not None and read_cache_meta(url) is not None
+        headers = get_validators(url)
+
+    stream = stream and mode is None
+    r = fetch_with_retries(url, headers, stream)
+    if r is not None and r.status_code == 304 and headers:
+        r.close()
+        if not cached:
+            r._content = b''
+            r.not_modified = True
+            r.streamed = False
+            return r
+        if read_cache_meta(url) is not None:
+            touch_cache(url, r)
+            r = read_cache(url)
+            r.not_modified = True
+            return r
+        r = fetch_with_retries(url, {}, stream)
+
+    if r is not None and r.status_code in [403, 404]:
+        r.close()
+        r = None
+    elif r is not None:
+        r.not_modified = False
+        r.streamed = stream
+
+    # Error pages are not cached, so they are fetched again next time
+    if r is not None and mode is not None and r.status_code == 200:
+        write_cache(url, r)
+
+    return r
+
+
+def configure_scheduler(workers=None, per_host=None):
+    '''
+    Change the number of fetch threads and the number of requests allowed
+    in flight per host. More fetch threads are started if needed; extra ones
+    are not stopped.
+    '''
+    with _scheduler['condition']:
+        if workers is not None:
+            SCHEDULER_CONFIG['workers'] = workers
+        if per_host is not None:
+            SCHEDULER_CONFIG['per_host'] = per_host
+        _scheduler['condition'].notify_all()
+
+
+def get_free_slots(host):
+    '''
+    Return the number of requests the scheduler may still send to host right
+    now: none while the host is paused by a Retry-After, otherwise up to its
+    adaptive concurrency limit (capped by the per-host setting). Called with
+    the scheduler's condition held.
+    '''
+    limit = SCHEDULER_CONFIG['per_host']
+    if CACHE_CONFIG['mode'] != 'replay':
+        stats = get_host_stats(host)
+        if time.time() < stats['paused_until']:
+            return 0
+        limit = min(limit, max(1, int(stats['concurrency'])))
+
+    return limit - _scheduler['scheduled'].get(host, 0)
+
+
+def next_scheduled_request():
+    '''
+    Wait for and take the next request to send: of the hosts with a free
+    slot, the one whose best queued request (listings first, then oldest)
+    comes first.
+
+    Outputs: host, (url, revalidate, stream, future, crawl context) tuple
+    '''
+    condition = _scheduler['condition']
+    with condition:
+        while True:
+            best_host = None
+            for host, host_queue in _scheduler['queues'].items():
+                if host_queue and get_free_slots(host) > 0 and \
+                        (best_host is None or
+                         host_queue[0] < _scheduler['queues'][best_host][0]):
+                    best_host = host
+
+            if best_host is not None:
+                _, _, request = heapq.heappop(_scheduler['queues'][best_host])
+                _scheduler['scheduled'][best_host] = \
+                    _scheduler['scheduled'].get(best_host, 0) + 1
+                return best_host, request
+
+            # Hosts can get a free slot without notice (a pause running out,
+            # the adaptive limit growing), so look again after a short wait
+            # while anything is queued
+            if any(_scheduler['queues'].values()):
+                condition.wait(0.1)
+            else:
+                condition.wait()
+
+
+def run_scheduler():
+    '''
+    Body of a fetch thread: send scheduled requests one at a time and hand
+    each response to the request's future.
+    '''
+    while True:
+        host, (url, revalidate, stream, future, context) = \
+            next_scheduled_request()
+        try:
+            if future.set_running_or_notify_cancel():
+                fetch_start = time.perf_counter()
+                try:
+                    r = get_request(url, revalidate, stream)
+                except Exception as error:
+                    future.set_exception(error)
+                else:
+                    # The bytes of streamed pages are counted as they are
+                    # read, by iter_page_text
+                    record_metric(*context, 'fetch',
+                        time.perf_counter() - fetch_start,
+                        pages=int(r is not None),
+                        nbytes=0 if r is None or r.streamed else \
+                            len(r.content))
+                    future.set_result(r)
+        finally:
+            with _scheduler['condition']:
+                _scheduler['scheduled'][host] -= 1
+                _scheduler['condition'].notify_all()
+
+
+def schedule_request(url, kind='transcript', revalidate=False,
+                     stream=False):
+    '''
+    Queue a page to be fetched by the scheduler. Its fetch is credited to
+    the calling thread's crawl context. A streamed page only holds its
+    host's slot until its headers arrive.
+
+    Inputs:
+        url: absolute URL
+        kind: (str) "listing" or "transcript" (see REQUEST_PRIORITIES)
+        revalidate, stream: (bool) passed on to get_request
+
+    Outputs:
+        concurrent.futures.Future holding the request object or None
+    '''
+    future = concurrent.futures.Future()
+    host = urllib.parse.urlparse(url).netloc
+
+    with _scheduler['condition']:
+        while len(_scheduler['threads']) < SCHEDULER_CONFIG['workers']:
+            thread = threading.Thread(target=run_scheduler, daemon=True,
+                name='fetch-{}'.format(len(_scheduler['threads'])))
+            thread.start()
+            _scheduler['threads'].append(thread)
+
+        _scheduler['sequence'] += 1
+        heapq.heappush(_scheduler['queues'].setdefault(host, []),
+                       (REQUEST_PRIORITIES[kind], _scheduler['sequence'],
+                        (url, revalidate, stream, future,
+                         get_crawl_context())))
+        _scheduler['condition'].notify()
+
+    return future
+
+
+def configure_shows(shows=None):
+    '''
+    Only crawl some shows.
+
+    Inputs:
+        shows: list of show titles as the networks' show indexes give
+            them, or None to crawl every show
+    '''
+    SHOW_CONFIG['shows'] = None if shows is None else set(shows)
+
+
+def is_show_selected(title):
+    '''
+    Is a show (by its title in the network's show index) to be crawled?
+    '''
+    return SHOW_CONFIG['shows'] is None or title in SHOW_CONFIG['shows']
+
+
+def configure_catalog(ttl=None, refresh=None):
+    '''
+    Set how long the show catalog is used before the show indexes are read
+    again.
+
+    Inputs:
+        ttl: (float) seconds after which the catalog has expired
+        refresh: (bool) read the show indexes again even if the catalog has
+            not expired
+    '''
+    if ttl is not None:
+        CATALOG_CONFIG['ttl'] = ttl
+    if refresh is not None:
+        CATALOG_CONFIG['refresh'] = refresh
+
+
+def load_catalog(db_cursor):
+    '''
+    Read the show catalog from the crawl_catalog and crawl_discovery tables
+    into CATALOG.
+    '''
+    with _catalog_lock:
+        CATALOG.clear()
+        for starting_url, discovered in db_cursor.execute(\
+                'SELECT starting_url, discovered FROM crawl_discovery'
+                ).fetchall():
+            CATALOG[starting_url] = {'discovered': discovered, 'shows': {}}
+        for starting_url, show_name, network_name, listing_url, last_seen \
+                in db_cursor.execute('SELECT * FROM crawl_catalog').fetchall():
+            entry = CATALOG.setdefault(starting_url,
+                                       {'discovered': None, 'shows': {}})
+            entry['shows'][show_name] = (network_name, listing_url, last_seen)
+
+
+def read_catalog(starting_url):
+    '''
+    Return the shows of a network's index from the catalog, or None if they
+    have to be found on the index again: the catalog has expired (or has
+    none of the selected shows, see configure_shows) or a refresh was asked
+    for.
+
+    Outputs: list of (title, listing URL) tuples, or None
+    '''
+    if CATALOG_CONFIG['refresh']:
+        return None
+
+    now = time.time()
+    with _catalog_lock:
+        entry = CATALOG.get(starting_url)
+        if entry is None:
+            return None
+        catalog_shows = dict(entry['shows'])
+        discovered = entry['discovered']
+
+    if SHOW_CONFIG['shows'] is None:
+        if discovered is None or now - discovered > CATALOG_CONFIG['ttl']:
+            return None
+        return [(title, listing_url) for title, (_, listing_url, _)
+                in catalog_shows.items()]
+
+    shows = []
+    for title in SHOW_CONFIG['shows']:
+        if title not in catalog_shows:
+            return None
+        _, listing_url, last_seen = catalog_shows[title]
+        if now - last_seen > CATALOG_CONFIG['ttl']:
+            return None
+        shows.append((title, listing_url))
+
+    return shows
+
+
+def get_catalog_shows(network_name, starting_url, get_shows):
+    '''
+    Return a network's shows from the catalog, or find them on its index
+    and update the catalog. An index read while only some shows are
+    selected updates those shows without counting as a full read, since
+    the Fox crawler does not look up the others.
+
+    Inputs:
+        network_name: (str) name of network
+        starting_url: (str) the network's show index
+        get_shows: the crawler's function taking starting_url and returning
+            a list of (title, listing URL) tuples
+
+    Outputs: list of (title, listing URL) tuples
+    '''
+    shows = read_catalog(starting_url)
+    if shows is not None:
+        return shows
+
+    shows = get_shows(starting_url)
+    if not shows:
+        # An empty index is more likely a broken page than a network with
+        # no shows, so it is not kept
+        return shows
+
+    now = time.time()
+    complete = SHOW_CONFIG['shows'] is None
+    with _catalog_lock:
+        entry = CATALOG.setdefault(starting_url,
+                                   {'discovered': None, 'shows': {}})
+        if complete:
+            entry['discovered'] = now
+            entry['shows'].clear()
+        for title, listing_url in shows:
+            entry['shows'][title] = (network_name, listing_url, now)
+    if _writer['queue'] is not None:
+        _writer['queue'].put(('catalog', network_name, starting_url,
+                              list(shows), complete, now))
+
+    return shows
+
+
+def configure_partitions(partition=None):
+    '''
+    Split each CNN show's crawl window into partitions crawled in parallel.
+
+    Inputs:
+        partition: (str) one of PARTITIONS, or None to crawl each show's
+            window in one go
+    '''
+    if partition is not None and partition not in PARTITIONS:
+        raise ValueError("partition must be one of {}".format(PARTITIONS))
+
+    PARTITION_CONFIG['partition'] = partition
+
+
+def split_date_window(start, end, partition=None):
+    '''
+    Split a crawl window into calendar years or months.
+
+    Inputs:
+        start, end: (datetime.date) first and last air date (inclusive)
+        partition: (str) one of PARTITIONS, or None for the whole window
+
+    Outputs: list of (start, end) tuples of datetime.dates covering the
+        window, newest first (the order of the listings)
+    '''
+    if partition is None:
+        return [(start, end)]
+
+    windows = []
+    window_end = end
+    while window_end >= start:
+        if partition == 'year':
+            window_start = datetime.date(window_end.year, 1, 1)
+        else:
+            window_start = window_end.replace(day=1)
+        windows.append((max(window_start, start), window_end))
+        window_end = window_start - datetime.timedelta(days=1)
+
+    return windows
+
+
+def crawl_shows(network_name, crawl_show, starting_url, shows,
+                incremental=False, start=None, end=None, partition=None,
+                list_show=None):
+    '''
+    Crawl a network's shows, SHOW_WORKERS at a time, each in its own crawl
+    context. With a partition, each year or month of each show is crawled on
+    its own, so a backfill of many years runs SHOW_WORKERS partitions at a
+    time: each show's listing is first read once, for the whole window, with
+    list_show, and handed to the crawl of every partition. A show (or
+    partition) that fails is put on the retry list (see mark_url) and the
+    others carry on. Shows left out by configure_shows are skipped.
+
+    The writer moves a show's high-water mark as soon as one of its
+    partitions loads an episode, so every crawl is handed the marks as they
+    were before the first one started: an incremental crawl of an older
+    partition still walks down to the mark the crawl started from.
+
+    Inputs:
+        network_name: (str) name of network
+        crawl_show: function taking the network's starting URL, a show's
+            listing URL, its title, incremental, start, end and the marks
+            (see get_crawl_marks), and returning the number of episodes it
+            queued for the database
+        starting_url: (str) the network's starting URL
+        shows: list of (title, listing URL) tuples
+        incremental: (bool) passed to crawl_show
+        start, end: (datetime.date) first and last air date to crawl
+        partition: (str) one of PARTITIONS, or None
+        list_show: function taking the same arguments as crawl_show and
+            returning the request object a show's listing was read from, the
+            listing to hand to crawl_show as its last argument and the
+            transcript URLs in it, or None if the listing has not changed
+            since the last incremental crawl (see crawler_cnn.list_show).
+            Needed to partition the shows.
+
+    Outputs: (int) number of episodes queued for the database
+    '''
+    windows = split_date_window(start, end, partition)
+    marks = get_crawl_marks(network_name)
+    shows = [(title, link) for title, link in shows if is_show_selected(title)]
+    episodes_loaded = 0
+    with concurrent.futures.ThreadPoolExecutor(\
+            max_workers=SHOW_WORKERS) as executor:
+        listings = {}
+        if len(windows) > 1:
+            reads = [executor.submit(run_in_context, network_name, title,
+                                     list_show, starting_url, link, title,
+                                     incremental, start, end, marks)
+                     for title, link in shows]
+            for (title, link), read in zip(shows, reads):
+                try:
+                    listing = read.result()
+                except Exception as error:
+                    print("FAILED TO CRAWL", title, repr(error))
+                    mark_url(link, 'failed', repr(error))
+                    continue
+                if listing is not None:
+                    listings[link] = listing
+            shows = [(title, link) for title, link in shows
+                     if link in listings]
+
+        tasks = [(title, link, window_start, window_end)
+                 for title, link in shows
+                 for window_start, window_end in windows]
+        crawls = []
+        for title, link, window_start, window_end in tasks:
+            crawl_args = [starting_url, link, title, incremental,
+                          window_start, window_end, marks]
+            if link in listings:
+                crawl_args.append(listings[link][1])
+            crawls.append(executor.submit(run_in_context, network_name,
+                                          title, crawl_show, *crawl_args))
+        failed_links = set()
+        for (title, link, window_start, window_end), crawl in zip(tasks,
+                                                                  crawls):
+            try:
+                episodes_loaded += crawl.result()
+            except Exception as error:
+                print("FAILED TO CRAWL", title, window_start, window_end,
+                      repr(error))
+                mark_url(link, 'failed', repr(error))
+                failed_links.add(link)
+
+    # The partitions left the validators of the listing they shared to be
+    # kept once all of them had finished. Every show has finished too, so
+    # the transcripts of the listing another show took are done by now
+    # unless they failed.
+    for link, (transcripts_request, _, urls) in listings.items():
+        if link not in failed_links:
+            save_validators(link, transcripts_request, urls)
+
+    return episodes_loaded
+
+
+def get_listing(url, stream=False, revalidate=True):
+    '''
+    Fetch a show listing (or other index page) through the scheduler, ahead
+    of any queued transcripts.
+
+    Inputs:
+        url: absolute URL
+        stream: (bool) leave the body to be read with iter_page_text (only
+            while the page cache is off)
+        revalidate: (bool) send the page's stored validators (see
+            get_request). A show listing with validators in VALIDATORS can
+            come back as a 304 with no body, so crawl_show only revalidates
+            listings in an incremental crawl.
+
+    Outputs:
+        request object or None (see get_request)
+    '''
+    return schedule_request(url, 'listing', revalidate=revalidate,
+                            stream=stream).result()
+
+
+def iter_page_text(r, chunk_size=STREAM_CHUNK_SIZE):
+    '''
+    Yield the body of a fetched page as text, a chunk at a time. A streamed
+    page is read from the network as the chunks are asked for; closing the
+    generator early closes the connection without reading the rest.
+
+    Inputs:
+        r: request object from get_request
+        chunk_size: (int) bytes (or, for pages already read, characters)
+            per chunk
+
+    Outputs: generator of strings
+    '''
+    if not r.streamed:
+        text = r.text
+        for chunk_start in range(0, len(text), chunk_size):
+            yield text[chunk_start:chunk_start + chunk_size]
+        return
+
+    decoder = codecs.getincrementaldecoder(r.encoding or 'utf-8')(\
+        errors='replace')
+    chunks = r.iter_content(chunk_size)
+    read_seconds = 0
+    nbytes = 0
+    try:
+        while True:
+            read_start = time.perf_counter()
+            chunk = next(chunks, None)
+            read_seconds += time.perf_counter() - read_start
+            if chunk is None:
+                break
+            nbytes += len(chunk)
+            yield decoder.decode(chunk)
+        yield decoder.decode(b'', final=True)
+    finally:
+        r.close()
+        record_metric(*get_crawl_context(), 'fetch', read_seconds,
+                      nbytes=nbytes)
+
+
+def get_requests(urls):
+    '''
+    Fetch a batch of transcript pages through the scheduler and yield the
+    responses in the order of urls. The order does not depend on which
+    request finishes first, so episodes are numbered the same way as a
+    serial crawl.
+
+    Requests keep running in the background while the caller works on the
+    responses already yielded; the ones not yet sent are dropped if the
+    caller stops early.
+
+    Inputs:
+        urls: list of absolute URLs
+
+    Outputs:
+        generator of (url, request object or None) tuples
+    '''
+    futures = [schedule_request(url) for url in urls]
+
+    try:
+        for url, future in zip(urls, futures):
+            yield url, future.result()
+    finally:
+        for future in futures:
+            future.cancel()
 
 
 def is_absolute_url(url):
@@ -0,0 +1,268 @@
+'''
+CAPP 30122: Merge crawl shards into one database
+
+A shard is a database filled by run_crawlers.py for only some networks or
+shows (--network, --show), numbering its episodes, phrases and speakers from
+0. Shards can be crawled on different machines or processes without knowing
+about each other; this copies them, in the order given, into one new
+database with the news.sql schema:
+    - episode and phrase IDs are renumbered after those already merged
+    - speakers with the same official name are the same speaker, and each
+      speaker's titles are only kept once
+    - an episode whose text (see crawler_util.get_content_hash) is already
+      in the merged database is left out. Shards without a crawl_content
+      table (made before content hashes were kept) are not checked.
+    - the crawl tables are merged too, so the result can be crawled
+      incrementally or resumed like any other crawl database
+'''
+
+import time
+import sqlite3
+import argparse
+import crawler_util
+
+
+DATABASE_FILENAME = 'news_db_2020.sqlite3'
+
+
+def has_table(db_cursor, schema, table):
+    '''
+    Does an attached database (schema) have a table? Shards made before the
+    crawl tables existed do not have them.
+    '''
+    return db_cursor.execute(\
+        'SELECT 1 FROM {}.sqlite_master WHERE type = ? AND name = ?'.format(\
+            schema), ('table', table)).fetchall() != []
+
+
+def map_speakers(db_cursor):
+    '''
+    Give every speaker of the attached shard its ID in the merged database:
+    the ID of the merged speaker with the same name, or a new one.
+
+    Outputs: (int) number of new speakers
+    '''
+    speaker_id_start, _, _ = crawler_util.get_next_ids(db_cursor)
+    speakers = dict(db_cursor.execute(\
+        'SELECT speaker_name, speaker_id FROM main.speaker').fetchall())
+
+    speaker_map = []
+    new_speakers = []
+    for speaker_id, speaker_name in db_cursor.execute(\
+            '''SELECT speaker_id, speaker_name FROM shard.speaker
+               ORDER BY CAST(speaker_id AS INTEGER)''').fetchall():
+        if speaker_name not in speakers:
+            speakers[speaker_name] = speaker_id_start
+            new_speakers.append((speaker_id_start, speaker_name))
+            speaker_id_start += 1
+        speaker_map.append((int(speaker_id), speakers[speaker_name]))
+
+    db_cursor.executemany('INSERT INTO main.speaker VALUES(?, ?)',
+                          new_speakers)
+    db_cursor.executemany('INSERT INTO speaker_map VALUES(?, ?)',
+                          speaker_map)
+
+    return len(new_speakers)
+
+
+def map_episodes(db_cursor):
+    '''
+    Give every episode of the attached shard the next free episode ID of the
+    merged database, leaving out episodes whose text is already merged.
+
+    Outputs: (int) number of episodes left out
+    '''
+    _, episode_id_start, _ = crawler_util.get_next_ids(db_cursor)
+
+    duplicates = set()
+    if has_table(db_cursor, 'shard', 'crawl_content'):
+        duplicates = {int(episode_id) for episode_id, in db_cursor.execute(\
+            '''SELECT s.episode_id FROM shard.crawl_content s
+               JOIN main.crawl_content m USING (content_hash)''').fetchall()}
+
+    episode_map = []
+    for episode_id, in db_cursor.execute(\
+            '''SELECT episode_id FROM shard.episode
+               ORDER BY CAST(episode_id AS INTEGER)''').fetchall():
+        if int(episode_id) not in duplicates:
+            episode_map.append((int(episode_id), episode_id_start))
+            episode_id_start += 1
+
+    db_cursor.executemany('INSERT INTO episode_map VALUES(?, ?)',
+                          episode_map)
+
+    return len(duplicates)
+
+
+def merge_shard(db_connection, shard_name):
+    '''
+    Copy one shard into the merged database, in a single transaction.
+
+    Inputs:
+        db_connection: connection to the merged database
+        shard_name: (str) shard database file
+
+    Outputs: dictionary with the number of episodes merged, duplicate
+        episodes left out and new speakers
+    '''
+    db_connection.execute('ATTACH DATABASE ? AS shard', (shard_name,))
+    db_cursor = db_connection.cursor()
+    try:
+        db_cursor.execute('''CREATE TEMP TABLE speaker_map(
+                                 old_id int NOT NULL PRIMARY KEY,
+                                 new_id int)''')
+        db_cursor.execute('''CREATE TEMP TABLE episode_map(
+                                 old_id int NOT NULL PRIMARY KEY,
+                                 new_id int)''')
+        new_speakers = map_speakers(db_cursor)
+        duplicates = map_episodes(db_cursor)
+        _, _, phrase_id_start = crawler_util.get_next_ids(db_cursor)
+
+        db_cursor.execute('''INSERT INTO main.title
+                             SELECT m.new_id, t.speaker_title
+                             FROM shard.title t JOIN speaker_map m
+                             ON m.old_id = CAST(t.speaker_id AS INTEGER)
+                             WHERE NOT EXISTS (
+                                 SELECT 1 FROM main.title x
+                                 WHERE x.speaker_id = m.new_id
+                                 AND x.speaker_title = t.speaker_title)
+                             GROUP BY m.new_id, t.speaker_title
+                             ORDER BY MIN(t.rowid)''')
+        db_cursor.execute('''INSERT INTO main.episode
+                             SELECT e.new_id, s.headline, s.airtime,
+                                    s.show_name
+                             FROM shard.episode s JOIN episode_map e
+                             ON e.old_id = CAST(s.episode_id AS INTEGER)
+                             ORDER BY e.new_id''')
+        db_cursor.execute('''INSERT INTO main.transcript
+                             SELECT ? + ROW_NUMBER() OVER (
+                                        ORDER BY CAST(t.phrase_id AS INTEGER))
+                                    - 1,
+                                    e.new_id, t.words, m.new_id
+                             FROM shard.transcript t
+                             JOIN episode_map e
+                             ON e.old_id = CAST(t.episode_id AS INTEGER)
+                             JOIN speaker_map m
+                             ON m.old_id = CAST(t.speaker_id AS INTEGER)''',
+                          (phrase_id_start,))
+        db_cursor.execute('INSERT OR IGNORE INTO main.show '
+                          'SELECT * FROM shard.show')
+
+        if has_table(db_cursor, 'shard', 'crawl_content'):
+            db_cursor.execute('''INSERT INTO main.crawl_content
+                                 SELECT s.content_hash, e.new_id
+                                 FROM shard.crawl_content s JOIN episode_map e
+                                 ON e.old_id = CAST(s.episode_id AS INTEGER)
+                                 ''')
+        if has_table(db_cursor, 'shard', 'crawl_mark'):
+            # Each show keeps its newest mark
+            db_cursor.execute('''INSERT INTO main.crawl_mark
+                                 SELECT * FROM shard.crawl_mark WHERE true
+                                 ON CONFLICT(show_name) DO UPDATE
+                                 SET network_name = excluded.network_name,
+                                     airtime = excluded.airtime,
+                                     url = excluded.url
+                                 WHERE excluded.airtime >
+                                     crawl_mark.airtime''')
+        if has_table(db_cursor, 'shard', 'crawl_frontier'):
+            db_cursor.execute('INSERT OR IGNORE INTO main.crawl_frontier '
+                              'SELECT * FROM shard.crawl_frontier')
+        if has_table(db_cursor, 'shard', 'crawl_catalog'):
+            # The newest sighting of each show, and of each full index read
+            db_cursor.execute('''INSERT INTO main.crawl_catalog
+                                 SELECT * FROM shard.crawl_catalog WHERE true
+                                 ON CONFLICT(starting_url, show_name)
+                                 DO UPDATE
+                                 SET network_name = excluded.network_name,
+                                     listing_url = excluded.listing_url,
+                                     last_seen = excluded.last_seen
+                                 WHERE excluded.last_seen >
+                                     crawl_catalog.last_seen''')
+            db_cursor.execute('''INSERT INTO main.crawl_discovery
+                                 SELECT * FROM shard.crawl_discovery
+                                 WHERE true
+                                 ON CONFLICT(starting_url) DO UPDATE
+                                 SET network_name = excluded.network_name,
+                                     discovered = excluded.discovered
+                                 WHERE excluded.discovered >
+                                     crawl_discovery.discovered''')
+        if has_table(db_cursor, 'shard', 'crawl_validator'):
+            # The validators each listing was last crawled with
+            db_cursor.execute('''INSERT INTO main.crawl_validator
+                                 SELECT * FROM shard.crawl_validator
+                                 WHERE true
+                                 ON CONFLICT(url) DO UPDATE
+                                 SET etag = excluded.etag,
+                                     last_modified = excluded.last_modified,
+                                     saved = excluded.saved
+                                 WHERE excluded.saved >
+                                     crawl_validator.saved''')
+
+        episodes = db_cursor.execute(\
+            'SELECT COUNT(*) FROM episode_map').fetchall()[0][0]
+        db_cursor.execute('DROP TABLE speaker_map')
+        db_cursor.execute('DROP TABLE episode_map')
+        db_connection.commit()
+    except Exception:
+        db_connection.rollback()
+        raise
+    finally:
+        db_connection.execute('DETACH DATABASE shard')
+
+    return {'episodes': episodes, 'duplicates': duplicates,
+            'new_speakers': new_speakers}
+
+
+def go(shard_names, db_name=DATABASE_FILENAME, overwrite=False):
+    '''
+    Merge shards into a new database.
+
+    Inputs:
+        shard_names: list of shard database files, merged in this order
+            (which decides the IDs and which copy of a duplicate episode is
+            kept)
+        db_name: (str) database file to create
+        overwrite: (bool) replace db_name if it already exists
+
+    Outputs: (int) number of episodes in the merged database
+    '''
+    crawler_util.create_database(db_name, overwrite)
+
+    db_connection = sqlite3.connect(db_name)
+    try:
+        episodes = 0
+        for shard_name in shard_names:
+            merged = merge_shard(db_connection, shard_name)
+            episodes += merged['episodes']
+            print(shard_name + ":", merged['episodes'], "episodes,",
+                  merged['duplicates'], "duplicate episodes left out,",
+                  merged['new_speakers'], "new speakers")
+
+        # Incremental crawls and resumes of the merged database number from
+        # here
+        db_cursor = db_connection.cursor()
+        db_cursor.execute(\
+            'INSERT OR REPLACE INTO crawl_checkpoint VALUES(0, ?, ?, ?, ?)',
+            crawler_util.get_next_ids(db_cursor) +
+            (time.strftime('%Y-%m-%d %H:%M:%S'),))
+        db_connection.commit()
+    finally:
+        db_connection.close()
+
+    print(episodes, "episodes merged into", db_name)
+
+    return episodes
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(\
+        description="Merge crawl shards into one database")
+    parser.add_argument("shards", nargs="+",
+                        help="shard database files, merged in this order")
+    parser.add_argument("--db", default=DATABASE_FILENAME,
+                        help="database file to create")
+    parser.add_argument("--overwrite", action="store_true",
+                        help="replace the database if it exists")
+    args = parser.parse_args()
+
+    go(args.shards, args.db, args.overwrite)
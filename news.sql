@@ -25,3 +25,46 @@ CREATE TABLE transcript(
     speaker_id varchar(7),
     FOREIGN KEY(episode_id) REFERENCES episode(episode_id),
     FOREIGN KEY(speaker_id) REFERENCES speaker(speaker_id));
+
+CREATE TABLE crawl_mark(
+    show_name varchar(25) NOT NULL PRIMARY KEY,
+    network_name varchar(7),
+    airtime datetime,
+    url varchar(200));
+
+CREATE TABLE crawl_frontier(
+    url varchar(200) NOT NULL PRIMARY KEY,
+    network_name varchar(7),
+    show_name varchar(25),
+    state varchar(7),
+    error text);
+
+CREATE TABLE crawl_checkpoint(
+    checkpoint_id int NOT NULL PRIMARY KEY,
+    speaker_id int,
+    episode_id int,
+    phrase_id int,
+    saved_at datetime);
+
+CREATE TABLE crawl_content(
+    content_hash char(40) NOT NULL PRIMARY KEY,
+    episode_id varchar(7));
+
+CREATE TABLE crawl_catalog(
+    starting_url varchar(200) NOT NULL,
+    show_name varchar(25) NOT NULL,
+    network_name varchar(7),
+    listing_url varchar(200),
+    last_seen real,
+    PRIMARY KEY (starting_url, show_name));
+
+CREATE TABLE crawl_discovery(
+    starting_url varchar(200) NOT NULL PRIMARY KEY,
+    network_name varchar(7),
+    discovered real);
+
+CREATE TABLE crawl_validator(
+    url varchar(200) NOT NULL PRIMARY KEY,
+    etag varchar(200),
+    last_modified varchar(40),
+    saved real);
@@ -0,0 +1,208 @@
+'''
+CAPP 30122: Rebuild the database from archived transcript pages
+
+Reads the transcript archive that crawls log while the page cache is
+recording (crawler_util.ARCHIVE_FILENAME) and loads every archived
+transcript into a fresh database without touching the network. Pages are
+parsed, cleaned and their speakers resolved in parallel in the parse pool;
+a single writer thread then hands out IDs in archive order, so rebuilding
+from the same archive always gives the same database.
+'''
+
+import time
+import sqlite3
+import argparse
+import datetime
+import crawler_cnn
+import crawler_fox
+import crawler_msnbc
+import crawler_util
+
+
+DATABASE_FILENAME = 'news_db_reparsed.sqlite3'
+
+# Pages handed to each parse process at a time
+CHUNKSIZE = 8
+
+# Transcripts are written in large transactions without fsyncs: a rebuild
+# that fails part of the way is simply run again.
+WRITE_BATCH_ROWS = 50000
+
+# Network of each archived transcript: function parsing its page
+PARSE_FUNCTIONS = {'CNN': crawler_cnn.parse_cnn_transcript,
+                   'Fox': crawler_fox.parse_fox_transcript,
+                   'MSNBC': crawler_msnbc.parse_msnbc_transcript}
+
+
+def parse_and_resolve(page_text, parse_function, *args):
+    '''
+    Parse a transcript page and resolve its speakers, so the writer thread
+    only has to give them IDs.
+
+    Inputs:
+        page_text: (str) HTML of the transcript page
+        parse_function: network parse function from PARSE_FUNCTIONS
+        args: extra arguments passed to parse_function
+
+    Outputs: parse_function result, with the 'speakers_dict' and
+        'alias_dict' of crawler_util.resolve_speakers if it has speakers
+    '''
+    parsed_transcript = parse_function(page_text, *args)
+    if parsed_transcript['all_speakers'] or parsed_transcript['turns']:
+        speakers_start = time.perf_counter()
+        speakers_dict, alias_dict = crawler_util.resolve_speakers(\
+            parsed_transcript)
+        crawler_util.add_stage_time('speakers',
+            time.perf_counter() - speakers_start)
+        parsed_transcript['speakers_dict'] = speakers_dict
+        parsed_transcript['alias_dict'] = alias_dict
+
+    return parsed_transcript
+
+
+def reparse_page(task):
+    '''
+    Read an archived transcript page from the page cache and parse it. Runs
+    in the parse pool.
+
+    Inputs:
+        task: (archive entry, cache folder, start, end) tuple
+
+    Outputs: parsed transcript or None, error or None, dictionary mapping
+        stages to seconds
+    '''
+    entry, cache_dir, start, end = task
+    crawler_util.configure_cache('replay', cache_dir)
+    r = crawler_util.read_cache(entry['url'])
+    if r is None:
+        return None, "page is not in the archive", {}
+
+    try:
+        parsed_transcript, stage_times = crawler_util.timed_parse(r.text,
+            parse_and_resolve, PARSE_FUNCTIONS[entry['network']], start, end)
+    except Exception as parse_error:
+        return None, repr(parse_error), {}
+
+    return parsed_transcript, None, stage_times
+
+
+def load_episode(entry, parsed_transcript, start, end):
+    '''
+    Queue a reparsed transcript for the database, leaving out the same
+    transcripts as a crawl would.
+
+    Outputs: (bool) True if the episode was queued for the database
+    '''
+    link, title = entry['url'], entry['show']
+    if entry['network'] == 'CNN':
+        return crawler_cnn.crawl_transcript(link, title, entry['headline'],
+            parsed_transcript, start, end)
+    if entry['network'] == 'MSNBC':
+        return crawler_msnbc.crawl_msnbc_transcript(link, title,
+            parsed_transcript, start, end)
+
+    if not crawler_util.in_date_window(parsed_transcript['airtime'], start,
+                                       end):
+        return False
+    crawler_util.store_episode('Fox', title, parsed_transcript['headline'],
+        parsed_transcript['airtime'], link, parsed_transcript)
+
+    return True
+
+
+def go(db_name=DATABASE_FILENAME, cache_dir=crawler_util.CACHE_DIR,
+       start=None, end=None, workers=crawler_util.PARSE_WORKERS,
+       overwrite=False, report=None):
+    '''
+    Rebuild the database from the transcript archive of a page cache.
+
+    Inputs:
+        db_name: (str) database file to create
+        cache_dir: (str) page cache folder recorded by run_crawlers.go(
+            cache_mode="record")
+        start, end: (datetime.date) only load episodes that aired between
+            these dates (inclusive), by default the crawlers' LIMIT_YEAR
+        workers: (int) number of parse processes (0 parses in this process)
+        overwrite: (bool) replace db_name if it already exists
+        report: (str) JSON file to write the run report to, or None
+
+    Outputs: (int) number of episodes queued for the database
+    '''
+    entries = [entry for entry in crawler_util.read_archive(cache_dir)
+               if entry['network'] in PARSE_FUNCTIONS]
+    crawler_util.create_database(db_name, overwrite)
+
+    # Only ever read pages from the cache
+    crawler_util.configure_cache('replay', cache_dir)
+    crawler_util.reset_metrics()
+    crawler_util.configure_writer(batch_rows=WRITE_BATCH_ROWS,
+                                  synchronous='OFF')
+    crawler_util.set_next_ids(0, 0, 0)
+    conn = sqlite3.connect(db_name)
+    crawler_util.load_crawl_marks(conn.cursor())
+    crawler_util.load_frontier(conn.cursor())
+    conn.close()
+
+    crawler_util.close_parse_pool()
+    crawler_util.PARSE_WORKERS = workers
+    pool = crawler_util.get_parse_pool()
+    tasks = [(entry, cache_dir, start, end) for entry in entries]
+    if pool is None:
+        results = map(reparse_page, tasks)
+    else:
+        results = pool.imap(reparse_page, tasks, CHUNKSIZE)
+
+    episodes_loaded = 0
+    crawler_util.start_writer(db_name)
+    try:
+        for entry, (parsed_transcript, error, stage_times) in zip(entries,
+                                                                  results):
+            network_name, show_name = entry['network'], entry['show']
+            crawler_util.add_to_frontier(network_name, show_name,
+                                         [entry['url']])
+            if error is not None:
+                print("FAILED TO PARSE", entry['url'], error)
+                crawler_util.mark_url(entry['url'], 'failed', error)
+                continue
+            for stage, seconds in stage_times.items():
+                crawler_util.record_metric(network_name, show_name, stage,
+                                           seconds)
+
+            loaded = load_episode(entry, parsed_transcript, start, end)
+            episodes_loaded += loaded
+            if not loaded:
+                crawler_util.mark_url(entry['url'], 'done')
+    finally:
+        crawler_util.stop_writer()
+        crawler_util.close_parse_pool()
+        if report is not None:
+            crawler_util.write_run_report(report)
+
+    print(len(entries), "archived transcripts,", episodes_loaded,
+          "episodes loaded into", db_name)
+
+    return episodes_loaded
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(\
+        description="Rebuild the database from archived transcript pages")
+    parser.add_argument("--db", default=DATABASE_FILENAME,
+                        help="database file to create")
+    parser.add_argument("--cache-dir", default=crawler_util.CACHE_DIR,
+                        help="page cache folder with the archive")
+    parser.add_argument("--start", type=datetime.date.fromisoformat,
+                        help="first air date to load (YYYY-MM-DD)")
+    parser.add_argument("--end", type=datetime.date.fromisoformat,
+                        help="last air date to load (YYYY-MM-DD)")
+    parser.add_argument("--workers", type=int,
+                        default=crawler_util.PARSE_WORKERS,
+                        help="number of parse processes")
+    parser.add_argument("--overwrite", action="store_true",
+                        help="replace the database if it exists")
+    parser.add_argument("--report",
+                        help="JSON file to write the run report to")
+    args = parser.parse_args()
+
+    go(args.db, args.cache_dir, args.start, args.end, args.workers,
+       args.overwrite, args.report)
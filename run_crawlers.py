@@ -4,42 +4,234 @@ CAPP 30122: Run all crawlers
 Charlie Sheils
 '''
 
+import os
 import sqlite3
+import argparse
+import datetime
+import concurrent.futures
 import crawler_cnn
 import crawler_msnbc
 import crawler_fox
+import crawler_util
 
 
 DATABASE_FILENAME = 'news_db_2020.sqlite3'
+REPORT_FILENAME = 'crawl_report.json'
 LIMIT_YEAR = 2020
+CRAWLERS = [('fox', crawler_fox), ('cnn', crawler_cnn),
+            ('msnbc', crawler_msnbc)]
 
 
-def go(db_name=DATABASE_FILENAME):
+def go(db_name=DATABASE_FILENAME, cache_mode=None,
+       cache_dir=crawler_util.CACHE_DIR, cache_max_age=None,
+       incremental=False, synchronous='FULL', resume=False, start=None,
+       end=None, report=REPORT_FILENAME, metrics_port=None,
+       starting_urls=None, networks=None, shows=None, refresh_shows=False,
+       partition=None, rate=None, burst=None):
     '''
     This function modifies the database that is passed as a parameter to the
     function.
+
+    Inputs:
+        db_name: (str) database file to fill
+        cache_mode: (str) on-disk page cache mode, one of "record", "replay"
+            or "refresh-older-than" (None to turn the cache off). Use
+            "replay" to rebuild the database from previously recorded pages
+            without touching the network.
+        cache_dir: (str) folder of the page cache
+        cache_max_age: (float) seconds after which a cached page is fetched
+            again in "refresh-older-than" mode
+        incremental: (bool) keep the database and only add episodes newer
+            than the newest one already loaded for each show, instead of
+            clearing it and crawling everything again. Show listings that
+            have not changed since they were last crawled are skipped, with
+            or without the page cache.
+        synchronous: (str) SQLite synchronous mode for the crawl, one of
+            "FULL", "NORMAL" or "OFF". Lower modes fsync less often but can
+            lose the latest committed batches on a power failure.
+        resume: (bool) carry on with a crawl that stopped: keep the
+            database, start from the ID counters of its last checkpoint and
+            skip every transcript it finished. Transcripts on its retry list
+            (see crawler_util.get_failed_urls) are crawled again.
+        start, end: (datetime.date) only crawl episodes that aired between
+            these dates (inclusive). They default to the first and last day
+            of LIMIT_YEAR. CNN and MSNBC listings are dated, so listing
+            entries outside the window are skipped without fetching them.
+        report: (str) JSON file to write the run report to (time spent
+            fetching, parsing, cleaning, resolving speakers and writing, per
+            network and show; see crawler_util.get_run_report), or None
+        metrics_port: (int) if given, serve the crawl metrics as plain text
+            on this port of localhost while the crawl runs
+        starting_urls: dictionary mapping "cnn", "msnbc" and "fox" to the
+            page each crawler starts from, to crawl other sites with the
+            same markup (such as stand_in_sites.py) instead of the networks'
+        networks: list of the networks to crawl ("fox", "cnn", "msnbc"), by
+            default all three
+        shows: list of the only shows to crawl (titles as in the networks'
+            show indexes), by default all of them
+        refresh_shows: (bool) read the networks' show indexes again even if
+            the show catalog (see crawler_util.get_catalog_shows) has not
+            expired
+        partition: (str) "year" or "month" to split each CNN show's window
+            into years or months crawled in parallel, for a backfill of
+            several years (see crawler_util.configure_partitions)
+        rate: (float) requests per second allowed per host (default:
+            crawler_util.REQUESTS_PER_SECOND)
+        burst: (int) number of requests a host may receive back to back
+            (default: crawler_util.BURST)
+
+    Crawling a single network or show into its own database makes a shard:
+    a database with its own IDs, built without coordinating with the other
+    crawls. merge_shards.py combines shards into one database. db_name is
+    created with the news.sql schema if it does not exist.
+
+    The Fox, CNN and MSNBC crawlers run at the same time and queue their
+    episodes for a single writer thread (see crawler_util.start_writer),
+    which hands out episode, speaker and phrase IDs and writes them in
+    batched transactions.
     '''
 
+    if starting_urls is None:
+        starting_urls = {}
+
+    if networks is None:
+        networks = [name for name, _ in CRAWLERS]
+
+    crawler_util.configure_cache(cache_mode, cache_dir, cache_max_age)
+    crawler_util.configure_shows(shows)
+    crawler_util.configure_catalog(refresh=refresh_shows)
+    crawler_util.configure_partitions(partition)
+    crawler_util.configure_rate_limit(rate, burst)
+    crawler_util.reset_metrics()
+
+    crawler_util.configure_writer(synchronous=synchronous)
+
+    if not os.path.exists(db_name):
+        crawler_util.create_database(db_name)
     conn = sqlite3.connect(db_name)
     db_cursor = conn.cursor()
 
-    # Clear out database before running crawlers
-    db_cursor.execute('DELETE FROM show')
-    db_cursor.execute('DELETE FROM episode')
-    db_cursor.execute('DELETE FROM speaker')
-    db_cursor.execute('DELETE FROM title')
-    db_cursor.execute('DELETE FROM transcript')
+    crawler_util.create_crawl_tables(db_cursor)
 
-    # Run web crawlers & input results into database
-    speaker_id_start = 0
-    episode_id_start = 0
-    phrase_id_start = 0
-    speaker_id_start, episode_id_start, phrase_id_start = crawler_fox.go(\
-        db_cursor, conn, speaker_id_start, episode_id_start, phrase_id_start)
-    speaker_id_start, episode_id_start, phrase_id_start = crawler_cnn.go(\
-        db_cursor, conn, speaker_id_start, episode_id_start, phrase_id_start)
-    speaker_id_start, episode_id_start, phrase_id_start = crawler_msnbc.go(\
-        db_cursor, conn, speaker_id_start, episode_id_start, phrase_id_start)
+    if resume:
+        # Continue numbering from the last commit of the stopped crawl
+        speaker_id_start, episode_id_start, phrase_id_start = \
+            crawler_util.get_checkpoint_ids(db_cursor)
+    elif incremental:
+        # Continue numbering after what is already in the database
+        speaker_id_start, episode_id_start, phrase_id_start = \
+            crawler_util.get_next_ids(db_cursor)
+    else:
+        # Clear out database before running crawlers
+        db_cursor.execute('DELETE FROM show')
+        db_cursor.execute('DELETE FROM episode')
+        db_cursor.execute('DELETE FROM speaker')
+        db_cursor.execute('DELETE FROM title')
+        db_cursor.execute('DELETE FROM transcript')
+        db_cursor.execute('DELETE FROM crawl_mark')
+        db_cursor.execute('DELETE FROM crawl_frontier')
+        db_cursor.execute('DELETE FROM crawl_checkpoint')
+        db_cursor.execute('DELETE FROM crawl_content')
+        db_cursor.execute('DELETE FROM crawl_validator')
+
+        speaker_id_start = 0
+        episode_id_start = 0
+        phrase_id_start = 0
+
+    crawler_util.set_next_ids(speaker_id_start, episode_id_start,
+                              phrase_id_start)
+    crawler_util.load_crawl_marks(db_cursor)
+    crawler_util.load_frontier(db_cursor)
+    crawler_util.load_catalog(db_cursor)
+    crawler_util.load_validators(db_cursor)
 
     conn.commit()
     conn.close()
+
+    # Run web crawlers & input results into database
+    if metrics_port is not None:
+        crawler_util.start_metrics_server(metrics_port)
+    crawler_util.start_writer(db_name)
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=3) as executor:
+            crawls = [executor.submit(crawler.go, incremental, start, end,
+                                      starting_urls.get(name,
+                                                        crawler.STARTING_URL))
+                      for name, crawler in CRAWLERS if name in networks]
+            for crawl in crawls:
+                crawl.result()
+    finally:
+        crawler_util.stop_writer()
+        crawler_util.stop_metrics_server()
+        if report is not None:
+            crawler_util.write_run_report(report)
+
+    conn = sqlite3.connect(db_name)
+    failed_urls = crawler_util.get_failed_urls(conn.cursor())
+    conn.close()
+    if failed_urls:
+        print(len(failed_urls), "PAGES FAILED; RUN AGAIN WITH resume=True TO",
+              "RETRY THEM")
+
+    crawler_util.close_parse_pool()
+    crawler_util.print_host_summary()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run all crawlers")
+    parser.add_argument("--db", default=DATABASE_FILENAME,
+                        help="database file to fill")
+    parser.add_argument("--incremental", action="store_true",
+                        help="only add episodes newer than the last crawl")
+    parser.add_argument("--resume", action="store_true",
+                        help="carry on with a crawl that stopped")
+    parser.add_argument("--synchronous", default='FULL',
+                        choices=crawler_util.SYNCHRONOUS_MODES,
+                        help="SQLite synchronous mode")
+    parser.add_argument("--cache-mode", choices=crawler_util.CACHE_MODES,
+                        help="keep fetched pages in the on-disk page cache")
+    parser.add_argument("--cache-dir", default=crawler_util.CACHE_DIR,
+                        help="folder of the page cache")
+    parser.add_argument("--cache-max-age", type=float,
+                        help="seconds after which a cached page is fetched "
+                             "again (refresh-older-than)")
+    parser.add_argument("--start", type=datetime.date.fromisoformat,
+                        help="first air date to crawl (YYYY-MM-DD)")
+    parser.add_argument("--end", type=datetime.date.fromisoformat,
+                        help="last air date to crawl (YYYY-MM-DD)")
+    parser.add_argument("--report", default=REPORT_FILENAME,
+                        help="JSON file to write the run report to")
+    parser.add_argument("--metrics-port", type=int,
+                        help="serve live crawl metrics on this port")
+    parser.add_argument("--network", action="append",
+                        choices=[name for name, _ in CRAWLERS],
+                        help="only crawl this network (can be repeated)")
+    parser.add_argument("--show", action="append",
+                        help="only crawl this show (can be repeated)")
+    parser.add_argument("--refresh-shows", action="store_true",
+                        help="read the show indexes again instead of using "
+                             "the show catalog")
+    parser.add_argument("--partition", choices=crawler_util.PARTITIONS,
+                        help="crawl each CNN show's years or months in "
+                             "parallel (MSNBC and Fox are not partitioned)")
+    parser.add_argument("--rate", type=float,
+                        default=crawler_util.REQUESTS_PER_SECOND,
+                        help="requests per second allowed per host")
+    parser.add_argument("--burst", type=int, default=crawler_util.BURST,
+                        help="requests a host may receive back to back")
+    for name, crawler in CRAWLERS:
+        parser.add_argument("--{}-url".format(name),
+                            default=crawler.STARTING_URL,
+                            help="page the {} crawler starts from".format(\
+                                name))
+    args = parser.parse_args()
+
+    go(args.db, cache_mode=args.cache_mode, cache_dir=args.cache_dir,
+       cache_max_age=args.cache_max_age, incremental=args.incremental,
+       synchronous=args.synchronous, resume=args.resume, start=args.start,
+       end=args.end, report=args.report, metrics_port=args.metrics_port,
+       starting_urls={'cnn': args.cnn_url, 'msnbc': args.msnbc_url,
+                      'fox': args.fox_url},
+       networks=args.network, shows=args.show,
+       refresh_shows=args.refresh_shows, partition=args.partition,
+       rate=args.rate, burst=args.burst)
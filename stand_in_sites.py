@@ -0,0 +1,607 @@
+'''
+CAPP 30122: Local stand-in transcript sites
+
+Serves synthetic CNN, MSNBC and Fox transcript sites, with the markup the
+crawlers read, on three local ports so the crawlers can be load-tested with
+any number of shows and episodes and no network. Responses can be slowed
+down, fail (500) or be throttled (429 with Retry-After) at configurable
+rates.
+
+    python stand_in_sites.py --shows 50 --episodes 365 --latency 0.05
+
+then point run_crawlers.py at the printed URLs.
+'''
+
+import re
+import json
+import time
+import zlib
+import random
+import calendar
+import datetime
+import argparse
+import threading
+import http.server
+import urllib.parse
+
+
+PORT = 8800
+HOST = '127.0.0.1'
+
+# Each show has an episode every day, the newest on END_DATE. Fox listings
+# show FOX_PAGE_SIZE transcripts at a time, with a "load more" button for the
+# next ones.
+SITE_CONFIG = {'shows': 10,
+               'episodes': 366,
+               'turns': 150,
+               'end_date': datetime.date(2020, 12, 31),
+               'latency': 0.0,
+               'jitter': 0.0,
+               'error_rate': 0.0,
+               'throttle_rate': 0.0,
+               'retry_after': 1,
+               'seed': 0}
+FOX_PAGE_SIZE = 10
+
+# Site served on each port, counting up from the first port
+SITES = ['cnn', 'msnbc', 'fox']
+STARTING_PATHS = {'cnn': '/TRANSCRIPTS/', 'msnbc': '/transcripts',
+                  'fox': '/shows'}
+
+SHOW_NAMES = {'cnn': ['The Lead', 'The Situation Room', 'Anderson Cooper 360',
+                      'Cuomo Prime Time', 'CNN Newsroom', 'New Day',
+                      'Erin Burnett OutFront', 'State of the Union'],
+              'msnbc': ['The Rachel Maddow Show', 'All In with Chris Hayes',
+                        'Hardball with Chris Matthews', 'The Beat with Ari Melber',
+                        'The Last Word with Lawrence O\'Donnell',
+                        'Deadline: White House'],
+              'fox': ['Hannity', 'Tucker Carlson Tonight', 'The Ingraham Angle',
+                      'The Story with Martha MacCallum', 'Special Report',
+                      'Fox News Sunday']}
+NETWORK_TITLES = {'cnn': 'CNN', 'msnbc': 'MSNBC', 'fox': 'FOX NEWS'}
+FIRST_NAMES = ['JOHN', 'MARY', 'DAVID', 'SARAH', 'MICHAEL', 'JENNIFER',
+               'JAMES', 'LISA', 'ROBERT', 'KAREN', 'WILLIAM', 'NANCY']
+LAST_NAMES = ['SMITH', 'JOHNSON', 'WILLIAMS', 'BROWN', 'GARCIA', 'MILLER',
+              'DAVIS', 'WILSON', 'ANDERSON', 'TAYLOR', 'THOMAS', 'MOORE']
+GUEST_TITLES = ['SENATOR', 'CORRESPONDENT', 'ANALYST', 'CONTRIBUTOR',
+                'FORMER GOVERNOR', 'PROFESSOR']
+WORDS = ('the president said we are going to see more cases in the coming '
+         'days and governors across the country are asking for tests and '
+         'help from washington while markets fell sharply again as '
+         'investors worried about the economy the senate is expected to '
+         'vote this week on a relief package that would send checks to '
+         'families and loans to small businesses').split()
+
+SITE_STATS = {}
+_stats_lock = threading.Lock()
+
+
+def configure_sites(**settings):
+    '''
+    Change the size and behaviour of the stand-in sites (see SITE_CONFIG).
+    '''
+    for key, value in settings.items():
+        assert key in SITE_CONFIG, "unknown setting %r" % key
+        SITE_CONFIG[key] = value
+
+
+def get_show_name(site, show_index):
+    '''
+    Return the name of a show, numbering repeats of the stock names.
+    '''
+    names = SHOW_NAMES[site]
+    name = names[show_index % len(names)]
+    if show_index >= len(names):
+        name += ' ' + str(show_index // len(names) + 1)
+
+    return name
+
+
+def get_show_slug(show_index):
+    '''
+    Return the part of a show's URLs that names it.
+    '''
+    return 'show{:04d}'.format(show_index)
+
+
+def get_show_index(slug):
+    '''
+    Return the index of the show named by slug, or None if there is none.
+    '''
+    if not re.match('^show[0-9]{4}$', slug):
+        return None
+    show_index = int(slug[4:])
+    if show_index >= SITE_CONFIG['shows']:
+        return None
+
+    return show_index
+
+
+def get_air_date(episode):
+    '''
+    Return the air date of a show's episode (0 is the newest).
+    '''
+    return SITE_CONFIG['end_date'] - datetime.timedelta(days=episode)
+
+
+def get_episode(air_date):
+    '''
+    Return the episode that aired on air_date, or None if there is none.
+    '''
+    episode = (SITE_CONFIG['end_date'] - air_date).days
+    if episode < 0 or episode >= SITE_CONFIG['episodes']:
+        return None
+
+    return episode
+
+
+def format_date(air_date):
+    '''
+    Return a date as "March 3, 2020".
+    '''
+    return '{} {}, {}'.format(calendar.month_name[air_date.month],
+                              air_date.day, air_date.year)
+
+
+def get_turns(site, show_index, episode):
+    '''
+    Make up the speaker turns of an episode. The same episode always gets
+    the same turns, and no two episodes get the same text.
+
+    Outputs: list of "SPEAKER: text" strings, including a video clip
+    '''
+    rng = random.Random(zlib.crc32('{}/{}/{}/{}'.format(site, show_index,
+        episode, SITE_CONFIG['seed']).encode('utf-8')))
+    network = NETWORK_TITLES[site]
+    # Speakers of an episode never share a last name, which would leave
+    # their short names ambiguous
+    last_names = rng.sample(LAST_NAMES, 4)
+    host = (rng.choice(FIRST_NAMES), last_names[0])
+    guests = [(rng.choice(FIRST_NAMES), last_name, rng.choice(GUEST_TITLES))
+              for last_name in last_names[1:]]
+
+    turns = ['{} {}, {} HOST: Good evening and welcome to {} on {}.'.format(\
+        host[0], host[1], network, get_show_name(site, show_index),
+        format_date(get_air_date(episode)))]
+    introduced = set()
+    for turn in range(1, SITE_CONFIG['turns']):
+        text = ' '.join([' '.join([rng.choice(WORDS)
+                                   for _ in range(rng.randint(6, 20))]) + '.'
+                         for _ in range(rng.randint(1, 4))])
+        text = text[0].upper() + text[1:]
+        if turn % 2:
+            turns.append('{}: {}'.format(host[1], text))
+            continue
+        first, last, title = rng.choice(guests)
+        if last in introduced:
+            turns.append('{}: {}'.format(last, text))
+        else:
+            introduced.add(last)
+            turns.append('{} {}, {}: {}'.format(first, last, title, text))
+        if turn == SITE_CONFIG['turns'] // 2:
+            turns += ['(BEGIN VIDEO CLIP)',
+                      'UNIDENTIFIED MALE: {}'.format(text),
+                      '(END VIDEO CLIP)']
+
+    return turns
+
+
+def page(title, body):
+    '''
+    Wrap a page body in a minimal HTML document.
+    '''
+    return ('<!DOCTYPE html><html lang="en"><head><meta charset="utf-8">'
+            '<title>{}</title></head><body>{}</body></html>').format(title,
+                                                                     body)
+
+
+def cnn_index():
+    '''
+    CNN's transcripts index: links to every show's listing.
+    '''
+    links = ''.join(['<a href="/TRANSCRIPTS/{}.html">{}</a><br>'.format(\
+        get_show_slug(show_index), get_show_name('cnn', show_index))
+        for show_index in range(SITE_CONFIG['shows'])])
+
+    return page('CNN.com - Transcripts',
+                '<span class="cnnSectBulletItems">{}</span>'.format(links))
+
+
+def cnn_listing(show_index):
+    '''
+    A CNN show's listing: one block of transcript links per day.
+    '''
+    name = get_show_name('cnn', show_index)
+    blocks = []
+    for episode in range(SITE_CONFIG['episodes']):
+        air_date = get_air_date(episode)
+        blocks.append(('<div class="cnnSectBulletItems"><a href="/TRANSCRIPTS/'
+                       '{:%y%m/%d}/{}.01.html">{}: {}. Aired {}</a></div>')\
+            .format(air_date, get_show_slug(show_index), name,
+                    format_date(air_date), 'Headline'))
+
+    return page(name, '<p class="cnnTransHead">{}</p>{}'.format(name,
+        ''.join(blocks)))
+
+
+def cnn_transcript(show_index, episode):
+    '''
+    A CNN transcript page.
+    '''
+    name = get_show_name('cnn', show_index)
+    air_date = get_air_date(episode)
+    hour = 6 + show_index % 16
+
+    return page(name, ('<p class="cnnTransStoryHead">{0}</p>'
+        '<p class="cnnTransSubHead">{0} for {1}. Aired {2}-{3}p ET</p>'
+        '<p class="cnnBodyText">Aired {1} - {2}:00   ET</p>'
+        '<p class="cnnBodyText">THIS IS A RUSH TRANSCRIPT. THIS COPY MAY NOT '
+        'BE IN ITS FINAL FORM AND MAY BE UPDATED.</p>'
+        '<p class="cnnBodyText">[{2}:00:00]<br><br>{4}<br></p>').format(\
+        name.upper(), format_date(air_date), hour, hour + 1,
+        '<br><br>'.join(get_turns('cnn', show_index, episode))))
+
+
+def msnbc_index():
+    '''
+    MSNBC's transcripts index: links to every show's listing.
+    '''
+    links = ''.join(['<li><a href="/transcripts/{}">{}</a></li>'.format(\
+        get_show_slug(show_index), get_show_name('msnbc', show_index))
+        for show_index in range(SITE_CONFIG['shows'])])
+
+    return page('MSNBC Transcripts',
+                '<div class="item-list"><ul>{}</ul></div>'.format(links))
+
+
+def msnbc_listing(show_index):
+    '''
+    An MSNBC show's listing: one item per transcript, newest first.
+    '''
+    name = get_show_name('msnbc', show_index)
+    items = ''.join([('<div class="transcript-item"><a href="/transcripts/{}/'
+                      '{}">{}, {}</a></div>').format(get_show_slug(show_index),
+                          get_air_date(episode).isoformat(), name,
+                          format_date(get_air_date(episode)))
+                     for episode in range(SITE_CONFIG['episodes'])])
+
+    return page(name, items)
+
+
+def msnbc_transcript(show_index, episode):
+    '''
+    An MSNBC transcript page.
+    '''
+    name = get_show_name('msnbc', show_index)
+    air_date = get_air_date(episode)
+    paragraphs = ''.join(['<p>{}</p>'.format(turn)
+                          for turn in get_turns('msnbc', show_index, episode)])
+
+    return ('<!DOCTYPE html><html lang="en"><head><meta charset="utf-8">'
+            '<meta property="nv:date" content="{:%m/%d/%Y} {:02d}:00:00">'
+            '<meta property="nv:title" content="{}, {}/{}/{:%y} TRANSCRIPT">'
+            '<title>{}</title></head><body><div itemprop="articleBody">{}'
+            '<p>THIS IS A RUSH TRANSCRIPT. THIS COPY MAY NOT BE IN ITS FINAL '
+            'FORM AND MAY BE UPDATED.</p></div></body></html>').format(\
+        air_date, 17 + show_index % 6, name, air_date.month, air_date.day,
+        air_date, name, paragraphs)
+
+
+def fox_index():
+    '''
+    Fox's shows page: one item per show with a link to its transcripts.
+    '''
+    items = ''.join([('<li class="showpage"><h2 class="title">{1}</h2>'
+                      '<a href="/shows/{0}">{1}</a> '
+                      '<a href="/shows/{0}/transcripts">Transcripts</a></li>')\
+        .format(get_show_slug(show_index), get_show_name('fox', show_index))
+        for show_index in range(SITE_CONFIG['shows'])])
+
+    return page('Fox News Shows', '<ul>{}</ul>'.format(items))
+
+
+def fox_articles(show_index, listing_page):
+    '''
+    The HTML of one page of a Fox show's transcript listing.
+    '''
+    name = get_show_name('fox', show_index)
+    first = listing_page * FOX_PAGE_SIZE
+    last = min(SITE_CONFIG['episodes'], first + FOX_PAGE_SIZE)
+
+    return ''.join([('<article class="article"><div class="info"><header '
+                     'class="info-header"><h2 class="title"><a href="/'
+                     'transcript/{}-{}">{} for {}</a></h2></header></div>'
+                     '</article>').format(get_show_slug(show_index),
+                         get_air_date(episode).isoformat(), name,
+                         format_date(get_air_date(episode)))
+                    for episode in range(first, last)])
+
+
+def fox_listing(show_index):
+    '''
+    A Fox show's transcript listing, laid out so that crawler_fox's XPaths
+    find its articles and "load more" button. The button fetches the next
+    page of articles from the server and adds them to the list.
+    '''
+    pages = -(-SITE_CONFIG['episodes'] // FOX_PAGE_SIZE)
+    load_more = ''
+    if pages > 1:
+        load_more = ('<div class="button load-more js-load-more" '
+                     'data-page="1"><a href="#">Load More</a></div>')
+    script = '''<script>
+var button = document.querySelector('.js-load-more');
+if (button) {
+    button.querySelector('a').addEventListener('click', function (event) {
+        event.preventDefault();
+        var listingPage = parseInt(button.getAttribute('data-page'), 10);
+        fetch('?page=' + listingPage).then(function (r) {
+            return r.text();
+        }).then(function (html) {
+            document.getElementById('articles').insertAdjacentHTML(
+                'beforeend', html);
+            if (listingPage + 1 >= %d) {
+                button.parentNode.removeChild(button);
+            } else {
+                button.setAttribute('data-page', listingPage + 1);
+            }
+        });
+    });
+}
+</script>''' % pages
+
+    return page(get_show_name('fox', show_index),
+                ('<div id="wrapper"><div></div><div><div></div><div></div>'
+                 '<div><div><main><section><div id="articles">{}</div>{}'
+                 '</section></main></div></div></div></div>{}').format(\
+                    fox_articles(show_index, 0), load_more, script))
+
+
+def fox_transcript(show_index, episode):
+    '''
+    A Fox transcript page.
+    '''
+    name = get_show_name('fox', show_index)
+    air_date = get_air_date(episode)
+    headline = '{} for {}'.format(name, format_date(air_date))
+    paragraphs = ''.join(['<p>{}</p>'.format(turn)
+                          for turn in get_turns('fox', show_index, episode)])
+
+    return page(headline, ('<script type="application/ld+json">{}</script>'
+        '<div class="article-body"><p class="speakable">This is a rush '
+        'transcript from "{}," {}. This copy may not be in its final form '
+        'and may be updated.</p>{}<p>Content and Programming Copyright {} Fox '
+        'News Network, LLC. ALL RIGHTS RESERVED.</p></div>').format(\
+        json.dumps({'@type': 'NewsArticle', 'headline': headline}), name,
+        format_date(air_date), paragraphs, air_date.year))
+
+
+def parse_date(date_text):
+    '''
+    Read a YYYY-MM-DD date, or return None.
+    '''
+    try:
+        return datetime.date.fromisoformat(date_text)
+    except ValueError:
+        return None
+
+
+def get_page(site, path, query):
+    '''
+    Return the HTML served at path on a site, or None if there is no such
+    page.
+    '''
+    if path == STARTING_PATHS[site]:
+        return {'cnn': cnn_index, 'msnbc': msnbc_index,
+                'fox': fox_index}[site]()
+
+    if site == 'cnn':
+        match = re.match('^/TRANSCRIPTS/(show[0-9]{4})\\.html$', path)
+        if match and get_show_index(match.group(1)) is not None:
+            return cnn_listing(get_show_index(match.group(1)))
+        match = re.match('^/TRANSCRIPTS/([0-9]{2})([0-9]{2})/([0-9]{2})/'
+                         '(show[0-9]{4})\\.01\\.html$', path)
+        if match:
+            air_date = parse_date('20{}-{}-{}'.format(*match.groups()[:3]))
+            show_index = get_show_index(match.group(4))
+            episode = air_date and get_episode(air_date)
+            if show_index is not None and episode is not None:
+                return cnn_transcript(show_index, episode)
+
+    elif site == 'msnbc':
+        match = re.match('^/transcripts/(show[0-9]{4})(/[0-9-]+)?$', path)
+        show_index = match and get_show_index(match.group(1))
+        if show_index is not None and match.group(2) is None:
+            return msnbc_listing(show_index)
+        if show_index is not None:
+            air_date = parse_date(match.group(2)[1:])
+            episode = air_date and get_episode(air_date)
+            if episode is not None:
+                return msnbc_transcript(show_index, episode)
+
+    elif site == 'fox':
+        match = re.match('^/shows/(show[0-9]{4})/transcripts$', path)
+        show_index = match and get_show_index(match.group(1))
+        if show_index is not None:
+            listing_page = query.get('page', [None])[0]
+            if listing_page is None:
+                return fox_listing(show_index)
+            if listing_page.isdigit():
+                return fox_articles(show_index, int(listing_page))
+        match = re.match('^/transcript/(show[0-9]{4})-([0-9-]+)$', path)
+        show_index = match and get_show_index(match.group(1))
+        if show_index is not None:
+            air_date = parse_date(match.group(2))
+            episode = air_date and get_episode(air_date)
+            if episode is not None:
+                return fox_transcript(show_index, episode)
+
+    return None
+
+
+def count_request(site, status=None, started=False):
+    '''
+    Keep track of requests in flight and answered for each site.
+    '''
+    with _stats_lock:
+        stats = SITE_STATS.setdefault(site, {'requests': 0, 'in_flight': 0,
+                                             'peak_in_flight': 0,
+                                             'statuses': {}})
+        if started:
+            stats['in_flight'] += 1
+            stats['peak_in_flight'] = max(stats['peak_in_flight'],
+                                          stats['in_flight'])
+        else:
+            stats['in_flight'] -= 1
+            stats['requests'] += 1
+            stats['statuses'][status] = stats['statuses'].get(status, 0) + 1
+
+
+class SiteHandler(http.server.BaseHTTPRequestHandler):
+    '''
+    Serve one of the stand-in sites (the server's site attribute), with the
+    configured latency, errors and throttling.
+    '''
+    protocol_version = 'HTTP/1.1'
+
+    def handle(self):
+        try:
+            super().handle()
+        except (ConnectionResetError, BrokenPipeError):
+            # The crawler closed the connection, as it does when it stops
+            # reading a streamed listing early
+            pass
+
+    def do_GET(self):
+        site = self.server.site
+        count_request(site, started=True)
+        status = 500
+        try:
+            time.sleep(SITE_CONFIG['latency'] +
+                       random.uniform(0, SITE_CONFIG['jitter']))
+            url = urllib.parse.urlparse(self.path)
+            draw = random.random()
+            headers = {'Content-Type': 'text/html; charset=utf-8'}
+            if draw < SITE_CONFIG['throttle_rate']:
+                status, html = 429, page('Too Many Requests', '')
+                headers['Retry-After'] = str(SITE_CONFIG['retry_after'])
+            elif draw < SITE_CONFIG['throttle_rate'] + \
+                    SITE_CONFIG['error_rate']:
+                status, html = 500, page('Internal Server Error', '')
+            else:
+                html = get_page(site, url.path,
+                                urllib.parse.parse_qs(url.query))
+                status = 200 if html is not None else 404
+                html = html or page('Not Found', '')
+
+            body = html.encode('utf-8')
+            self.send_response(status)
+            for header, value in headers.items():
+                self.send_header(header, value)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        finally:
+            count_request(site, status)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_sites(port=PORT, host=HOST):
+    '''
+    Start the stand-in sites on background threads, on port, port + 1 and
+    port + 2.
+
+    Outputs: dictionary mapping "cnn", "msnbc" and "fox" to the server and
+        the URL its crawler starts from
+    '''
+    sites = {}
+    for offset, site in enumerate(SITES):
+        server = http.server.ThreadingHTTPServer((host, port + offset),
+                                                 SiteHandler)
+        server.daemon_threads = True
+        server.site = site
+        threading.Thread(target=server.serve_forever, name=site + '-site',
+                         daemon=True).start()
+        sites[site] = (server, 'http://{}:{}{}'.format(host, port + offset,
+                                                      STARTING_PATHS[site]))
+
+    return sites
+
+
+def stop_sites(sites):
+    '''
+    Stop the servers started by start_sites.
+    '''
+    for server, _ in sites.values():
+        server.shutdown()
+        server.server_close()
+
+
+def print_site_stats():
+    '''
+    Print the number of requests each site answered, by status, and the
+    most it had in flight at once.
+    '''
+    with _stats_lock:
+        for site, stats in sorted(SITE_STATS.items()):
+            print(site, stats['requests'], "requests, statuses",
+                  dict(sorted(stats['statuses'].items())),
+                  "peak in flight", stats['peak_in_flight'])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(\
+        description="Serve stand-in CNN, MSNBC and Fox transcript sites")
+    parser.add_argument("--port", type=int, default=PORT,
+                        help="port of the CNN site (MSNBC and Fox use the "
+                             "next two)")
+    parser.add_argument("--host", default=HOST)
+    parser.add_argument("--shows", type=int, default=SITE_CONFIG['shows'],
+                        help="shows per network")
+    parser.add_argument("--episodes", type=int,
+                        default=SITE_CONFIG['episodes'],
+                        help="episodes per show, one a day")
+    parser.add_argument("--turns", type=int, default=SITE_CONFIG['turns'],
+                        help="speaker turns per transcript")
+    parser.add_argument("--end-date", type=datetime.date.fromisoformat,
+                        default=SITE_CONFIG['end_date'],
+                        help="air date of the newest episodes (YYYY-MM-DD)")
+    parser.add_argument("--latency", type=float,
+                        default=SITE_CONFIG['latency'],
+                        help="seconds to wait before answering")
+    parser.add_argument("--jitter", type=float, default=SITE_CONFIG['jitter'],
+                        help="up to this many more seconds, at random")
+    parser.add_argument("--error-rate", type=float,
+                        default=SITE_CONFIG['error_rate'],
+                        help="fraction of requests answered 500")
+    parser.add_argument("--throttle-rate", type=float,
+                        default=SITE_CONFIG['throttle_rate'],
+                        help="fraction of requests answered 429")
+    parser.add_argument("--retry-after", type=int,
+                        default=SITE_CONFIG['retry_after'],
+                        help="Retry-After seconds sent with 429s")
+    parser.add_argument("--seed", type=int, default=SITE_CONFIG['seed'],
+                        help="changes the text of every transcript")
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    configure_sites(shows=args.shows, episodes=args.episodes,
+                    turns=args.turns, end_date=args.end_date,
+                    latency=args.latency, jitter=args.jitter,
+                    error_rate=args.error_rate,
+                    throttle_rate=args.throttle_rate,
+                    retry_after=args.retry_after, seed=args.seed)
+    sites = start_sites(args.port, args.host)
+    print("Serving stand-in sites; crawl them with:")
+    print("python run_crawlers.py --db <test database> " +
+          " ".join(["--{}-url {}".format(site, url)
+                    for site, (_, url) in sites.items()]))
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stop_sites(sites)
+        print_site_stats()
@@ -0,0 +1,311 @@
+'''
+CAPP 30122: Durable work queue for crawl workers
+
+A SQLite table of work items (list a show, fetch and parse an episode,
+write an episode) shared by any number of worker processes, on this machine
+or on others that see the same file. A worker claims items with a
+time-limited lease and renews the leases it still holds (heartbeat) as its
+work makes progress; when it finishes an item, the items the work produced
+are queued in the same transaction. Items whose lease runs out (their worker
+died or hung), or that are still leased a maximum time after they were
+claimed, are queued again for another worker, up to MAX_ATTEMPTS times.
+
+The file uses SQLite's default rollback journal rather than WAL, so it
+works on a shared filesystem with working file locks.
+'''
+
+import os
+import time
+import pickle
+import socket
+import sqlite3
+
+
+QUEUE_FILENAME = 'crawl_queue.sqlite3'
+ITEM_STATES = ['queued', 'leased', 'done', 'failed']
+
+# Lower priorities are claimed first: shows are listed before their
+# episodes are fetched, and episodes are fetched before they are written
+WORK_PRIORITIES = {'show': 0, 'episode': 1, 'write': 2, 'writer': 3}
+
+# A lease is renewed between items and, within a long item such as a Fox
+# show paginated in the browser, after each page. However often it is
+# renewed, an item is taken back MAX_LEASE_SECONDS after it was claimed
+# (unless it was claimed with no maximum, like the writer's item).
+LEASE_SECONDS = 120
+MAX_LEASE_SECONDS = 3600
+MAX_ATTEMPTS = 3
+
+# Seconds to wait for another process's lock on the queue
+BUSY_TIMEOUT = 60
+
+QUEUE_TABLES = ['''CREATE TABLE IF NOT EXISTS work_item(
+                       item_id INTEGER PRIMARY KEY,
+                       kind varchar(10) NOT NULL,
+                       item_key varchar(400) UNIQUE,
+                       priority int NOT NULL,
+                       payload blob,
+                       state varchar(10) NOT NULL DEFAULT 'queued',
+                       attempts int NOT NULL DEFAULT 0,
+                       lease_owner varchar(100),
+                       lease_expires real,
+                       lease_deadline real,
+                       error varchar(500),
+                       updated real)''',
+                '''CREATE INDEX IF NOT EXISTS work_item_claim
+                   ON work_item(state, priority, item_id)''',
+                '''CREATE INDEX IF NOT EXISTS work_item_lease
+                   ON work_item(lease_owner)''']
+
+
+def get_worker_id():
+    '''
+    Return an ID for this worker process that is unique across machines.
+    '''
+    return '{}-{}'.format(socket.gethostname(), os.getpid())
+
+
+def connect_queue(queue_name=QUEUE_FILENAME):
+    '''
+    Open the queue database, creating its tables if needed. Transactions are
+    begun explicitly (see claim_items), so the connection is in autocommit
+    mode.
+    '''
+    conn = sqlite3.connect(queue_name, timeout=BUSY_TIMEOUT,
+                           isolation_level=None)
+    for statement in QUEUE_TABLES:
+        conn.execute(statement)
+
+    return conn
+
+
+def put_items(db_cursor, items, state='queued', requeue=False):
+    '''
+    Add work items to the queue. An item with the same key as one already
+    queued (in any state) is left out, so a listing can be read again
+    without queueing its episodes twice.
+
+    Inputs:
+        db_cursor: cursor on the queue database
+        items: list of (kind, key, payload) tuples; key may be None for
+            items that are never left out, payload is any picklable object
+        state: (str) state to add the items in
+        requeue: (bool) queue items with the same key as a done or failed
+            item again, with the new payload, instead of leaving them out
+
+    Outputs: (int) number of items added or queued again
+    '''
+    query = '''INSERT INTO work_item(kind, item_key, priority, payload, state,
+                                     updated)
+               VALUES(?, ?, ?, ?, ?, ?)
+               ON CONFLICT(item_key) DO '''
+    if requeue:
+        query += '''UPDATE SET payload = excluded.payload, state = 'queued',
+                                attempts = 0, error = NULL,
+                                updated = excluded.updated
+                     WHERE state IN ('done', 'failed')'''
+    else:
+        query += 'NOTHING'
+
+    before = db_cursor.connection.total_changes
+    db_cursor.executemany(query,
+        [(kind, key, WORK_PRIORITIES[kind], pickle.dumps(payload), state,
+          time.time()) for kind, key, payload in items])
+
+    return db_cursor.connection.total_changes - before
+
+
+def requeue_expired(db_cursor, now=None):
+    '''
+    Queue again the items whose lease has run out or passed its deadline
+    (see claim_items), or mark them failed once they have been tried
+    MAX_ATTEMPTS times.
+
+    Outputs: (int) number of expired leases
+    '''
+    now = now or time.time()
+    db_cursor.execute(\
+        '''UPDATE work_item
+           SET state = CASE WHEN attempts >= ? THEN 'failed'
+                            ELSE 'queued' END,
+               error = 'lease of ' || lease_owner || ' expired',
+               lease_owner = NULL, lease_expires = NULL,
+               lease_deadline = NULL, updated = ?
+           WHERE state = 'leased' AND
+                 (lease_expires < ? OR lease_deadline < ?)''',
+        (MAX_ATTEMPTS, now, now, now))
+
+    return db_cursor.rowcount
+
+
+def claim_items(conn, worker_id, kinds, limit=1,
+                lease_seconds=LEASE_SECONDS,
+                max_lease_seconds=MAX_LEASE_SECONDS):
+    '''
+    Lease the next queued items of some kinds to a worker, highest priority
+    first. Expired leases are queued again first.
+
+    Inputs:
+        conn: connection from connect_queue
+        worker_id: (str) worker taking the items (see get_worker_id)
+        kinds: list of item kinds to claim
+        limit: (int) most items to claim
+        lease_seconds: (float) how long the worker has to finish them or
+            renew the lease (see heartbeat)
+        max_lease_seconds: (float) how long the lease can be renewed for,
+            or None for as long as the worker keeps renewing it
+
+    Outputs: list of (item_id, kind, payload) tuples, empty if nothing is
+        queued
+    '''
+    now = time.time()
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        db_cursor = conn.cursor()
+        requeue_expired(db_cursor, now)
+        rows = db_cursor.execute(\
+            '''SELECT item_id, kind, payload FROM work_item
+               WHERE state = 'queued' AND kind IN ({})
+               ORDER BY priority, item_id LIMIT ?'''.format(\
+                   ', '.join('?' * len(kinds))),
+            list(kinds) + [limit]).fetchall()
+        db_cursor.executemany(\
+            '''UPDATE work_item
+               SET state = 'leased', lease_owner = ?, lease_expires = ?,
+                   lease_deadline = ?, attempts = attempts + 1, updated = ?
+               WHERE item_id = ?''',
+            [(worker_id, now + lease_seconds,
+              None if max_lease_seconds is None else now + max_lease_seconds,
+              now, item_id)
+             for item_id, _, _ in rows])
+        conn.execute('COMMIT')
+    except Exception:
+        conn.execute('ROLLBACK')
+        raise
+
+    return [(item_id, kind, pickle.loads(payload))
+            for item_id, kind, payload in rows]
+
+
+def heartbeat(conn, worker_id, lease_seconds=LEASE_SECONDS):
+    '''
+    Renew the leases of every item a worker holds. Called by the worker as
+    its work makes progress, never on a timer, so the leases of a worker
+    that hangs run out.
+
+    Outputs: (int) number of leases renewed
+    '''
+    now = time.time()
+    db_cursor = conn.execute(\
+        '''UPDATE work_item SET lease_expires = ?, updated = ?
+           WHERE state = 'leased' AND lease_owner = ?''',
+        (now + lease_seconds, now, worker_id))
+
+    return db_cursor.rowcount
+
+
+def complete_items(conn, worker_id, item_ids, new_items=None):
+    '''
+    Mark items done and queue the items their work produced, in one
+    transaction. Items whose lease the worker has lost (it expired and they
+    were queued again) are left alone, and nothing is queued for them.
+
+    Inputs:
+        conn: connection from connect_queue
+        worker_id: (str) worker that claimed the items
+        item_ids: list of item IDs
+        new_items: list of (kind, key, payload) tuples to queue (see
+            put_items)
+
+    Outputs: (bool) True if the worker still held every item
+    '''
+    now = time.time()
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        db_cursor = conn.cursor()
+        db_cursor.executemany(\
+            '''UPDATE work_item
+               SET state = 'done', lease_owner = NULL, lease_expires = NULL,
+                   lease_deadline = NULL, error = NULL, updated = ?
+               WHERE item_id = ? AND state = 'leased' AND lease_owner = ?''',
+            [(now, item_id, worker_id) for item_id in item_ids])
+        held = db_cursor.rowcount == len(item_ids)
+        if not held:
+            conn.execute('ROLLBACK')
+            return False
+        if new_items:
+            put_items(db_cursor, new_items)
+        conn.execute('COMMIT')
+    except Exception:
+        conn.execute('ROLLBACK')
+        raise
+
+    return True
+
+
+def fail_item(conn, worker_id, item_id, error):
+    '''
+    Give an item back after its work failed: it is queued again, or marked
+    failed once it has been tried MAX_ATTEMPTS times.
+    '''
+    conn.execute(\
+        '''UPDATE work_item
+           SET state = CASE WHEN attempts >= ? THEN 'failed'
+                            ELSE 'queued' END,
+               error = ?, lease_owner = NULL, lease_expires = NULL,
+               lease_deadline = NULL, updated = ?
+           WHERE item_id = ? AND state = 'leased' AND lease_owner = ?''',
+        (MAX_ATTEMPTS, error[:500], time.time(), item_id, worker_id))
+
+
+def release_items(conn, worker_id, kinds=None):
+    '''
+    Queue again the items a worker still holds, without counting the
+    attempt, when it stops before finishing them.
+    '''
+    query = '''UPDATE work_item
+               SET state = 'queued', attempts = attempts - 1,
+                   lease_owner = NULL, lease_expires = NULL,
+                   lease_deadline = NULL, updated = ?
+               WHERE state = 'leased' AND lease_owner = ?'''
+    params = [time.time(), worker_id]
+    if kinds is not None:
+        query += ' AND kind IN ({})'.format(', '.join('?' * len(kinds)))
+        params.extend(kinds)
+    conn.execute(query, params)
+
+
+def count_pending(conn, kinds):
+    '''
+    Count the items of some kinds that are queued or leased.
+    '''
+    return conn.execute(\
+        '''SELECT COUNT(*) FROM work_item
+           WHERE state IN ('queued', 'leased') AND kind IN ({})'''.format(\
+               ', '.join('?' * len(kinds))), list(kinds)).fetchall()[0][0]
+
+
+def get_queue_summary(conn):
+    '''
+    Count the items of each kind in each state.
+
+    Outputs: dictionary mapping kinds to dictionaries mapping states to
+        counts
+    '''
+    summary = {}
+    for kind, state, count in conn.execute(\
+            '''SELECT kind, state, COUNT(*) FROM work_item
+               GROUP BY kind, state''').fetchall():
+        summary.setdefault(kind, dict.fromkeys(ITEM_STATES, 0))[state] = count
+
+    return summary
+
+
+def get_failed_items(conn):
+    '''
+    Return the (kind, key, error) of every item that failed MAX_ATTEMPTS
+    times.
+    '''
+    return conn.execute('''SELECT kind, item_key, error FROM work_item
+                           WHERE state = 'failed'
+                           ORDER BY item_id''').fetchall()